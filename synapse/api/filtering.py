@@ -297,6 +297,13 @@ class FilterCollection:
             or self._room_ephemeral_filter.filters_all_rooms()
         )
 
+    def blocks_room_ephemeral_type(self, event_type: str) -> bool:
+        """True if all room ephemeral events of the given type will be filtered out."""
+        return (
+            self.blocks_all_room_ephemeral()
+            or self._room_ephemeral_filter.filters_type(event_type)
+        )
+
     def blocks_all_room_account_data(self) -> bool:
         return (
             self._room_account_data_filter.filters_all_types()
@@ -361,6 +368,12 @@ class Filter:
     def filters_all_types(self) -> bool:
         return self.types == [] or "*" in self.not_types
 
+    def filters_type(self, event_type: str) -> bool:
+        """True if all events of the given type will be filtered out."""
+        return not self._check_fields(
+            {"types": lambda v: _matches_wildcard(event_type, v)}
+        )
+
     def filters_all_senders(self) -> bool:
         return self.senders == [] or "*" in self.not_senders
 
@@ -76,6 +76,7 @@ from synapse.module_api.callbacks.third_party_event_rules_callbacks import (
 )
 from synapse.types import ISynapseReactor, StrCollection
 from synapse.util import SYNAPSE_VERSION
+from synapse.util.caches.adaptive import setup_adaptive_cache_sizing
 from synapse.util.caches.lrucache import setup_expire_lru_cache_entries
 from synapse.util.daemonize import daemonize_process
 from synapse.util.gai_resolver import GAIResolver
@@ -583,6 +584,7 @@ async def start(hs: "HomeServer") -> None:
 
     # If we've configured an expiry time for caches, start the background job now.
     setup_expire_lru_cache_entries(hs)
+    setup_adaptive_cache_sizing(hs)
 
     # It is now safe to start your Synapse.
     hs.start_listening()
@@ -634,6 +636,8 @@ def reload_cache_config(config: HomeServerConfig) -> None:
               HomeServer ->  SyncHandler -> ResponseCache.
         - track_memory_usage. This affects synapse.util.caches.TRACK_MEMORY_USAGE which
               influences Synapse's self-reported metrics.
+        - memory_budget: used to start the background job which evicts cache entries
+              when the caches go over budget, at startup.
 
     Also, the HTTPConnectionPool in SimpleHTTPClient sets its maxPersistentPerHost
     parameter based on the global_factor. This won't be applied on a config reload.
@@ -100,8 +100,14 @@ class CacheConfig(Config):
     cache_factors: Dict[str, float]
     global_factor: float
     track_memory_usage: bool
+    memory_budget: Optional[int]
+    adaptive_sizing_enabled: bool
+    adaptive_sizing_recommend_only: bool
+    adaptive_sizing_interval_ms: int
     expiry_time_msec: Optional[int]
     sync_response_cache_duration: int
+    sync_work_unit_cache_duration: int
+    sync_snapshots_enabled: bool
 
     @staticmethod
     def reset() -> None:
@@ -161,6 +167,22 @@ class CacheConfig(Config):
         if self.track_memory_usage:
             check_requirements("cache-memory")
 
+        memory_budget = cache_config.get("memory_budget")
+        self.memory_budget = (
+            self.parse_size(memory_budget) if memory_budget is not None else None
+        )
+
+        adaptive_sizing = cache_config.get("adaptive_sizing") or {}
+        if not isinstance(adaptive_sizing, dict):
+            raise ConfigError("caches.adaptive_sizing must be a dictionary")
+        self.adaptive_sizing_enabled = adaptive_sizing.get("enabled", False)
+        self.adaptive_sizing_recommend_only = adaptive_sizing.get(
+            "recommend_only", False
+        )
+        self.adaptive_sizing_interval_ms = self.parse_duration(
+            adaptive_sizing.get("interval", "5m")
+        )
+
         expire_caches = cache_config.get("expire_caches", True)
         cache_entry_ttl = cache_config.get("cache_entry_ttl", "30m")
 
@@ -200,10 +222,30 @@ class CacheConfig(Config):
             min_cache_ttl = self.cache_autotuning.get("min_cache_ttl")
             self.cache_autotuning["min_cache_ttl"] = self.parse_duration(min_cache_ttl)
 
+            memory_stat = self.cache_autotuning.get("memory_stat", "allocated")
+            if memory_stat not in ("allocated", "active", "resident"):
+                raise ConfigError(
+                    "caches.cache_autotuning.memory_stat must be one of 'allocated', "
+                    "'active' or 'resident'"
+                )
+            self.cache_autotuning["memory_stat"] = memory_stat
+
+            self.cache_autotuning["check_interval"] = self.parse_duration(
+                self.cache_autotuning.get("check_interval", "30s")
+            )
+
         self.sync_response_cache_duration = self.parse_duration(
             cache_config.get("sync_response_cache_duration", "2m")
         )
 
+        self.sync_work_unit_cache_duration = self.parse_duration(
+            cache_config.get("sync_work_unit_cache_duration", "5s")
+        )
+
+        self.sync_snapshots_enabled = cache_config.get("sync_snapshots_enabled", False)
+        if not isinstance(self.sync_snapshots_enabled, bool):
+            raise ConfigError("caches.sync_snapshots_enabled must be a boolean")
+
     def resize_all_caches(self) -> None:
         """Ensure all cache sizes are up-to-date.
 
@@ -13,7 +13,7 @@
 # limitations under the License.
 from typing import Any, Optional
 
-from synapse.config._base import Config
+from synapse.config._base import Config, ConfigError
 from synapse.config._util import validate_config
 from synapse.types import JsonDict
 
@@ -65,6 +65,20 @@ class FederationConfig(Config):
         self.max_long_retries = federation_config.get("max_long_retries", 10)
         self.max_short_retries = federation_config.get("max_short_retries", 3)
 
+        # Optionally limit the number of transactions the federation sender has in
+        # flight at once, across all destinations.
+        self.max_concurrent_transactions: Optional[int] = federation_config.get(
+            "max_concurrent_transactions"
+        )
+        if self.max_concurrent_transactions is not None and (
+            not isinstance(self.max_concurrent_transactions, int)
+            or self.max_concurrent_transactions < 1
+        ):
+            raise ConfigError(
+                "must be a positive integer",
+                ("federation", "max_concurrent_transactions"),
+            )
+
         # Allow for the configuration of the backoff algorithm used
         # when trying to reach an unavailable destination.
         # Unlike previous configuration those values applies across
@@ -769,6 +769,144 @@ class ServerConfig(Config):
         else:
             self.delete_stale_devices_after = None
 
+        notifier_coalescing_config = config.get("notifier_coalescing") or {}
+        if not isinstance(notifier_coalescing_config, dict):
+            raise ConfigError("The 'notifier_coalescing' section must be a dictionary")
+
+        self.notifier_coalesce_window_ms = self.parse_duration(
+            notifier_coalescing_config.get("window", 0)
+        )
+        self.notifier_fanout_jitter_ms = self.parse_duration(
+            notifier_coalescing_config.get("fanout_jitter", 0)
+        )
+        self.notifier_fanout_jitter_threshold = notifier_coalescing_config.get(
+            "fanout_jitter_threshold", 1000
+        )
+        if (
+            not isinstance(self.notifier_fanout_jitter_threshold, int)
+            or self.notifier_fanout_jitter_threshold < 1
+        ):
+            raise ConfigError(
+                "'fanout_jitter_threshold' must be a positive integer",
+                ("notifier_coalescing", "fanout_jitter_threshold"),
+            )
+
+        state_res_process_pool_config = config.get("state_res_process_pool") or {}
+        if not isinstance(state_res_process_pool_config, dict):
+            raise ConfigError(
+                "The 'state_res_process_pool' section must be a dictionary"
+            )
+
+        self.state_res_process_pool_enabled: bool = bool(
+            state_res_process_pool_config.get("enabled", False)
+        )
+        self.state_res_process_pool_workers = state_res_process_pool_config.get(
+            "workers", 2
+        )
+        if (
+            not isinstance(self.state_res_process_pool_workers, int)
+            or self.state_res_process_pool_workers < 1
+        ):
+            raise ConfigError(
+                "'workers' must be a positive integer",
+                ("state_res_process_pool", "workers"),
+            )
+        self.state_res_process_pool_min_conflicted_events = (
+            state_res_process_pool_config.get("min_conflicted_events", 1000)
+        )
+        if (
+            not isinstance(self.state_res_process_pool_min_conflicted_events, int)
+            or self.state_res_process_pool_min_conflicted_events < 0
+        ):
+            raise ConfigError(
+                "'min_conflicted_events' must be a non-negative integer",
+                ("state_res_process_pool", "min_conflicted_events"),
+            )
+
+        state_group_compaction_config = config.get("state_group_compaction") or {}
+        if not isinstance(state_group_compaction_config, dict):
+            raise ConfigError(
+                "The 'state_group_compaction' section must be a dictionary"
+            )
+
+        self.state_group_compaction_enabled: bool = bool(
+            state_group_compaction_config.get("enabled", False)
+        )
+        self.state_group_compaction_interval_ms = self.parse_duration(
+            state_group_compaction_config.get("interval", "1d")
+        )
+        self.state_group_compaction_max_delta_chain_length = (
+            state_group_compaction_config.get("max_delta_chain_length", 50)
+        )
+        if (
+            not isinstance(self.state_group_compaction_max_delta_chain_length, int)
+            or self.state_group_compaction_max_delta_chain_length < 1
+        ):
+            raise ConfigError(
+                "'max_delta_chain_length' must be a positive integer",
+                ("state_group_compaction", "max_delta_chain_length"),
+            )
+
+        state_res_scheduler_config = config.get("state_res_scheduler") or {}
+        if not isinstance(state_res_scheduler_config, dict):
+            raise ConfigError("The 'state_res_scheduler' section must be a dictionary")
+
+        self.state_res_max_concurrent_resolutions: Optional[
+            int
+        ] = state_res_scheduler_config.get("max_concurrent_resolutions")
+        if self.state_res_max_concurrent_resolutions is not None and (
+            not isinstance(self.state_res_max_concurrent_resolutions, int)
+            or self.state_res_max_concurrent_resolutions < 1
+        ):
+            raise ConfigError(
+                "'max_concurrent_resolutions' must be a positive integer",
+                ("state_res_scheduler", "max_concurrent_resolutions"),
+            )
+        self.state_res_active_room_period_ms = self.parse_duration(
+            state_res_scheduler_config.get("active_room_period", "5m")
+        )
+        self.state_res_flooding_room_threshold = state_res_scheduler_config.get(
+            "flooding_room_threshold", 10.0
+        )
+        if (
+            not isinstance(self.state_res_flooding_room_threshold, (int, float))
+            or self.state_res_flooding_room_threshold <= 0
+        ):
+            raise ConfigError(
+                "'flooding_room_threshold' must be a positive number",
+                ("state_res_scheduler", "flooding_room_threshold"),
+            )
+
+        group_commit_config = config.get("event_persistence_group_commit") or {}
+        if not isinstance(group_commit_config, dict):
+            raise ConfigError(
+                "The 'event_persistence_group_commit' section must be a dictionary"
+            )
+
+        self.event_persistence_group_commit_enabled: bool = bool(
+            group_commit_config.get("enabled", False)
+        )
+        self.event_persistence_group_commit_max_latency_ms = self.parse_duration(
+            group_commit_config.get("max_latency", 10)
+        )
+        self.event_persistence_group_commit_max_events = group_commit_config.get(
+            "max_events", 500
+        )
+        if (
+            not isinstance(self.event_persistence_group_commit_max_events, int)
+            or self.event_persistence_group_commit_max_events < 1
+        ):
+            raise ConfigError(
+                "'max_events' must be a positive integer",
+                ("event_persistence_group_commit", "max_events"),
+            )
+
+        # Whether to recalculate the forward extremities and current state of rooms
+        # after persisting their events, when doing so needs state resolution.
+        self.deferred_extremity_maintenance: bool = bool(
+            config.get("deferred_extremity_maintenance", False)
+        )
+
     def has_tls_listener(self) -> bool:
         return any(listener.is_tls() for listener in self.listeners)
 
@@ -17,6 +17,7 @@
 import abc
 import collections.abc
 import os
+import sys
 from typing import (
     TYPE_CHECKING,
     Any,
@@ -39,7 +40,9 @@ from unpaddedbase64 import encode_base64
 from synapse.api.constants import RelationTypes
 from synapse.api.room_versions import EventFormatVersions, RoomVersion, RoomVersions
 from synapse.types import JsonDict, RoomStreamToken, StrCollection
+from synapse.util import json_decoder
 from synapse.util.caches import intern_dict
+from synapse.util.caches.sizing import estimate_size, register_size_estimator
 from synapse.util.frozenutils import freeze
 from synapse.util.stringutils import strtobool
 
@@ -310,16 +313,20 @@ class EventBase(metaclass=abc.ABCMeta):
         assert room_version.event_format == self.format_version
 
         self.room_version = room_version
-        self.signatures = signatures
-        self.unsigned = unsigned
+        self._signatures = signatures
+        self._unsigned = unsigned
         self.rejected_reason = rejected_reason
 
         self._dict = event_dict
 
+        # The JSON this event was built from, if `content`, `signatures` and
+        # `unsigned` have been dropped until they are next needed. See
+        # `drop_decoded_fields`.
+        self._undecoded_json: Optional[str] = None
+
         self.internal_metadata = _EventInternalMetadata(internal_metadata_dict)
 
     depth: DictProperty[int] = DictProperty("depth")
-    content: DictProperty[JsonDict] = DictProperty("content")
     hashes: DictProperty[Dict[str, str]] = DictProperty("hashes")
     origin: DictProperty[str] = DictProperty("origin")
     origin_server_ts: DictProperty[int] = DictProperty("origin_server_ts")
@@ -338,6 +345,91 @@ class EventBase(metaclass=abc.ABCMeta):
     def event_id(self) -> str:
         raise NotImplementedError()
 
+    @property
+    def content(self) -> JsonDict:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
+        try:
+            return self._dict["content"]
+        except KeyError as e1:
+            raise AttributeError(
+                "'%s' has no 'content' property" % (type(self),)
+            ) from e1.__context__
+
+    @content.setter
+    def content(self, content: JsonDict) -> None:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
+        self._dict["content"] = content
+
+    @property
+    def signatures(self) -> Dict[str, Dict[str, str]]:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
+        return self._signatures
+
+    @signatures.setter
+    def signatures(self, signatures: Dict[str, Dict[str, str]]) -> None:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
+        self._signatures = signatures
+
+    @property
+    def unsigned(self) -> JsonDict:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
+        return self._unsigned
+
+    @unsigned.setter
+    def unsigned(self, unsigned: JsonDict) -> None:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
+        self._unsigned = unsigned
+
+    def drop_decoded_fields(self, event_json: str) -> None:
+        """Drop the decoded `content`, `signatures` and `unsigned` of this event,
+        keeping only the JSON they came from. They are decoded again the next time
+        they are needed.
+
+        Nested dicts take several times as much memory as the JSON they were
+        decoded from, and most events held in the event cache are never looked at
+        beyond their top-level fields, so this lets us hold many more events in
+        the same amount of memory.
+
+        Args:
+            event_json: The JSON this event was built from. The caller must ensure
+                that the event has not been modified since.
+        """
+        if self._undecoded_json is not None:
+            return
+
+        event_dict = {k: v for k, v in self._dict.items() if k != "content"}
+        self._dict = freeze(event_dict) if USE_FROZEN_DICTS else event_dict
+        self._signatures = {}
+        self._unsigned = {}
+        self._undecoded_json = event_json
+
+    def get_undecoded_json(self) -> Optional[str]:
+        """Get the JSON this event was built from, if its `content`, `signatures`
+        and `unsigned` have been dropped by `drop_decoded_fields` and not yet
+        decoded again.
+        """
+        return self._undecoded_json
+
+    def _decode_dropped_fields(self) -> None:
+        """Restore the fields dropped by `drop_decoded_fields`."""
+        assert self._undecoded_json is not None
+        d = json_decoder.decode(self._undecoded_json)
+        self._undecoded_json = None
+
+        event_dict = dict(self._dict)
+        event_dict["content"] = d.get("content", {})
+        self._dict = freeze(event_dict) if USE_FROZEN_DICTS else event_dict
+        self._signatures = {
+            name: dict(sigs.items()) for name, sigs in d.get("signatures", {}).items()
+        }
+        self._unsigned = dict(d.get("unsigned", {}))
+
     @property
     def membership(self) -> str:
         return self.content["membership"]
@@ -357,12 +449,16 @@ class EventBase(metaclass=abc.ABCMeta):
         return self._dict.get("state_key")
 
     def get_dict(self) -> JsonDict:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
         d = dict(self._dict)
         d.update({"signatures": self.signatures, "unsigned": dict(self.unsigned)})
 
         return d
 
     def get(self, key: str, default: Optional[Any] = None) -> Any:
+        if self._undecoded_json is not None and key == "content":
+            self._decode_dropped_fields()
         return self._dict.get(key, default)
 
     def get_internal_metadata_dict(self) -> JsonDict:
@@ -386,6 +482,8 @@ class EventBase(metaclass=abc.ABCMeta):
         Return a JSON object suitable for a templated event, as used in the
         make_{join,leave,knock} workflow.
         """
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
         # By using _dict directly we don't pull in signatures/unsigned.
         template_json = dict(self._dict)
         # The hashes (similar to the signature) need to be recalculated by the
@@ -396,15 +494,23 @@ class EventBase(metaclass=abc.ABCMeta):
         return template_json
 
     def __getitem__(self, field: str) -> Optional[Any]:
+        if self._undecoded_json is not None and field == "content":
+            self._decode_dropped_fields()
         return self._dict[field]
 
     def __contains__(self, field: str) -> bool:
+        if self._undecoded_json is not None and field == "content":
+            self._decode_dropped_fields()
         return field in self._dict
 
     def items(self) -> List[Tuple[str, Optional[Any]]]:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
         return list(self._dict.items())
 
     def keys(self) -> Iterable[str]:
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
         return self._dict.keys()
 
     def prev_event_ids(self) -> List[str]:
@@ -429,6 +535,8 @@ class EventBase(metaclass=abc.ABCMeta):
         """'Freeze' the event dict, so it cannot be modified by accident"""
 
         # this will be a no-op if the event dict is already frozen.
+        if self._undecoded_json is not None:
+            self._decode_dropped_fields()
         self._dict = freeze(self._dict)
 
     def __str__(self) -> str:
@@ -590,6 +698,24 @@ class FrozenEventV3(FrozenEventV2):
         return self._event_id
 
 
+def _estimate_event_size(event: EventBase) -> int:
+    """Estimate the size of an event for the caches' memory accounting."""
+    size = (
+        sys.getsizeof(event)
+        + sys.getsizeof(event.__dict__)
+        + estimate_size(event._dict)
+        + estimate_size(event.internal_metadata._dict)
+    )
+    if event._undecoded_json is not None:
+        size += sys.getsizeof(event._undecoded_json)
+    else:
+        size += estimate_size(event._signatures) + estimate_size(event._unsigned)
+    return size
+
+
+register_size_estimator(EventBase, _estimate_event_size)
+
+
 def _event_type_from_format_version(
     format_version: int,
 ) -> Type[Union[FrozenEvent, FrozenEventV2, FrozenEventV3]]:
@@ -59,6 +59,7 @@ from synapse.federation.federation_base import (
     InvalidEventSignatureError,
     event_from_pdu_json,
 )
+from synapse.federation.incoming_pdus import IncomingPduScheduler
 from synapse.federation.persistence import TransactionActions
 from synapse.federation.units import Edu, Transaction
 from synapse.handlers.worker_lock import NEW_EVENT_DURING_PURGE_LOCK_NAME
@@ -81,7 +82,6 @@ from synapse.replication.http.federation import (
     ReplicationFederationSendEduRestServlet,
     ReplicationGetQueryRestServlet,
 )
-from synapse.storage.databases.main.lock import Lock
 from synapse.storage.databases.main.roommember import extract_heroes_from_room_summary
 from synapse.storage.roommember import MemberSummary
 from synapse.types import JsonDict, StateMap, get_domain_from_id
@@ -97,6 +97,13 @@ if TYPE_CHECKING:
 # parallel, up to this limit.
 TRANSACTION_CONCURRENCY_LIMIT = 10
 
+# the number of rooms whose staged events we process at once.
+INCOMING_PDU_CONCURRENCY_LIMIT = 100
+
+# the number of staged events we process in a room before giving other rooms a
+# turn.
+INCOMING_PDU_BATCH_SIZE = 10
+
 logger = logging.getLogger(__name__)
 
 received_pdus_counter = Counter("synapse_federation_server_received_pdus", "")
@@ -179,6 +186,16 @@ class FederationServer(FederationBase):
         # Whether we have started handling old events in the staging area.
         self._started_handling_of_staged_events = False
 
+        self._incoming_pdu_scheduler = IncomingPduScheduler(
+            hs,
+            self._process_incoming_pdus_in_room_inner,
+            INCOMING_PDU_CONCURRENCY_LIMIT,
+        )
+
+        # The latest event we've received in each room which is waiting to be
+        # processed, and the server which sent it.
+        self._latest_received_pdus: Dict[str, Tuple[str, EventBase]] = {}
+
     @wrap_as_background_process("_handle_old_staged_events")
     async def _handle_old_staged_events(self) -> None:
         """Handle old staged events by fetching all rooms that have staged
@@ -193,23 +210,7 @@ class FederationServer(FederationBase):
         random.shuffle(room_ids)
 
         for room_id in room_ids:
-            room_version = await self.store.get_room_version(room_id)
-
-            # Try and acquire the processing lock for the room, if we get it start a
-            # background process for handling the events in the room.
-            lock = await self.store.try_acquire_lock(
-                _INBOUND_EVENT_HANDLING_LOCK_NAME, room_id
-            )
-            if lock:
-                logger.info("Handling old staged inbound events in %s", room_id)
-                self._process_incoming_pdus_in_room_inner(
-                    room_id,
-                    room_version,
-                    lock,
-                )
-
-            # We pause a bit so that we don't start handling all rooms at once.
-            await self._clock.sleep(random.uniform(0, 0.1))
+            self._incoming_pdu_scheduler.schedule(room_id, None)
 
     async def on_backfill_request(
         self, origin: str, room_id: str, versions: List[str], limit: int
@@ -1129,15 +1130,9 @@ class FederationServer(FederationBase):
         # Add the event to our staging area
         await self.store.insert_received_event_to_staging(origin, pdu)
 
-        # Try and acquire the processing lock for the room, if we get it start a
-        # background process for handling the events in the room.
-        lock = await self.store.try_acquire_lock(
-            _INBOUND_EVENT_HANDLING_LOCK_NAME, pdu.room_id
-        )
-        if lock:
-            self._process_incoming_pdus_in_room_inner(
-                pdu.room_id, room_version, lock, origin, pdu
-            )
+        # Schedule the processing of the events in the room.
+        self._latest_received_pdus[pdu.room_id] = (origin, pdu)
+        self._incoming_pdu_scheduler.schedule(pdu.room_id, origin)
 
     async def _get_next_nonspam_staged_event_for_room(
         self, room_id: str, room_version: RoomVersion
@@ -1176,20 +1171,29 @@ class FederationServer(FederationBase):
 
             return next
 
-    @wrap_as_background_process("_process_incoming_pdus_in_room_inner")
-    async def _process_incoming_pdus_in_room_inner(
-        self,
-        room_id: str,
-        room_version: RoomVersion,
-        lock: Lock,
-        latest_origin: Optional[str] = None,
-        latest_event: Optional[EventBase] = None,
-    ) -> None:
-        """Process events in the staging area for the given room.
+    async def _process_incoming_pdus_in_room_inner(self, room_id: str) -> bool:
+        """Process a batch of events in the staging area for the given room.
+
+        Called by the `IncomingPduScheduler`.
 
-        The latest_origin and latest_event args are the latest origin and event
-        received (or None to simply pull the next event from the database).
+        Returns:
+            Whether there may be more events in the staging area to process.
         """
+        latest_origin: Optional[str] = None
+        latest_event: Optional[EventBase] = None
+        latest = self._latest_received_pdus.pop(room_id, None)
+        if latest is not None:
+            latest_origin, latest_event = latest
+
+        room_version = await self.store.get_room_version(room_id)
+
+        # Try and acquire the processing lock for the room. If we don't get it
+        # then someone else is processing the room, and will pick up the events.
+        lock = await self.store.try_acquire_lock(
+            _INBOUND_EVENT_HANDLING_LOCK_NAME, room_id
+        )
+        if not lock:
+            return False
 
         # The common path is for the event we just received be the only event in
         # the room, so instead of pulling the event out of the DB and parsing
@@ -1214,7 +1218,7 @@ class FederationServer(FederationBase):
             )
             if not next:
                 await lock.release()
-                return
+                return False
 
             origin, event = next
         else:
@@ -1222,8 +1226,9 @@ class FederationServer(FederationBase):
             event = latest_event
 
         # We loop round until there are no more events in the room in the
-        # staging area, or we fail to get the lock (which means another process
-        # has started processing).
+        # staging area, we fail to get the lock (which means another process
+        # has started processing), or we've processed a batch of events.
+        processed = 0
         while True:
             async with lock:
                 logger.info("handling received PDU in room %s: %s", room_id, event)
@@ -1262,12 +1267,17 @@ class FederationServer(FederationBase):
                         (self._clock.time_msec() - received_ts) / 1000
                     )
 
+            processed += 1
+            if processed >= INCOMING_PDU_BATCH_SIZE:
+                # Give other rooms a turn.
+                return True
+
             next = await self._get_next_nonspam_staged_event_for_room(
                 room_id, room_version
             )
 
             if not next:
-                break
+                return False
 
             origin, event = next
 
@@ -1284,7 +1294,7 @@ class FederationServer(FederationBase):
                     room_id, room_version
                 )
                 if not next:
-                    break
+                    return False
 
                 origin, event = next
 
@@ -1292,7 +1302,7 @@ class FederationServer(FederationBase):
                 _INBOUND_EVENT_HANDLING_LOCK_NAME, room_id
             )
             if not new_lock:
-                return
+                return False
             lock = new_lock
 
     async def exchange_third_party_invite(
@@ -0,0 +1,182 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from collections import OrderedDict, deque
+from typing import TYPE_CHECKING, Awaitable, Callable, Deque, Dict, Optional, Set
+
+import attr
+from prometheus_client import Histogram
+
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
+logger = logging.getLogger(__name__)
+
+room_queue_wait = Histogram(
+    "synapse_federation_server_incoming_pdu_room_wait_seconds",
+    "Time rooms with received PDUs to process waited for a worker",
+)
+
+origin_queue_wait = Histogram(
+    "synapse_federation_server_incoming_pdu_origin_wait_seconds",
+    "Time rooms with PDUs received from the given domain waited for a worker",
+    labelnames=("server_name",),
+)
+
+
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class _QueuedRoom:
+    room_id: str
+    # The server which sent the PDU which caused the room to be queued, if known.
+    origin: Optional[str]
+    queued_ts: int
+
+
+class IncomingPduScheduler:
+    """Schedules the processing of received PDUs, room by room, on a bounded pool
+    of workers.
+
+    Rooms are queued by the server which sent the PDUs in them, and workers take
+    a room from each server in turn, so that a server sending lots of PDUs (in
+    lots of rooms) can't hold up the PDUs from other servers.
+
+    Each time a worker takes a room it calls `process_room` with it, which should
+    process a batch of the room's PDUs and return whether there may be more to
+    process, in which case the room is queued again (behind the other rooms
+    from the same server).
+
+    Args:
+        hs
+        process_room: the function to process a batch of PDUs in a room.
+        max_workers: the number of rooms to process at once.
+    """
+
+    def __init__(
+        self,
+        hs: "HomeServer",
+        process_room: Callable[[str], Awaitable[bool]],
+        max_workers: int,
+    ):
+        self._clock = hs.get_clock()
+        self._process_room = process_room
+        self._max_workers = max_workers
+
+        self._federation_metrics_domains = (
+            hs.config.federation.federation_metrics_domains
+        )
+
+        # The queued rooms, by the server which sent their PDUs. The servers are
+        # in the order they'll next be taken from.
+        self._queues: "OrderedDict[Optional[str], Deque[_QueuedRoom]]" = OrderedDict()
+        self._queued_room_ids: Set[str] = set()
+
+        # The rooms being processed, and which of those have been scheduled again
+        # meanwhile (mapped to the server which sent the PDU).
+        self._processing_room_ids: Set[str] = set()
+        self._rescheduled_rooms: Dict[str, Optional[str]] = {}
+
+        self._num_workers = 0
+
+        LaterGauge(
+            "synapse_federation_server_incoming_pdu_queued_rooms",
+            "Number of rooms with received PDUs waiting to be processed",
+            [],
+            lambda: len(self._queued_room_ids),
+        )
+
+        LaterGauge(
+            "synapse_federation_server_incoming_pdu_active_rooms",
+            "Number of rooms whose received PDUs are being processed",
+            [],
+            lambda: len(self._processing_room_ids),
+        )
+
+    def schedule(self, room_id: str, origin: Optional[str]) -> None:
+        """Schedules the processing of the received PDUs in the given room.
+
+        Args:
+            room_id: the room with PDUs to process.
+            origin: the server which sent the PDU, if known.
+        """
+        if room_id in self._processing_room_ids:
+            # The worker processing the room may have already checked for more
+            # PDUs, so queue the room again once it's done.
+            self._rescheduled_rooms.setdefault(room_id, origin)
+            return
+
+        if room_id in self._queued_room_ids:
+            return
+
+        self._queue_room(room_id, origin)
+
+        while self._num_workers < self._max_workers and self._queued_room_ids:
+            self._num_workers += 1
+            run_as_background_process("process_incoming_pdus", self._worker)
+
+    def _queue_room(self, room_id: str, origin: Optional[str]) -> None:
+        queue = self._queues.get(origin)
+        if queue is None:
+            queue = self._queues[origin] = deque()
+        queue.append(_QueuedRoom(room_id, origin, self._clock.time_msec()))
+        self._queued_room_ids.add(room_id)
+
+    def _next_room(self) -> Optional[_QueuedRoom]:
+        """Takes the next room from the server whose turn it is."""
+        if not self._queues:
+            return None
+
+        origin, queue = next(iter(self._queues.items()))
+        room = queue.popleft()
+        if queue:
+            self._queues.move_to_end(origin)
+        else:
+            del self._queues[origin]
+
+        self._queued_room_ids.discard(room.room_id)
+        return room
+
+    async def _worker(self) -> None:
+        try:
+            while True:
+                room = self._next_room()
+                if room is None:
+                    return
+
+                wait = (self._clock.time_msec() - room.queued_ts) / 1000
+                room_queue_wait.observe(wait)
+                if room.origin in self._federation_metrics_domains:
+                    origin_queue_wait.labels(server_name=room.origin).observe(wait)
+
+                self._processing_room_ids.add(room.room_id)
+                more_to_process = False
+                try:
+                    more_to_process = await self._process_room(room.room_id)
+                except Exception:
+                    logger.exception(
+                        "Failed to process received PDUs in %s", room.room_id
+                    )
+                finally:
+                    self._processing_room_ids.discard(room.room_id)
+
+                if room.room_id in self._rescheduled_rooms:
+                    origin = self._rescheduled_rooms.pop(room.room_id)
+                    self._queue_room(room.room_id, origin)
+                elif more_to_process:
+                    self._queue_room(room.room_id, room.origin)
+        finally:
+            self._num_workers -= 1
@@ -147,6 +147,7 @@ from twisted.internet import defer
 import synapse.metrics
 from synapse.api.presence import UserPresenceState
 from synapse.events import EventBase
+from synapse.federation.sender.catch_up import CatchUpCoordinator
 from synapse.federation.sender.per_destination_queue import (
     CATCHUP_RETRY_INTERVAL,
     PerDestinationQueue,
@@ -373,6 +374,7 @@ class FederationSender(AbstractFederationSender):
 
         self._presence_router: Optional["PresenceRouter"] = None
         self._transaction_manager = TransactionManager(hs)
+        self._catch_up_coordinator = CatchUpCoordinator(hs)
 
         self._instance_name = hs.get_instance_name()
         self._federation_shard_config = hs.config.worker.federation_shard_config
@@ -442,7 +444,12 @@ class FederationSender(AbstractFederationSender):
         """
         queue = self._per_destination_queues.get(destination)
         if not queue:
-            queue = PerDestinationQueue(self.hs, self._transaction_manager, destination)
+            queue = PerDestinationQueue(
+                self.hs,
+                self._transaction_manager,
+                self._catch_up_coordinator,
+                destination,
+            )
             self._per_destination_queues[destination] = queue
         return queue
 
@@ -942,10 +949,12 @@ class FederationSender(AbstractFederationSender):
         )
 
         for destination in destinations:
+            queue = self._get_per_destination_queue(destination)
+            queue.mark_device_messages_pending()
             if immediate:
-                self._get_per_destination_queue(destination).attempt_new_transaction()
+                queue.attempt_new_transaction()
             else:
-                self._get_per_destination_queue(destination).mark_new_data()
+                queue.mark_new_data()
                 self._destination_wakeup_queue.add_to_queue(destination)
 
     def wake_destination(self, destination: str) -> None:
@@ -0,0 +1,210 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+from typing import TYPE_CHECKING, Dict, List, Mapping, Tuple
+
+import attr
+from prometheus_client import Counter, Histogram
+
+from synapse.events import EventBase
+from synapse.metrics import LaterGauge
+from synapse.types import StrCollection
+from synapse.util.batching_queue import BatchingQueue
+from synapse.util.caches.response_cache import ResponseCache
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
+logger = logging.getLogger(__name__)
+
+catch_up_rooms_sent_counter = Counter(
+    "synapse_federation_catch_up_rooms_sent",
+    "Number of rooms caught up on destinations which missed PDUs",
+)
+
+catch_up_duration = Histogram(
+    "synapse_federation_catch_up_duration_seconds",
+    "Time taken to catch up destinations which missed PDUs",
+    buckets=(1, 10, 60, 300, 1800, 3600, 21600, 86400, "+Inf"),
+)
+
+# How long the forward extremities of a room are shared between destinations
+# catching up on it. After an outage many destinations will be catching up on the
+# same rooms at once, so this needn't be long.
+EXTREMITIES_CACHE_TIMEOUT_MS = 5 * 1000
+
+
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class RoomExtremities:
+    """The forward extremities of a room, as sent to destinations catching up."""
+
+    event_ids: List[str]
+    # The room stream position the extremities were fetched at: they reflect all
+    # the events up to this position.
+    stream_ordering: int
+    # The extremity events. Empty if the room has partial state, as we can't be
+    # sure which of them the destinations should see.
+    events: List[EventBase]
+    partial_state: bool
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _CatchUpProgress:
+    """How far a destination has got through catching up."""
+
+    started_ts: int
+    # The stream ordering of the last PDU we've caught the destination up to.
+    stream_ordering: int
+    rooms_sent: int = 0
+
+
+class CatchUpCoordinator:
+    """Shares the work of catching up destinations which missed PDUs (e.g. because
+    they, or we, were offline) between them.
+
+    After an outage there will be many destinations catching up at once, mostly on
+    the same rooms. Rather than each of them querying for their events separately:
+
+    * the events are fetched in batches across all the destinations which ask for
+      them at once, and
+    * the forward extremities of each room are fetched once and then shared by
+      all the destinations catching up on that room for a short while.
+
+    Also tracks how far behind each destination is, for metrics.
+    """
+
+    def __init__(self, hs: "HomeServer"):
+        self._clock = hs.get_clock()
+        self._store = hs.get_datastores().main
+
+        self._event_fetcher: BatchingQueue[
+            StrCollection, Mapping[str, EventBase]
+        ] = BatchingQueue(
+            "federation_catch_up_events",
+            self._clock,
+            self._fetch_events,
+        )
+
+        self._extremities_cache: ResponseCache[str] = ResponseCache(
+            self._clock,
+            "federation_catch_up_extremities",
+            timeout_ms=EXTREMITIES_CACHE_TIMEOUT_MS,
+        )
+
+        # The destinations which are catching up.
+        self._progress: Dict[str, _CatchUpProgress] = {}
+
+        LaterGauge(
+            "synapse_federation_catch_up_destinations",
+            "Number of destinations which are catching up on missed PDUs",
+            [],
+            lambda: len(self._progress),
+        )
+
+        LaterGauge(
+            "synapse_federation_catch_up_backlog",
+            "Number of stream positions which each destination catching up is behind",
+            ["server_name"],
+            self._get_backlogs,
+        )
+
+    async def get_events(self, event_ids: StrCollection) -> List[EventBase]:
+        """Fetches the given events, in the given order.
+
+        Rejected events are not returned, and redacted events are returned pruned.
+        """
+        events = await self._event_fetcher.add_to_queue(event_ids)
+        return [events[event_id] for event_id in event_ids if event_id in events]
+
+    async def _fetch_events(
+        self, batches: List[StrCollection]
+    ) -> Mapping[str, EventBase]:
+        event_ids = {event_id for batch in batches for event_id in batch}
+        return await self._store.get_events(event_ids)
+
+    async def get_room_extremities(
+        self, room_id: str, stream_ordering: int
+    ) -> RoomExtremities:
+        """Fetches the forward extremities of the given room.
+
+        The result may be a few seconds out of date, but reflects at least all the
+        events up to the given stream ordering.
+        """
+        extremities = await self._extremities_cache.wrap(
+            room_id, self._fetch_room_extremities, room_id
+        )
+        if extremities.stream_ordering < stream_ordering:
+            # The shared extremities were fetched before an event we need to know
+            # about was persisted, so fetch them again.
+            self._extremities_cache.unset(room_id)
+            extremities = await self._extremities_cache.wrap(
+                room_id, self._fetch_room_extremities, room_id
+            )
+        return extremities
+
+    async def _fetch_room_extremities(self, room_id: str) -> RoomExtremities:
+        stream_ordering = self._store.get_room_max_stream_ordering()
+        event_ids = await self._store.get_prev_events_for_room(room_id)
+        if await self._store.is_partial_state_room(room_id):
+            return RoomExtremities(
+                event_ids=event_ids,
+                stream_ordering=stream_ordering,
+                events=[],
+                partial_state=True,
+            )
+
+        events = await self.get_events(event_ids)
+        return RoomExtremities(
+            event_ids=event_ids,
+            stream_ordering=stream_ordering,
+            events=events,
+            partial_state=False,
+        )
+
+    def note_progress(self, destination: str, stream_ordering: int) -> None:
+        """Records that the destination is catching up, and has been caught up to
+        the given stream ordering.
+        """
+        progress = self._progress.get(destination)
+        if progress is None:
+            self._progress[destination] = _CatchUpProgress(
+                started_ts=self._clock.time_msec(), stream_ordering=stream_ordering
+            )
+        elif stream_ordering > progress.stream_ordering:
+            progress.stream_ordering = stream_ordering
+            progress.rooms_sent += 1
+            catch_up_rooms_sent_counter.inc()
+
+    def note_caught_up(self, destination: str) -> None:
+        """Records that the destination has caught up."""
+        progress = self._progress.pop(destination, None)
+        if progress is None:
+            return
+
+        duration = (self._clock.time_msec() - progress.started_ts) / 1000
+        catch_up_duration.observe(duration)
+        logger.info(
+            "Caught up destination %s on %d rooms in %.1fs",
+            destination,
+            progress.rooms_sent,
+            duration,
+        )
+
+    def _get_backlogs(self) -> Dict[Tuple[str, ...], int]:
+        max_stream_ordering = self._store.get_room_max_stream_ordering()
+        return {
+            (destination,): max(0, max_stream_ordering - progress.stream_ordering)
+            for destination, progress in self._progress.items()
+        }
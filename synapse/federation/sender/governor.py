@@ -0,0 +1,290 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import (
+    TYPE_CHECKING,
+    AsyncContextManager,
+    AsyncIterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import attr
+from prometheus_client import Counter, Gauge, Histogram
+
+from twisted.internet import defer
+from twisted.internet.defer import CancelledError
+from twisted.internet.interfaces import IDelayedCall
+
+from synapse.logging.context import PreserveLoggingContext, make_deferred_yieldable
+from synapse.util.caches.lrucache import LruCache
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
+logger = logging.getLogger(__name__)
+
+
+class TransactionPriority(IntEnum):
+    """The priority of a transaction: lower values are sent first."""
+
+    # Transactions including PDUs to destinations which are responding promptly.
+    ACTIVE = 0
+    # Other transactions to destinations which are responding promptly.
+    NORMAL = 1
+    # Transactions to destinations which have recently failed or been slow.
+    UNRESPONSIVE = 2
+
+
+in_flight_transactions = Gauge(
+    "synapse_federation_transaction_governor_in_flight",
+    "Number of federation transactions currently being sent",
+)
+
+transaction_queue_depth = Gauge(
+    "synapse_federation_transaction_governor_queue_depth",
+    "Number of federation transactions waiting to be sent, by priority",
+    ["priority"],
+)
+
+transaction_wait_time = Histogram(
+    "synapse_federation_transaction_governor_wait_seconds",
+    "Time federation transactions spent waiting to be sent, by priority",
+    ["priority"],
+)
+
+overrunning_transactions_counter = Counter(
+    "synapse_federation_transaction_governor_overruns",
+    "Number of federation transactions which were still in flight after "
+    "SLOW_TRANSACTION_SECONDS, and so gave up their slot",
+)
+
+# The share of the transaction slots which transactions to unresponsive
+# destinations can use, so that they can't take up all of them.
+UNRESPONSIVE_SHARE = 0.25
+
+# A destination whose transactions take longer than this on average is treated
+# as unresponsive, as is a transaction still in flight after this long.
+SLOW_TRANSACTION_SECONDS = 10.0
+
+# How much weight the most recent transaction duration gets in the average.
+DURATION_SMOOTHING = 0.3
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _InFlightTransaction:
+    priority: TransactionPriority
+    # Whether the transaction has been in flight for longer than
+    # `SLOW_TRANSACTION_SECONDS`, and so no longer holds a slot.
+    overrunning: bool = False
+
+
+class TransactionGovernor:
+    """Limits the number of federation transactions in flight across all
+    destinations.
+
+    When the limit is reached, transactions wait in a queue, and are sent in order
+    of priority (and then in the order they were queued): destinations which are
+    responding promptly go first, and transactions including PDUs go before
+    those only including EDUs. Destinations which have recently failed (according
+    to the retry timings kept by `synapse.util.retryutils`) or been slow can only
+    use a share of the slots.
+
+    A transaction still in flight after `SLOW_TRANSACTION_SECONDS` (e.g. because
+    it is being retried against a destination which has gone away) gives up its
+    slot, and is counted against the share of unresponsive destinations instead,
+    so that slow transactions can't hold up all the others.
+
+    Example:
+
+        async with governor.transaction(destination, has_pdus=True):
+            # send the transaction.
+            governor.note_duration(destination, duration)
+    """
+
+    def __init__(self, hs: "HomeServer", max_in_flight: Optional[int]):
+        self._clock = hs.get_clock()
+        self._store = hs.get_datastores().main
+        self._max_in_flight = max_in_flight
+        self._max_unresponsive_in_flight = (
+            max(1, int(max_in_flight * UNRESPONSIVE_SHARE))
+            if max_in_flight is not None
+            else None
+        )
+
+        # The number of transactions currently in flight, and how many of those
+        # are to unresponsive destinations.
+        self._in_flight = 0
+        self._unresponsive_in_flight = 0
+
+        # A heap of the waiting transactions, as (priority, sequence number,
+        # deferred to resolve when it can be sent).
+        self._queue: List[Tuple[int, int, "defer.Deferred[None]"]] = []
+        self._sequence = itertools.count()
+
+        # The average time recent transactions to each destination took, in
+        # seconds.
+        self._durations: LruCache[str, float] = LruCache(
+            max_size=10000, cache_name="federation_transaction_durations"
+        )
+
+    def transaction(
+        self, destination: str, has_pdus: bool
+    ) -> AsyncContextManager[None]:
+        @asynccontextmanager
+        async def _ctx_manager() -> AsyncIterator[None]:
+            priority = await self._get_priority(destination, has_pdus)
+            await self._acquire(priority)
+            in_flight_transactions.inc()
+
+            transaction = _InFlightTransaction(priority)
+            overrun_call: Optional[IDelayedCall] = None
+            if (
+                self._max_in_flight is not None
+                and priority != TransactionPriority.UNRESPONSIVE
+            ):
+                overrun_call = self._clock.call_later(
+                    SLOW_TRANSACTION_SECONDS, self._overrun, transaction
+                )
+
+            try:
+                yield
+            finally:
+                in_flight_transactions.dec()
+                if overrun_call is not None and overrun_call.active():
+                    overrun_call.cancel()
+
+                if transaction.overrunning:
+                    self._unresponsive_in_flight -= 1
+                    self._start_waiting()
+                else:
+                    self._release(priority)
+
+        return _ctx_manager()
+
+    def note_duration(self, destination: str, duration: float) -> None:
+        """Records how long a transaction to the destination took, including any
+        retries.
+        """
+        average = self._durations.get(destination)
+        if average is not None:
+            duration = (
+                DURATION_SMOOTHING * duration + (1 - DURATION_SMOOTHING) * average
+            )
+        self._durations.set(destination, duration)
+
+    async def _get_priority(
+        self, destination: str, has_pdus: bool
+    ) -> TransactionPriority:
+        if self._max_in_flight is None:
+            return TransactionPriority.NORMAL
+
+        retry_timings = await self._store.get_destination_retry_timings(destination)
+        average_duration = self._durations.get(destination)
+        if retry_timings is not None or (
+            average_duration is not None and average_duration > SLOW_TRANSACTION_SECONDS
+        ):
+            return TransactionPriority.UNRESPONSIVE
+
+        if has_pdus:
+            return TransactionPriority.ACTIVE
+        return TransactionPriority.NORMAL
+
+    def _can_start(self, priority: int) -> bool:
+        if self._max_in_flight is None:
+            return True
+        if self._in_flight >= self._max_in_flight:
+            return False
+        if priority == TransactionPriority.UNRESPONSIVE:
+            assert self._max_unresponsive_in_flight is not None
+            return self._unresponsive_in_flight < self._max_unresponsive_in_flight
+        return True
+
+    def _start(self, priority: int) -> None:
+        self._in_flight += 1
+        if priority == TransactionPriority.UNRESPONSIVE:
+            self._unresponsive_in_flight += 1
+
+    async def _acquire(self, priority: TransactionPriority) -> None:
+        """Waits until a transaction of the given priority can be sent."""
+        start = self._clock.time()
+        label = priority.name.lower()
+
+        if not self._queue and self._can_start(priority):
+            self._start(priority)
+            transaction_wait_time.labels(label).observe(0)
+            return
+
+        deferred: "defer.Deferred[None]" = defer.Deferred()
+        entry = (priority.value, next(self._sequence), deferred)
+        heapq.heappush(self._queue, entry)
+        transaction_queue_depth.labels(label).inc()
+
+        # We may be able to go ahead of a waiting transaction to an unresponsive
+        # destination.
+        self._start_waiting()
+
+        try:
+            await make_deferred_yieldable(deferred)
+        except CancelledError:
+            # We were cancelled while waiting: take ourselves back out of the queue.
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            raise
+        finally:
+            transaction_queue_depth.labels(label).dec()
+
+        # `_start_waiting` has counted us as in flight.
+        transaction_wait_time.labels(label).observe(self._clock.time() - start)
+
+        # If the transaction which freed up the slot completed synchronously, we
+        # would be run recursively, so fall back to the reactor first (as
+        # `Linearizer` does).
+        try:
+            await self._clock.sleep(0)
+        except CancelledError:
+            self._release(priority)
+            raise
+
+    def _overrun(self, transaction: _InFlightTransaction) -> None:
+        """Called when a transaction has been in flight for longer than
+        `SLOW_TRANSACTION_SECONDS`: frees up its slot for the waiting
+        transactions, and counts it as to an unresponsive destination instead.
+        """
+        overrunning_transactions_counter.inc()
+        transaction.overrunning = True
+        self._in_flight -= 1
+        self._unresponsive_in_flight += 1
+        self._start_waiting()
+
+    def _release(self, priority: int) -> None:
+        self._in_flight -= 1
+        if priority == TransactionPriority.UNRESPONSIVE:
+            self._unresponsive_in_flight -= 1
+
+        self._start_waiting()
+
+    def _start_waiting(self) -> None:
+        """Starts as many of the waiting transactions as there are slots for."""
+        while self._queue and self._can_start(self._queue[0][0]):
+            priority, _, deferred = heapq.heappop(self._queue)
+            self._start(priority)
+            with PreserveLoggingContext():
+                deferred.callback(None)
@@ -15,11 +15,24 @@
 # limitations under the License.
 import datetime
 import logging
+from enum import Enum
 from types import TracebackType
-from typing import TYPE_CHECKING, Dict, Hashable, Iterable, List, Optional, Tuple, Type
+from typing import (
+    TYPE_CHECKING,
+    Collection,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
 
 import attr
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from synapse.api.constants import EduTypes
 from synapse.api.errors import (
@@ -36,6 +49,7 @@ from synapse.logging.opentracing import SynapseTags, set_tag
 from synapse.metrics import sent_transactions_counter
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.types import JsonDict, ReadReceipt
+from synapse.util import Clock
 from synapse.util.retryutils import NotRetryingDestination, get_retry_limiter
 from synapse.visibility import filter_events_for_server
 
@@ -43,6 +57,7 @@ if TYPE_CHECKING:
     import synapse.server
 
 # This is defined in the Matrix spec and enforced by the receiver.
+MAX_PDUS_PER_TRANSACTION = 50
 MAX_EDUS_PER_TRANSACTION = 100
 
 logger = logging.getLogger(__name__)
@@ -58,11 +73,183 @@ sent_edus_by_type = Counter(
     ["type"],
 )
 
+queue_delay = Histogram(
+    "synapse_federation_client_queue_delay_seconds",
+    "How long each class of traffic had been waiting to be sent to a destination "
+    "when a transaction including it was sent",
+    ["traffic_class"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 600, 3600, "+Inf"),
+)
+
 
 # If the retry interval is larger than this then we enter "catchup" mode
 CATCHUP_RETRY_INTERVAL = 60 * 60 * 1000
 
 
+class TrafficClass(Enum):
+    """The classes of traffic which compete for space in transactions."""
+
+    PDUS = "pdus"
+    TYPING = "typing"
+    RECEIPTS = "receipts"
+    TO_DEVICE = "to_device"
+    DEVICE_LISTS = "device_lists"
+    PRESENCE = "presence"
+    # Any other EDUs.
+    OTHER = "other"
+
+
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class TrafficClassConfig:
+    # The relative share of the EDU slots of a transaction the class gets when
+    # other classes are also waiting to be sent.
+    weight: int
+    # How long the class can wait to be sent before it is prioritised.
+    latency_target_ms: int
+
+
+DEFAULT_TRAFFIC_CLASSES: Mapping[TrafficClass, TrafficClassConfig] = {
+    TrafficClass.PDUS: TrafficClassConfig(weight=1, latency_target_ms=1000),
+    TrafficClass.TYPING: TrafficClassConfig(weight=4, latency_target_ms=1000),
+    TrafficClass.RECEIPTS: TrafficClassConfig(weight=2, latency_target_ms=5000),
+    TrafficClass.TO_DEVICE: TrafficClassConfig(weight=4, latency_target_ms=2000),
+    TrafficClass.DEVICE_LISTS: TrafficClassConfig(weight=2, latency_target_ms=10000),
+    TrafficClass.PRESENCE: TrafficClassConfig(weight=1, latency_target_ms=10000),
+    TrafficClass.OTHER: TrafficClassConfig(weight=1, latency_target_ms=10000),
+}
+
+# The factor by which the weight of a class is multiplied once it has been
+# waiting longer than its latency target.
+OVERDUE_WEIGHT_MULTIPLIER = 4
+
+
+class TransactionScheduler:
+    """Decides how to share the EDU slots of each transaction to a destination
+    between the classes of traffic waiting to be sent to it, and reports how long
+    each class waits.
+
+    Each class gets a share of the slots by weight, with classes that have been
+    waiting longer than their latency target getting a larger share and being
+    served first. PDUs have their own limit per transaction, and are always sent
+    in order, so they are not shared out, but their queueing delay is reported.
+
+    Args:
+        clock
+        traffic_classes: the weight and latency target of each class of traffic.
+    """
+
+    def __init__(
+        self,
+        clock: Clock,
+        traffic_classes: Mapping[TrafficClass, TrafficClassConfig] = (
+            DEFAULT_TRAFFIC_CLASSES
+        ),
+    ):
+        self._clock = clock
+        self._traffic_classes = traffic_classes
+
+        # When each class of traffic last went from having nothing waiting to be
+        # sent to having something.
+        self._pending_since: Dict[TrafficClass, int] = {}
+
+    def note_pending(self, traffic_class: TrafficClass) -> None:
+        """Notes that there is something of the given class waiting to be sent."""
+        self._pending_since.setdefault(traffic_class, self._clock.time_msec())
+
+    def note_sent(self, traffic_class: TrafficClass, drained: bool) -> None:
+        """Notes that a transaction including the given class has been sent.
+
+        Args:
+            traffic_class
+            drained: whether there is nothing else of the class waiting to be sent.
+        """
+        if drained:
+            pending_since = self._pending_since.pop(traffic_class, None)
+        else:
+            pending_since = self._pending_since.get(traffic_class)
+
+        if pending_since is not None:
+            queue_delay.labels(traffic_class.value).observe(
+                (self._clock.time_msec() - pending_since) / 1000
+            )
+
+    def reset(self, traffic_classes: Iterable[TrafficClass]) -> None:
+        """Notes that everything of the given classes has been dropped."""
+        for traffic_class in traffic_classes:
+            self._pending_since.pop(traffic_class, None)
+
+    def _get_weight(self, traffic_class: TrafficClass, now: int) -> int:
+        config = self._traffic_classes[traffic_class]
+        pending_since = self._pending_since.get(traffic_class)
+        if pending_since is not None and now - pending_since > config.latency_target_ms:
+            return config.weight * OVERDUE_WEIGHT_MULTIPLIER
+        return config.weight
+
+    def get_priority_order(
+        self, traffic_classes: Collection[TrafficClass]
+    ) -> List[TrafficClass]:
+        """Orders the given classes by priority, highest first: those which are
+        furthest past their latency target, then by weight.
+        """
+        now = self._clock.time_msec()
+
+        def _get_sort_key(traffic_class: TrafficClass) -> Tuple[float, int]:
+            config = self._traffic_classes[traffic_class]
+            pending_since = self._pending_since.get(traffic_class)
+            overdue = 0.0
+            if pending_since is not None:
+                overdue = max(0.0, (now - pending_since) / config.latency_target_ms - 1)
+            return -overdue, -config.weight
+
+        return sorted(traffic_classes, key=_get_sort_key)
+
+    def allocate(
+        self, demand: Mapping[TrafficClass, Optional[int]], limit: int
+    ) -> Dict[TrafficClass, int]:
+        """Shares out the EDU slots of a transaction between the classes of
+        traffic.
+
+        Args:
+            demand: the number of EDUs waiting to be sent for each class, or None
+                if that is not known without fetching them.
+            limit: the number of slots to share out.
+
+        Returns:
+            The number of slots given to each class of `demand`. Classes get no
+            more slots than their demand.
+        """
+        now = self._clock.time_msec()
+        allocation = {traffic_class: 0 for traffic_class in demand}
+        weights = {
+            traffic_class: self._get_weight(traffic_class, now)
+            for traffic_class, wanted in demand.items()
+            if wanted is None or wanted > 0
+        }
+        order = self.get_priority_order(weights)
+
+        remaining = limit
+        while remaining > 0 and order:
+            # Give each class its share of what is left (but at least one slot),
+            # highest priority first, and then share out anything it didn't need.
+            total_weight = sum(weights[traffic_class] for traffic_class in order)
+            available = remaining
+            for traffic_class in list(order):
+                share = max(1, available * weights[traffic_class] // total_weight)
+                wanted = demand[traffic_class]
+                if wanted is not None:
+                    share = min(share, wanted - allocation[traffic_class])
+                share = min(share, remaining)
+
+                allocation[traffic_class] += share
+                remaining -= share
+                if wanted is not None and allocation[traffic_class] >= wanted:
+                    order.remove(traffic_class)
+                if not remaining:
+                    break
+
+        return allocation
+
+
 class PerDestinationQueue:
     """
     Manages the per-destination transmission queues.
@@ -70,6 +257,7 @@ class PerDestinationQueue:
     Args:
         hs
         transaction_sender
+        catch_up_coordinator
         destination: the server_name of the destination that we are managing
             transmission for.
     """
@@ -78,6 +266,7 @@ class PerDestinationQueue:
         self,
         hs: "synapse.server.HomeServer",
         transaction_manager: "synapse.federation.sender.TransactionManager",
+        catch_up_coordinator: "synapse.federation.sender.CatchUpCoordinator",
         destination: str,
     ):
         self._server_name = hs.hostname
@@ -85,6 +274,7 @@ class PerDestinationQueue:
         self._storage_controllers = hs.get_storage_controllers()
         self._store = hs.get_datastores().main
         self._transaction_manager = transaction_manager
+        self._catch_up_coordinator = catch_up_coordinator
         self._instance_name = hs.get_instance_name()
         self._federation_shard_config = hs.config.worker.federation_shard_config
         self._state = hs.get_state_handler()
@@ -154,6 +344,8 @@ class PerDestinationQueue:
         # stream_id of last successfully sent device list update.
         self._last_device_list_stream_id = 0
 
+        self._scheduler = TransactionScheduler(self._clock)
+
     def __str__(self) -> str:
         return "PerDestinationQueue[%s]" % self._destination
 
@@ -177,6 +369,7 @@ class PerDestinationQueue:
             # only enqueue the PDU if we are not catching up (False) or do not
             # yet know if we have anything to catch up (None)
             self._pending_pdus.append(pdu)
+            self._scheduler.note_pending(TrafficClass.PDUS)
         else:
             assert pdu.internal_metadata.stream_ordering
             self._catchup_last_skipped = pdu.internal_metadata.stream_ordering
@@ -197,6 +390,8 @@ class PerDestinationQueue:
             states: presence to send
         """
         self._pending_presence.update({state.user_id: state for state in states})
+        if self._pending_presence:
+            self._scheduler.note_pending(TrafficClass.PRESENCE)
         self._new_data_to_send = True
 
         if start_loop:
@@ -253,18 +448,32 @@ class PerDestinationQueue:
         for edu in self._pending_receipt_edus:
             if room_id in edu:
                 self._rrs_pending_flush = True
+                self._scheduler.note_pending(TrafficClass.RECEIPTS)
                 self.attempt_new_transaction()
                 # No use in checking remaining EDUs if the room was found.
                 break
 
     def send_keyed_edu(self, edu: Edu, key: Hashable) -> None:
         self._pending_edus_keyed[(edu.edu_type, key)] = edu
+        self._scheduler.note_pending(
+            TrafficClass.TYPING
+            if edu.edu_type == EduTypes.TYPING
+            else TrafficClass.OTHER
+        )
         self.attempt_new_transaction()
 
     def send_edu(self, edu: Edu) -> None:
         self._pending_edus.append(edu)
+        self._scheduler.note_pending(TrafficClass.OTHER)
         self.attempt_new_transaction()
 
+    def mark_device_messages_pending(self) -> None:
+        """Marks that there may be new to-device messages or device list updates
+        to send, without starting a new transaction.
+        """
+        self._scheduler.note_pending(TrafficClass.TO_DEVICE)
+        self._scheduler.note_pending(TrafficClass.DEVICE_LISTS)
+
     def mark_new_data(self) -> None:
         """Marks that the destination has new data to send, without starting a
         new transaction.
@@ -395,6 +604,14 @@ class PerDestinationQueue:
                 self._pending_edus_keyed = {}
                 self._pending_presence = {}
                 self._pending_receipt_edus = []
+                self._scheduler.reset(
+                    (
+                        TrafficClass.TYPING,
+                        TrafficClass.RECEIPTS,
+                        TrafficClass.PRESENCE,
+                        TrafficClass.OTHER,
+                    )
+                )
 
                 self._start_catching_up()
         except FederationDeniedError as e:
@@ -467,6 +684,7 @@ class PerDestinationQueue:
 
                 # we are done catching up!
                 self._catching_up = False
+                self._catch_up_coordinator.note_caught_up(self._destination)
                 break
 
             if first_catch_up_check:
@@ -475,12 +693,17 @@ class PerDestinationQueue:
                 # clear those out now.
                 self._start_catching_up()
 
-            # fetch the relevant events from the event store
+            self._catch_up_coordinator.note_progress(
+                self._destination, last_successful_stream_ordering
+            )
+
+            # fetch the relevant events from the event store (alongside those for
+            # any other destinations which are catching up)
             # - redacted behaviour of REDACT is fine, since we only send metadata
             #   of redacted events to the destination.
             # - don't need to worry about rejected events as we do not actively
             #   forward received events over federation.
-            catchup_pdus = await self._store.get_events_as_list(event_ids)
+            catchup_pdus = await self._catch_up_coordinator.get_events(event_ids)
             if not catchup_pdus:
                 raise AssertionError(
                     "No events retrieved when we asked for %r. "
@@ -513,25 +736,29 @@ class PerDestinationQueue:
                 # servers, but the remote will correctly deduplicate them and
                 # handle it only once.
 
-                # Step 1, fetch the current extremities
-                extrems = await self._store.get_prev_events_for_room(pdu.room_id)
+                # We pulled this from the DB, so it'll be non-null
+                assert pdu.internal_metadata.stream_ordering
+
+                # Step 1, fetch the current extremities. These are shared with any
+                # other destinations catching up on the room, but must include
+                # `pdu`.
+                extrems = await self._catch_up_coordinator.get_room_extremities(
+                    pdu.room_id, pdu.internal_metadata.stream_ordering
+                )
 
-                if pdu.event_id in extrems:
+                if pdu.event_id in extrems.event_ids:
                     # If the event is in the extremities, then great! We can just
                     # use that without having to do further checks.
                     room_catchup_pdus = [pdu]
-                elif await self._store.is_partial_state_room(pdu.room_id):
+                elif extrems.partial_state:
                     # We can't be sure which events the destination should
                     # see using only partial state. Avoid doing so, and just retry
                     # sending our the newest PDU the remote is missing from us.
                     room_catchup_pdus = [pdu]
                 else:
-                    # If not, fetch the extremities and figure out which we can
-                    # send.
-                    extrem_events = await self._store.get_events_as_list(extrems)
-
+                    # If not, figure out which of the extremities we can send.
                     new_pdus = []
-                    for p in extrem_events:
+                    for p in extrems.events:
                         # We pulled this from the DB, so it'll be non-null
                         assert p.internal_metadata.stream_ordering
 
@@ -579,9 +806,6 @@ class PerDestinationQueue:
 
                 sent_transactions_counter.inc()
 
-                # We pulled this from the DB, so it'll be non-null
-                assert pdu.internal_metadata.stream_ordering
-
                 # Note that we mark the last successful stream ordering as that
                 # from the *original* PDU, rather than the PDU(s) we actually
                 # send. This is because we use it to mark our position in the
@@ -592,6 +816,9 @@ class PerDestinationQueue:
                 await self._store.set_destination_last_successful_stream_ordering(
                     self._destination, last_successful_stream_ordering
                 )
+                self._catch_up_coordinator.note_progress(
+                    self._destination, last_successful_stream_ordering
+                )
 
     def _get_receipt_edus(self, force_flush: bool, limit: int) -> Iterable[Edu]:
         if not self._pending_receipt_edus:
@@ -620,6 +847,74 @@ class PerDestinationQueue:
         pending_edus, self._pending_edus = pending_edus[:limit], pending_edus[limit:]
         return pending_edus
 
+    def _count_keyed_edus(self, typing: bool) -> int:
+        """Counts the pending keyed EDUs which are (or are not) typing EDUs."""
+        return sum(
+            1
+            for edu_type, _ in self._pending_edus_keyed
+            if (edu_type == EduTypes.TYPING) == typing
+        )
+
+    def _pop_keyed_edus(self, typing: bool, limit: int) -> List[Edu]:
+        """Pops up to `limit` pending keyed EDUs which are (or are not) typing
+        EDUs.
+        """
+        keys = [
+            key
+            for key in self._pending_edus_keyed
+            if (key[0] == EduTypes.TYPING) == typing
+        ][:limit]
+        return [self._pending_edus_keyed.pop(key) for key in keys]
+
+    def _get_presence_edu(self) -> Edu:
+        edu = Edu(
+            origin=self._server_name,
+            destination=self._destination,
+            edu_type=EduTypes.PRESENCE,
+            content={
+                "push": [
+                    format_user_presence_state(presence, self._clock.time_msec())
+                    for presence in self._pending_presence.values()
+                ]
+            },
+        )
+        self._pending_presence = {}
+        return edu
+
+    def _pop_edus(self, traffic_class: TrafficClass, limit: int) -> List[Edu]:
+        """Pops up to `limit` of the pending EDUs of the given class, which must
+        be one of the classes queued in memory.
+        """
+        if limit <= 0:
+            return []
+        if traffic_class == TrafficClass.PRESENCE:
+            return [self._get_presence_edu()] if self._pending_presence else []
+        if traffic_class == TrafficClass.RECEIPTS:
+            return list(self._get_receipt_edus(force_flush=False, limit=limit))
+        if traffic_class == TrafficClass.TYPING:
+            return self._pop_keyed_edus(typing=True, limit=limit)
+        if traffic_class == TrafficClass.OTHER:
+            edus = self._pop_pending_edus(limit)
+            edus.extend(self._pop_keyed_edus(typing=False, limit=limit - len(edus)))
+            return edus
+        raise ValueError("Unexpected traffic class %s" % (traffic_class,))
+
+    def _has_pending(self, traffic_class: TrafficClass) -> bool:
+        """Whether there is anything of the given class, which must be one of the
+        classes queued in memory, waiting to be sent.
+        """
+        if traffic_class == TrafficClass.PDUS:
+            return bool(self._pending_pdus)
+        if traffic_class == TrafficClass.PRESENCE:
+            return bool(self._pending_presence)
+        if traffic_class == TrafficClass.RECEIPTS:
+            return self._rrs_pending_flush and bool(self._pending_receipt_edus)
+        if traffic_class == TrafficClass.TYPING:
+            return self._count_keyed_edus(typing=True) > 0
+        if traffic_class == TrafficClass.OTHER:
+            return bool(self._pending_edus) or self._count_keyed_edus(typing=False) > 0
+        raise ValueError("Unexpected traffic class %s" % (traffic_class,))
+
     async def _get_device_update_edus(self, limit: int) -> Tuple[List[Edu], int]:
         last_device_list = self._last_device_list_stream_id
 
@@ -641,8 +936,14 @@ class PerDestinationQueue:
 
         return edus, now_stream_id
 
-    async def _get_to_device_message_edus(self, limit: int) -> Tuple[List[Edu], int]:
-        last_device_stream_id = self._last_device_stream_id
+    async def _get_to_device_message_edus(
+        self, limit: int, from_stream_id: Optional[int] = None
+    ) -> Tuple[List[Edu], int]:
+        last_device_stream_id = (
+            from_stream_id
+            if from_stream_id is not None
+            else self._last_device_stream_id
+        )
         to_device_stream_id = self._store.get_to_device_stream_token()
         contents, stream_id = await self._store.get_new_device_msgs_for_remote(
             self._destination, last_device_stream_id, to_device_stream_id, limit
@@ -682,6 +983,7 @@ class PerDestinationQueue:
         """
         self._catching_up = True
         self._pending_pdus = []
+        self._scheduler.reset((TrafficClass.PDUS,))
 
 
 @attr.s(slots=True, auto_attribs=True)
@@ -696,99 +998,140 @@ class _TransactionQueueManager:
     _device_list_id: Optional[int] = None
     _last_stream_ordering: Optional[int] = None
     _pdus: List[EventBase] = attr.Factory(list)
+    # The classes of traffic included in the transaction.
+    _traffic_classes: Set[TrafficClass] = attr.Factory(set)
+    # The classes fetched from the database which may have more waiting to be
+    # sent.
+    _undrained_traffic_classes: Set[TrafficClass] = attr.Factory(set)
 
     async def __aenter__(self) -> Tuple[List[EventBase], List[Edu]]:
-        # First we calculate the EDUs we want to send, if any.
+        queue = self.queue
 
-        # There's a maximum number of EDUs that can be sent with a transaction,
-        # generally device updates and to-device messages get priority, but we
-        # want to ensure that there's room for some other EDUs as well.
+        # First we calculate the EDUs we want to send, if any.
         #
-        # This is done by:
+        # There's a maximum number of EDUs that can be sent with a transaction,
+        # which the scheduler shares out between the classes of EDUs waiting to be
+        # sent, so that e.g. a backlog of to-device messages doesn't hold up typing
+        # notifications.
         #
-        # * Add a presence EDU, if one exists.
-        # * Add up-to a small limit of read receipt EDUs.
-        # * Add to-device EDUs, but leave some space for device list updates.
-        # * Add device list updates EDUs.
-        # * If there's any remaining room, add other EDUs.
-        pending_edus = []
-
-        # Add presence EDU.
-        if self.queue._pending_presence:
-            pending_edus.append(
-                Edu(
-                    origin=self.queue._server_name,
-                    destination=self.queue._destination,
-                    edu_type=EduTypes.PRESENCE,
-                    content={
-                        "push": [
-                            format_user_presence_state(
-                                presence, self.queue._clock.time_msec()
-                            )
-                            for presence in self.queue._pending_presence.values()
-                        ]
-                    },
-                )
-            )
-            self.queue._pending_presence = {}
+        # We don't know how many to-device messages and device list updates are
+        # waiting without fetching them, so we fetch those first, and then give
+        # any slots they didn't need to the classes queued in memory.
+        typing_count = queue._count_keyed_edus(typing=True)
+        demand: Dict[TrafficClass, Optional[int]] = {
+            TrafficClass.PRESENCE: 1 if queue._pending_presence else 0,
+            TrafficClass.RECEIPTS: (
+                len(queue._pending_receipt_edus) if queue._rrs_pending_flush else 0
+            ),
+            TrafficClass.TYPING: typing_count,
+            TrafficClass.OTHER: (
+                len(queue._pending_edus) + len(queue._pending_edus_keyed) - typing_count
+            ),
+            TrafficClass.TO_DEVICE: None,
+            TrafficClass.DEVICE_LISTS: None,
+        }
+        allocation = queue._scheduler.allocate(demand, MAX_EDUS_PER_TRANSACTION)
 
-        # Add read receipt EDUs.
-        pending_edus.extend(self.queue._get_receipt_edus(force_flush=False, limit=5))
-        edu_limit = MAX_EDUS_PER_TRANSACTION - len(pending_edus)
+        pending_edus = []
 
-        # Next, prioritize to-device messages so that existing encryption channels
-        # work. We also keep a few slots spare (by reducing the limit) so that
-        # we can still trickle out some device list updates.
+        # Add to-device EDUs, so that existing encryption channels work.
         (
             to_device_edus,
             device_stream_id,
-        ) = await self.queue._get_to_device_message_edus(edu_limit - 10)
+        ) = await queue._get_to_device_message_edus(allocation[TrafficClass.TO_DEVICE])
 
         if to_device_edus:
             self._device_stream_id = device_stream_id
+            self._traffic_classes.add(TrafficClass.TO_DEVICE)
+            if len(to_device_edus) >= allocation[TrafficClass.TO_DEVICE]:
+                self._undrained_traffic_classes.add(TrafficClass.TO_DEVICE)
         else:
-            self.queue._last_device_stream_id = device_stream_id
-
-        pending_edus.extend(to_device_edus)
-        edu_limit -= len(to_device_edus)
-
-        # Add device list update EDUs.
-        device_update_edus, dev_list_id = await self.queue._get_device_update_edus(
-            edu_limit
+            queue._last_device_stream_id = device_stream_id
+            queue._scheduler.reset((TrafficClass.TO_DEVICE,))
+
+        # Add device list update EDUs, giving them any slots the to-device
+        # messages didn't need.
+        device_list_limit = (
+            allocation[TrafficClass.DEVICE_LISTS]
+            + allocation[TrafficClass.TO_DEVICE]
+            - len(to_device_edus)
+        )
+        device_update_edus, dev_list_id = await queue._get_device_update_edus(
+            device_list_limit
         )
 
         if device_update_edus:
             self._device_list_id = dev_list_id
+            self._traffic_classes.add(TrafficClass.DEVICE_LISTS)
+            if len(device_update_edus) >= device_list_limit:
+                self._undrained_traffic_classes.add(TrafficClass.DEVICE_LISTS)
         else:
-            self.queue._last_device_list_stream_id = dev_list_id
+            queue._last_device_list_stream_id = dev_list_id
+            queue._scheduler.reset((TrafficClass.DEVICE_LISTS,))
+
+        # Give any slots the device list updates didn't need back to the to-device
+        # messages, if there are more of them waiting.
+        spare_slots = device_list_limit - len(device_update_edus)
+        if TrafficClass.TO_DEVICE in self._undrained_traffic_classes and spare_slots:
+            assert self._device_stream_id is not None
+            (
+                more_to_device_edus,
+                device_stream_id,
+            ) = await queue._get_to_device_message_edus(
+                spare_slots, from_stream_id=self._device_stream_id
+            )
+            self._device_stream_id = device_stream_id
+            to_device_edus.extend(more_to_device_edus)
+            if len(more_to_device_edus) < spare_slots:
+                self._undrained_traffic_classes.discard(TrafficClass.TO_DEVICE)
 
+        pending_edus.extend(to_device_edus)
         pending_edus.extend(device_update_edus)
-        edu_limit -= len(device_update_edus)
 
-        # Finally add any other types of EDUs if there is room.
-        other_edus = self.queue._pop_pending_edus(edu_limit)
-        pending_edus.extend(other_edus)
-        edu_limit -= len(other_edus)
-        while edu_limit > 0 and self.queue._pending_edus_keyed:
-            _, val = self.queue._pending_edus_keyed.popitem()
-            pending_edus.append(val)
-            edu_limit -= 1
+        # Add the EDUs queued in memory, up to their share of the slots, and then
+        # share out any remaining slots in order of priority.
+        in_memory_traffic_classes = queue._scheduler.get_priority_order(
+            (
+                TrafficClass.PRESENCE,
+                TrafficClass.RECEIPTS,
+                TrafficClass.TYPING,
+                TrafficClass.OTHER,
+            )
+        )
+        for traffic_class in in_memory_traffic_classes:
+            edus = queue._pop_edus(traffic_class, allocation[traffic_class])
+            if edus:
+                self._traffic_classes.add(traffic_class)
+            pending_edus.extend(edus)
+
+        for traffic_class in in_memory_traffic_classes:
+            edus = queue._pop_edus(
+                traffic_class, MAX_EDUS_PER_TRANSACTION - len(pending_edus)
+            )
+            if edus:
+                self._traffic_classes.add(traffic_class)
+            pending_edus.extend(edus)
 
         # Now we look for any PDUs to send, by getting up to 50 PDUs from the
         # queue
-        self._pdus = self.queue._pending_pdus[:50]
+        self._pdus = queue._pending_pdus[:MAX_PDUS_PER_TRANSACTION]
 
         if not self._pdus and not pending_edus:
             return [], []
 
         # if we've decided to send a transaction anyway, and we have room, we
         # may as well send any pending RRs
+        edu_limit = MAX_EDUS_PER_TRANSACTION - len(pending_edus)
         if edu_limit:
-            pending_edus.extend(
-                self.queue._get_receipt_edus(force_flush=True, limit=edu_limit)
+            receipt_edus = list(
+                queue._get_receipt_edus(force_flush=True, limit=edu_limit)
             )
+            if receipt_edus:
+                self._traffic_classes.add(TrafficClass.RECEIPTS)
+            pending_edus.extend(receipt_edus)
 
         if self._pdus:
+            self._traffic_classes.add(TrafficClass.PDUS)
             self._last_stream_ordering = self._pdus[
                 -1
             ].internal_metadata.stream_ordering
@@ -835,3 +1178,10 @@ class _TransactionQueueManager:
             await self.queue._store.set_destination_last_successful_stream_ordering(
                 self.queue._destination, self._last_stream_ordering
             )
+
+        for traffic_class in self._traffic_classes:
+            if traffic_class in (TrafficClass.TO_DEVICE, TrafficClass.DEVICE_LISTS):
+                drained = traffic_class not in self._undrained_traffic_classes
+            else:
+                drained = not self.queue._has_pending(traffic_class)
+            self.queue._scheduler.note_sent(traffic_class, drained)
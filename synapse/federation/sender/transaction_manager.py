@@ -12,14 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
-from typing import TYPE_CHECKING, List
+from typing import TYPE_CHECKING, List, Tuple
 
-from prometheus_client import Gauge
+from canonicaljson import encode_canonical_json
+from prometheus_client import Counter, Gauge, Histogram
 
 from synapse.api.constants import EduTypes
 from synapse.api.errors import HttpResponseException
 from synapse.events import EventBase
 from synapse.federation.persistence import TransactionActions
+from synapse.federation.sender.governor import TransactionGovernor
 from synapse.federation.units import Edu, Transaction
 from synapse.logging.opentracing import (
     extract_text_map,
@@ -30,6 +32,7 @@ from synapse.logging.opentracing import (
 )
 from synapse.types import JsonDict
 from synapse.util import json_decoder
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.metrics import measure_func
 
 if TYPE_CHECKING:
@@ -44,6 +47,22 @@ last_pdu_ts_metric = Gauge(
     labelnames=("server_name",),
 )
 
+serialized_pdu_size = Histogram(
+    "synapse_federation_serialized_pdu_size_bytes",
+    "The size of each PDU serialized for sending to other servers",
+    buckets=(256, 1024, 4096, 16384, 65536, "+Inf"),
+)
+
+sent_pdu_bytes_counter = Counter(
+    "synapse_federation_transaction_pdu_bytes",
+    "Bytes of serialized PDUs included in outgoing transactions, counting each "
+    "destination a PDU is sent to",
+)
+
+# The number of serialized PDUs to keep, so that they can be reused by the
+# transactions to all the destinations in the room.
+ENCODED_PDU_CACHE_SIZE = 1000
+
 
 class TransactionManager:
     """Helper class which handles building and sending transactions
@@ -65,6 +84,55 @@ class TransactionManager:
         # HACK to get unique tx id
         self._next_txn_id = int(self.clock.time_msec())
 
+        self._governor = TransactionGovernor(
+            hs, hs.config.federation.max_concurrent_transactions
+        )
+
+        # The JSON of PDUs we are sending, and its canonical JSON encoding, keyed
+        # by event ID and whether the event is redacted.
+        self._encoded_pdus: LruCache[
+            Tuple[str, bool], Tuple[JsonDict, bytes]
+        ] = LruCache(
+            max_size=ENCODED_PDU_CACHE_SIZE, cache_name="federation_encoded_pdus"
+        )
+
+    def _get_encoded_pdu(self, pdu: EventBase) -> Tuple[JsonDict, bytes]:
+        """Returns the JSON of the PDU to send to other servers, and its canonical
+        JSON encoding.
+
+        These are shared between the transactions to all destinations, so must not
+        be modified.
+        """
+        key = (pdu.event_id, pdu.internal_metadata.is_redacted())
+        result = self._encoded_pdus.get(key)
+        if result is None:
+            pdu_json = pdu.get_pdu_json()
+            encoded_pdu = encode_canonical_json(pdu_json)
+            serialized_pdu_size.observe(len(encoded_pdu))
+
+            result = (pdu_json, encoded_pdu)
+            self._encoded_pdus.set(key, result)
+        return result
+
+    def _encode_transaction(
+        self, transaction: Transaction, encoded_pdus: List[bytes]
+    ) -> bytes:
+        """Returns the canonical JSON encoding of the transaction body, splicing in
+        the given encodings of its PDUs.
+        """
+        envelope = transaction.get_dict()
+        del envelope["pdus"]
+
+        # "pdus" sorts after all the other keys, so goes at the end.
+        return b"".join(
+            (
+                encode_canonical_json(envelope)[:-1],
+                b',"pdus":[',
+                b",".join(encoded_pdus),
+                b"]}",
+            )
+        )
+
     @measure_func("_send_new_transaction")
     async def send_new_transaction(
         self,
@@ -107,12 +175,19 @@ class TransactionManager:
                 len(edus),
             )
 
+            # The PDUs are only serialized once, however many destinations they
+            # are sent to.
+            encoded_pdus = [self._get_encoded_pdu(p) for p in pdus]
+            sent_pdu_bytes_counter.inc(
+                sum(len(encoded_pdu) for _, encoded_pdu in encoded_pdus)
+            )
+
             transaction = Transaction(
                 origin_server_ts=int(self.clock.time_msec()),
                 transaction_id=txn_id,
                 origin=self._server_name,
                 destination=destination,
-                pdus=[p.get_pdu_json() for p in pdus],
+                pdus=[pdu_json for pdu_json, _ in encoded_pdus],
                 edus=[edu.get_dict() for edu in edus],
             )
 
@@ -143,26 +218,38 @@ class TransactionManager:
 
             # Actually send the transaction
 
-            # FIXME (erikj): This is a bit of a hack to make the Pdu age
-            # keys work
-            # FIXME (richardv): I also believe it no longer works. We (now?) store
-            #  "age_ts" in "unsigned" rather than at the top level. See
-            #  https://github.com/matrix-org/synapse/issues/8429.
-            def json_data_cb() -> JsonDict:
-                data = transaction.get_dict()
+            def encoded_json_cb() -> bytes:
                 now = int(self.clock.time_msec())
-                if "pdus" in data:
-                    for p in data["pdus"]:
-                        if "age_ts" in p:
-                            unsigned = p.setdefault("unsigned", {})
-                            unsigned["age"] = now - int(p["age_ts"])
-                            del p["age_ts"]
-                return data
+                encoded = []
+                for pdu_json, encoded_pdu in encoded_pdus:
+                    # FIXME (erikj): This is a bit of a hack to make the Pdu age
+                    # keys work
+                    # FIXME (richardv): I also believe it no longer works. We (now?)
+                    #  store "age_ts" in "unsigned" rather than at the top level.
+                    #  See https://github.com/matrix-org/synapse/issues/8429.
+                    if "age_ts" in pdu_json:
+                        pdu_json = dict(pdu_json)
+                        unsigned = dict(pdu_json.get("unsigned", {}))
+                        unsigned["age"] = now - int(pdu_json.pop("age_ts"))
+                        pdu_json["unsigned"] = unsigned
+                        encoded_pdu = encode_canonical_json(pdu_json)
+                    encoded.append(encoded_pdu)
+                return self._encode_transaction(transaction, encoded)
+
+            def json_data_cb() -> JsonDict:
+                return json_decoder.decode(encoded_json_cb().decode("utf-8"))
 
             try:
-                response = await self._transport_layer.send_transaction(
-                    transaction, json_data_cb
-                )
+                async with self._governor.transaction(destination, has_pdus=bool(pdus)):
+                    start = self.clock.time()
+                    try:
+                        response = await self._transport_layer.send_transaction(
+                            transaction, json_data_cb, encoded_json_cb
+                        )
+                    finally:
+                        self._governor.note_duration(
+                            destination, self.clock.time() - start
+                        )
             except HttpResponseException as e:
                 code = e.code
 
@@ -209,11 +209,16 @@ class TransportLayerClient:
         self,
         transaction: Transaction,
         json_data_callback: Optional[Callable[[], JsonDict]] = None,
+        encoded_json_callback: Optional[Callable[[], bytes]] = None,
     ) -> JsonDict:
         """Sends the given Transaction to its destination
 
         Args:
             transaction
+            json_data_callback: A callable returning the body of the request.
+            encoded_json_callback: A callable returning the body of the request,
+                already encoded as canonical JSON. Takes precedence over
+                `json_data_callback`.
 
         Returns:
             Succeeds when we get a 2xx HTTP response. The result
@@ -238,7 +243,7 @@ class TransportLayerClient:
             raise RuntimeError("Transport layer cannot send to itself!")
 
         # FIXME: This is only used by the tests. The actual json sent is
-        # generated by the json_data_callback.
+        # generated by the json_data_callback or encoded_json_callback.
         json_data = transaction.get_dict()
 
         path = _create_v1_path("/send/%s", transaction.transaction_id)
@@ -248,6 +253,7 @@ class TransportLayerClient:
             path=path,
             data=json_data,
             json_data_callback=json_data_callback,
+            encoded_data_callback=encoded_json_callback,
             long_retries=True,
             try_trailing_slash_on_400=True,
             # Sending a transaction should always succeed, if it doesn't
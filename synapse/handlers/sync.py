@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import hashlib
 import itertools
 import logging
 from typing import (
@@ -28,10 +29,12 @@ from typing import (
 )
 
 import attr
-from prometheus_client import Counter
+from canonicaljson import encode_canonical_json
+from prometheus_client import Counter, Histogram
 
 from synapse.api.constants import (
     AccountDataTypes,
+    EduTypes,
     EventContentFields,
     EventTypes,
     Membership,
@@ -50,8 +53,10 @@ from synapse.logging.opentracing import (
     start_active_span,
     trace,
 )
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.databases.main.event_push_actions import RoomNotifCounts
 from synapse.storage.databases.main.roommember import extract_heroes_from_room_summary
+from synapse.storage.databases.main.sync_snapshots import RoomSyncSnapshot
 from synapse.storage.roommember import MemberSummary
 from synapse.types import (
     DeviceListUpdates,
@@ -91,6 +96,30 @@ non_empty_sync_counter = Counter(
     ["type", "lazy_loaded"],
 )
 
+# Counts the number of joined rooms in initial syncs that were (or were not) served
+# from a persisted sync snapshot. `result` is "hit" or "miss".
+sync_snapshot_rooms_counter = Counter(
+    "synapse_handlers_sync_snapshot_rooms_total",
+    "Count of joined rooms in initial syncs, by whether they were served from a "
+    "sync snapshot",
+    ["result"],
+)
+
+# The number of timeline events whose state was fetched in a single batch ahead of
+# computing the state deltas of the rooms in a sync.
+sync_state_prefetch_batch_size = Histogram(
+    "synapse_handlers_sync_state_prefetch_batch_size",
+    "Number of events whose state was prefetched in one batch for a sync",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+
+# Counts the number of rooms whose state lookups were served from a batched
+# prefetch rather than being made room by room.
+sync_state_prefetch_rooms_counter = Counter(
+    "synapse_handlers_sync_state_prefetch_rooms_total",
+    "Count of rooms whose state was prefetched in a batch for a sync",
+)
+
 # Store the cache that tracks which lazy-loaded members have been sent to a given
 # client for no more than 30 minutes.
 LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
@@ -103,6 +132,18 @@ LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
 SyncRequestKey = Tuple[Any, ...]
 
 
+@attr.s(slots=True, frozen=True, auto_attribs=True, repr=False)
+class _RoomIdsKey:
+    """Wraps a set of room IDs used as part of a sync work unit cache key, so that
+    logging the key doesn't print out every room a user is in.
+    """
+
+    room_ids: FrozenSet[str]
+
+    def __repr__(self) -> str:
+        return "<%d rooms>" % (len(self.room_ids),)
+
+
 @attr.s(slots=True, frozen=True, auto_attribs=True)
 class SyncConfig:
     user: UserID
@@ -284,6 +325,16 @@ class SyncHandler:
             timeout_ms=hs.config.caches.sync_response_cache_duration,
         )
 
+        # Caches the parts of a sync that don't depend on the request's filter,
+        # keyed on the stream positions they were computed between. This lets
+        # concurrent syncs for the same user (e.g. from several devices with
+        # different filters) share the expensive database work.
+        self._work_unit_cache: ResponseCache[Tuple[Any, ...]] = ResponseCache(
+            hs.get_clock(),
+            "sync_work_units",
+            timeout_ms=hs.config.caches.sync_work_unit_cache_duration,
+        )
+
         # ExpiringCache((User, Device)) -> LruCache(user_id => event_id)
         self.lazy_loaded_members_cache: ExpiringCache[
             Tuple[str, Optional[str]], LruCache[str, str]
@@ -296,6 +347,8 @@ class SyncHandler:
 
         self.rooms_to_exclude_globally = hs.config.server.rooms_to_exclude_from_sync
 
+        self._sync_snapshots_enabled = hs.config.caches.sync_snapshots_enabled
+
     async def wait_for_sync_for_user(
         self,
         requester: Requester,
@@ -389,6 +442,7 @@ class SyncHandler:
                 timeout,
                 current_sync_callback,
                 from_token=since_token,
+                stream_keys=_get_wake_up_stream_keys(sync_config.filter_collection),
             )
 
         # if nothing has happened in any of the users' rooms since /sync was called,
@@ -480,7 +534,17 @@ class SyncHandler:
             receipt_key = since_token.receipt_key if since_token else 0
 
             receipt_source = self.event_sources.sources.receipt
-            receipts, receipt_key = await receipt_source.get_new_events(
+            receipts, receipt_key = await self._work_unit_cache.wrap(
+                (
+                    "receipts",
+                    sync_config.user,
+                    receipt_key,
+                    now_token.receipt_key,
+                    sync_config.filter_collection.ephemeral_limit(),
+                    _RoomIdsKey(room_ids),
+                    sync_config.is_guest,
+                ),
+                receipt_source.get_new_events,
                 user=sync_config.user,
                 from_key=receipt_key,
                 limit=sync_config.filter_collection.ephemeral_limit(),
@@ -755,6 +819,30 @@ class SyncHandler:
                 at the last event in the room before `stream_position` and
                 `state_filter` is not satisfied by partial state. Defaults to `True`.
         """
+        state_filter = state_filter or StateFilter.all()
+        return await self._work_unit_cache.wrap(
+            (
+                "state_at",
+                room_id,
+                stream_position.room_key,
+                state_filter,
+                await_full_state,
+            ),
+            self._get_state_at,
+            room_id,
+            stream_position,
+            state_filter,
+            await_full_state,
+        )
+
+    async def _get_state_at(
+        self,
+        room_id: str,
+        stream_position: StreamToken,
+        state_filter: StateFilter,
+        await_full_state: bool,
+    ) -> StateMap[str]:
+        """The uncached implementation of `get_state_at`."""
         # FIXME: This gets the state at the latest event before the stream ordering,
         # which might not be the same as the "current state" of the room at the time
         # of the stream token if there were multiple forward extremities at the time.
@@ -766,7 +854,7 @@ class SyncHandler:
         if last_event_id:
             state = await self.get_state_after_event(
                 last_event_id,
-                state_filter=state_filter or StateFilter.all(),
+                state_filter=state_filter,
                 await_full_state=await_full_state,
             )
 
@@ -784,6 +872,37 @@ class SyncHandler:
             )
         return state
 
+    async def _get_state_ids_for_timeline_event(
+        self,
+        event_id: str,
+        state_filter: StateFilter,
+        await_full_state: bool,
+        prefetched_state: Optional[Mapping[str, StateMap[str]]],
+    ) -> StateMap[str]:
+        """Get the room state at an event in a sync's timeline, using the
+        prefetched state if there is any.
+
+        Args:
+            event_id: event of interest
+            state_filter: The state filter used to fetch state from the database.
+            await_full_state: if `True`, will block if we do not yet have complete
+                state at the event and `state_filter` is not satisfied by partial
+                state.
+            prefetched_state: The full state at some of the events in the
+                timeline, by event ID, if it has already been fetched.
+        """
+        if prefetched_state is not None and event_id in prefetched_state:
+            state_ids = prefetched_state[event_id]
+            if state_filter.is_full():
+                return state_ids
+            return state_filter.filter_state(state_ids)
+
+        return await self._state_storage_controller.get_state_ids_for_event(
+            event_id,
+            state_filter=state_filter,
+            await_full_state=await_full_state,
+        )
+
     async def compute_summary(
         self,
         room_id: str,
@@ -925,6 +1044,7 @@ class SyncHandler:
         since_token: Optional[StreamToken],
         now_token: StreamToken,
         full_state: bool,
+        prefetched_state: Optional[Mapping[str, StateMap[str]]] = None,
     ) -> MutableStateMap[EventBase]:
         """Works out the difference in state between the end of the previous sync and
         the start of the timeline.
@@ -937,6 +1057,8 @@ class SyncHandler:
             now_token: Token of the end of the current batch.
             full_state: Whether to force returning the full state.
                 `lazy_load_members` still applies when `full_state` is `True`.
+            prefetched_state: The full state at some of the events in `batch`, by
+                event ID, if it has already been fetched.
 
         Returns:
             The state to return in the sync response for the room.
@@ -1039,18 +1161,20 @@ class SyncHandler:
             if full_state:
                 if batch:
                     state_at_timeline_end = (
-                        await self._state_storage_controller.get_state_ids_for_event(
+                        await self._get_state_ids_for_timeline_event(
                             batch.events[-1].event_id,
                             state_filter=state_filter,
                             await_full_state=await_full_state,
+                            prefetched_state=prefetched_state,
                         )
                     )
 
                     state_at_timeline_start = (
-                        await self._state_storage_controller.get_state_ids_for_event(
+                        await self._get_state_ids_for_timeline_event(
                             batch.events[0].event_id,
                             state_filter=state_filter,
                             await_full_state=await_full_state,
+                            prefetched_state=prefetched_state,
                         )
                     )
 
@@ -1074,10 +1198,11 @@ class SyncHandler:
             elif batch.limited:
                 if batch:
                     state_at_timeline_start = (
-                        await self._state_storage_controller.get_state_ids_for_event(
+                        await self._get_state_ids_for_timeline_event(
                             batch.events[0].event_id,
                             state_filter=state_filter,
                             await_full_state=await_full_state,
+                            prefetched_state=prefetched_state,
                         )
                     )
                 else:
@@ -1117,10 +1242,11 @@ class SyncHandler:
 
                 if batch:
                     state_at_timeline_end = (
-                        await self._state_storage_controller.get_state_ids_for_event(
+                        await self._get_state_ids_for_timeline_event(
                             batch.events[-1].event_id,
                             state_filter=state_filter,
                             await_full_state=await_full_state,
+                            prefetched_state=prefetched_state,
                         )
                     )
                 else:
@@ -1398,7 +1524,14 @@ class SyncHandler:
         # call and the get_current_token call.
         membership_change_events = []
         if since_token:
-            membership_change_events = await self.store.get_membership_changes_for_user(
+            membership_change_events = await self._work_unit_cache.wrap(
+                (
+                    "membership_changes",
+                    user_id,
+                    since_token.room_key,
+                    now_token.room_key,
+                ),
+                self.store.get_membership_changes_for_user,
                 user_id,
                 since_token.room_key,
                 now_token.room_key,
@@ -1970,6 +2103,7 @@ class SyncHandler:
 
         # 3. Work out which rooms need reporting in the sync response.
         ignored_users = await self.store.ignored_users(user_id)
+        snapshot_filter_key = None
         if since_token:
             room_changes = await self._get_room_changes_for_incremental_sync(
                 sync_result_builder, ignored_users
@@ -1983,6 +2117,19 @@ class SyncHandler:
             )
             tags_by_room = await self.store.get_tags_for_user(user_id)
 
+            # Load the rooms we can serve from a previous initial sync.
+            if self._sync_snapshots_enabled:
+                snapshot_filter_key = _get_sync_snapshot_filter_key(
+                    sync_result_builder.sync_config.filter_collection
+                )
+                sync_result_builder.room_snapshots = (
+                    await self.store.get_sync_snapshots(
+                        user_id,
+                        snapshot_filter_key,
+                        sync_result_builder.now_token.room_key.stream,
+                    )
+                )
+
         log_kv({"rooms_changed": len(room_changes.room_entries)})
 
         room_entries = room_changes.room_entries
@@ -1992,7 +2139,15 @@ class SyncHandler:
         newly_left_rooms = room_changes.newly_left_rooms
 
         # 4. We need to apply further processing to `room_entries` (rooms considered
-        # joined or archived).
+        # joined or archived). We load the timelines of the rooms first, so that the
+        # state needed to compute their state deltas can be fetched in one batch
+        # rather than room by room.
+        with start_active_span("sync.load_room_timelines"):
+            batches = await self._load_room_timelines(sync_result_builder, room_entries)
+            prefetched_state = await self._prefetch_state_for_room_timelines(
+                sync_result_builder, room_entries, batches
+            )
+
         async def handle_room_entries(room_entry: "RoomSyncResultBuilder") -> None:
             logger.debug("Generating room entry for %s", room_entry.room_id)
             # Note that this mutates sync_result_builder.{joined,archived}.
@@ -2003,17 +2158,169 @@ class SyncHandler:
                 tags=tags_by_room.get(room_entry.room_id),
                 account_data=account_data_by_room.get(room_entry.room_id, {}),
                 always_include=sync_result_builder.full_state,
+                batch=batches.get(room_entry.room_id),
+                # Drop the room's prefetched state once it's been used, rather than
+                # holding on to the state of every room until the end of the sync.
+                prefetched_state=prefetched_state.pop(room_entry.room_id, None),
             )
             logger.debug("Generated room entry for %s", room_entry.room_id)
 
         with start_active_span("sync.generate_room_entries"):
             await concurrently_execute(handle_room_entries, room_entries, 10)
 
+        # 5. Persist the snapshots of any rooms we had to compute from scratch, so
+        # that the next initial sync can skip them. This doesn't need to block the
+        # response.
+        if snapshot_filter_key is not None and sync_result_builder.new_room_snapshots:
+            run_as_background_process(
+                "store_sync_snapshots",
+                self.store.store_sync_snapshots,
+                user_id,
+                snapshot_filter_key,
+                sync_result_builder.new_room_snapshots,
+                sync_result_builder.joined_room_ids,
+            )
+
         sync_result_builder.invited.extend(invited)
         sync_result_builder.knocked.extend(knocked)
 
         return set(newly_joined_rooms), set(newly_left_rooms)
 
+    async def _load_room_timelines(
+        self,
+        sync_result_builder: "SyncResultBuilder",
+        room_entries: List["RoomSyncResultBuilder"],
+    ) -> Dict[str, TimelineBatch]:
+        """Loads the timelines of the rooms which will need one in the sync response.
+
+        Rooms which may be served from a sync snapshot, and rooms without new events
+        which might be left out of the response, are skipped: their timelines are
+        loaded by `_generate_room_entry` if needed.
+
+        Args:
+            sync_result_builder
+            room_entries: The joined and archived rooms to report in the sync.
+
+        Returns:
+            A map from room ID to the room's timeline.
+        """
+        batches: Dict[str, TimelineBatch] = {}
+
+        async def load_room_timeline(room_builder: "RoomSyncResultBuilder") -> None:
+            full_state = (
+                room_builder.full_state
+                or room_builder.newly_joined
+                or sync_result_builder.full_state
+            )
+            if room_builder.events == [] and not full_state:
+                return
+
+            if (
+                sync_result_builder.room_snapshots is not None
+                and room_builder.room_id in sync_result_builder.room_snapshots
+            ):
+                return
+
+            batches[room_builder.room_id] = await self._load_filtered_recents(
+                room_builder.room_id,
+                sync_result_builder,
+                sync_result_builder.sync_config,
+                upto_token=room_builder.upto_token,
+                since_token=room_builder.since_token,
+                potential_recents=room_builder.events,
+                newly_joined_room=room_builder.newly_joined,
+            )
+
+        await concurrently_execute(load_room_timeline, room_entries, 10)
+        return batches
+
+    async def _prefetch_state_for_room_timelines(
+        self,
+        sync_result_builder: "SyncResultBuilder",
+        room_entries: List["RoomSyncResultBuilder"],
+        batches: Mapping[str, TimelineBatch],
+    ) -> Dict[str, Dict[str, StateMap[str]]]:
+        """Fetches, in one batch, the full state at the timeline boundaries that
+        `compute_state_delta` will look up for each room.
+
+        Lazy-loaded membership lookups are not prefetched, as their state filters
+        differ from room to room. Nor is the state of partial state rooms, as it
+        may change once their full state has been fetched.
+
+        Args:
+            sync_result_builder
+            room_entries: The joined and archived rooms to report in the sync.
+            batches: The already loaded timelines of the rooms, by room ID.
+
+        Returns:
+            A map from room ID to the full state at each of the prefetched events
+            in the room, by event ID. Rooms without prefetched state are omitted.
+        """
+        lazy_load_members = (
+            sync_result_builder.sync_config.filter_collection.lazy_load_members()
+        )
+
+        event_ids_by_room: Dict[str, List[str]] = {}
+        for room_builder in room_entries:
+            batch = batches.get(room_builder.room_id)
+            if not batch or room_builder.out_of_band:
+                continue
+
+            full_state = (
+                room_builder.full_state
+                or room_builder.newly_joined
+                or sync_result_builder.full_state
+            )
+            if lazy_load_members:
+                # Only the state at the end of a gappy timeline is fetched
+                # unfiltered when lazy-loading members.
+                if full_state or not batch.limited:
+                    continue
+                event_ids_by_room[room_builder.room_id] = [batch.events[-1].event_id]
+            else:
+                if not (full_state or batch.limited):
+                    continue
+                event_ids_by_room[room_builder.room_id] = [
+                    batch.events[0].event_id,
+                    batch.events[-1].event_id,
+                ]
+
+        # There's nothing to gain from batching the lookups of a single room.
+        if len(event_ids_by_room) < 2:
+            return {}
+
+        partial_state_rooms = await self.store.is_partial_state_room_batched(
+            list(event_ids_by_room)
+        )
+        event_ids_by_room = {
+            room_id: event_ids
+            for room_id, event_ids in event_ids_by_room.items()
+            if not partial_state_rooms[room_id]
+        }
+        if len(event_ids_by_room) < 2:
+            return {}
+
+        with Measure(self.clock, "prefetch_state_for_room_timelines"):
+            event_ids = {
+                event_id
+                for room_event_ids in event_ids_by_room.values()
+                for event_id in room_event_ids
+            }
+            sync_state_prefetch_batch_size.observe(len(event_ids))
+            sync_state_prefetch_rooms_counter.inc(len(event_ids_by_room))
+            log_kv({"prefetched_state_rooms": len(event_ids_by_room)})
+
+            state_by_event = (
+                await self._state_storage_controller.get_state_ids_for_events(
+                    event_ids, state_filter=StateFilter.all()
+                )
+            )
+
+        return {
+            room_id: {event_id: state_by_event[event_id] for event_id in event_ids}
+            for room_id, event_ids in event_ids_by_room.items()
+        }
+
     async def _have_rooms_changed(
         self, sync_result_builder: "SyncResultBuilder"
     ) -> bool:
@@ -2232,7 +2539,15 @@ class SyncHandler:
         # Get all events since the `from_key` in rooms we're currently joined to.
         # If there are too many, we get the most recent events only. This leaves
         # a "gap" in the timeline, as described by the spec for /sync.
-        room_to_events = await self.store.get_room_events_stream_for_rooms(
+        room_to_events = await self._work_unit_cache.wrap(
+            (
+                "room_events",
+                _RoomIdsKey(sync_result_builder.joined_room_ids),
+                since_token.room_key,
+                now_token.room_key,
+                timeline_limit,
+            ),
+            self.store.get_room_events_stream_for_rooms,
             room_ids=sync_result_builder.joined_room_ids,
             from_key=since_token.room_key,
             to_key=now_token.room_key,
@@ -2370,6 +2685,8 @@ class SyncHandler:
         tags: Optional[Mapping[str, JsonMapping]],
         account_data: Mapping[str, JsonMapping],
         always_include: bool = False,
+        batch: Optional[TimelineBatch] = None,
+        prefetched_state: Optional[Mapping[str, StateMap[str]]] = None,
     ) -> None:
         """Populates the `joined` and `archived` section of `sync_result_builder`
         based on the `room_builder`.
@@ -2400,6 +2717,9 @@ class SyncHandler:
             account_data: List of new account data for room
             always_include: Always include this room in the sync response,
                 even if empty.
+            batch: The room's timeline, if it has already been loaded.
+            prefetched_state: The full state at some of the events in the room's
+                timeline, by event ID, if it has already been fetched.
         """
         newly_joined = room_builder.newly_joined
         full_state = (
@@ -2430,15 +2750,32 @@ class SyncHandler:
                 }
             )
 
-            batch = await self._load_filtered_recents(
-                room_id,
-                sync_result_builder,
-                sync_config,
-                upto_token=upto_token,
-                since_token=since_token,
-                potential_recents=events,
-                newly_joined_room=newly_joined,
+            # Initial syncs can reuse the timeline and state of rooms which have
+            # not changed since a previous initial sync.
+            use_snapshots = (
+                sync_result_builder.room_snapshots is not None
+                and room_builder.rtype == "joined"
+                and since_token is None
             )
+            snapshot_entry = None
+            if use_snapshots:
+                snapshot_entry = await self._load_room_entry_from_snapshot(
+                    sync_result_builder, room_id
+                )
+            log_kv({"from_snapshot": snapshot_entry is not None})
+
+            if snapshot_entry is not None:
+                batch = snapshot_entry[0]
+            elif batch is None:
+                batch = await self._load_filtered_recents(
+                    room_id,
+                    sync_result_builder,
+                    sync_config,
+                    upto_token=upto_token,
+                    since_token=since_token,
+                    potential_recents=events,
+                    newly_joined_room=newly_joined,
+                )
             log_kv(
                 {
                     "batch_events": len(batch.events),
@@ -2494,7 +2831,11 @@ class SyncHandler:
             ):
                 return
 
-            if not room_builder.out_of_band:
+            summary: Optional[JsonDict] = {}
+
+            if snapshot_entry is not None:
+                _, state, summary = snapshot_entry
+            elif not room_builder.out_of_band:
                 state = await self.compute_state_delta(
                     room_id,
                     batch,
@@ -2502,18 +2843,18 @@ class SyncHandler:
                     since_token,
                     now_token,
                     full_state=full_state,
+                    prefetched_state=prefetched_state,
                 )
             else:
                 # An out of band room won't have any state changes.
                 state = {}
 
-            summary: Optional[JsonDict] = {}
-
             # we include a summary in room responses when we're lazy loading
             # members (as the client otherwise doesn't have enough info to form
             # the name itself).
             if (
-                not room_builder.out_of_band
+                snapshot_entry is None
+                and not room_builder.out_of_band
                 and sync_config.filter_collection.lazy_load_members()
                 and (
                     # we recalculate the summary:
@@ -2534,6 +2875,11 @@ class SyncHandler:
                     room_id, sync_config, batch, state, now_token
                 )
 
+            if use_snapshots and snapshot_entry is None:
+                await self._add_room_snapshot(
+                    sync_result_builder, room_id, batch, state, summary
+                )
+
             if room_builder.rtype == "joined":
                 unread_notifications: Dict[str, int] = {}
                 room_sync = JoinedSyncResult(
@@ -2599,6 +2945,152 @@ class SyncHandler:
             else:
                 raise Exception("Unrecognized rtype: %r", room_builder.rtype)
 
+    async def _load_room_entry_from_snapshot(
+        self, sync_result_builder: "SyncResultBuilder", room_id: str
+    ) -> Optional[Tuple[TimelineBatch, MutableStateMap[EventBase], Optional[JsonDict]]]:
+        """Rebuild the timeline, state and summary of a joined room in an initial
+        sync from a snapshot taken by a previous initial sync.
+
+        Returns:
+            The timeline batch, state and summary of the room, or None if there is
+            no usable snapshot for the room.
+        """
+        assert sync_result_builder.room_snapshots is not None
+        sync_config = sync_result_builder.sync_config
+        user_id = sync_config.user.to_string()
+
+        snapshot = sync_result_builder.room_snapshots.get(room_id)
+        if snapshot is None or await self.store.is_partial_state_room(room_id):
+            sync_snapshot_rooms_counter.labels("miss").inc()
+            return None
+
+        recents = await self.store.get_events_as_list(snapshot.timeline_event_ids)
+        state_events = await self.store.get_events(snapshot.state_event_ids)
+        if len(recents) != len(snapshot.timeline_event_ids) or len(state_events) != len(
+            snapshot.state_event_ids
+        ):
+            # Some of the events have since been purged.
+            sync_snapshot_rooms_counter.labels("miss").inc()
+            return None
+
+        # Nothing has happened in the room since the snapshot, but the visibility
+        # of events to the user can still change (e.g. if they ignored someone), so
+        # we check again and fall back to recomputing the room if it did.
+        current_state_ids: FrozenSet[str] = frozenset()
+        if any(e.is_state() for e in recents):
+            current_state_ids_map = await self.store.get_partial_current_state_ids(
+                room_id
+            )
+            current_state_ids = frozenset(current_state_ids_map.values())
+        filtered_recents = await filter_events_for_client(
+            self._storage_controllers,
+            user_id,
+            recents,
+            always_include_ids=current_state_ids,
+        )
+        if len(filtered_recents) != len(recents):
+            sync_snapshot_rooms_counter.labels("miss").inc()
+            return None
+
+        sync_snapshot_rooms_counter.labels("hit").inc()
+
+        bundled_aggregations = None
+        if snapshot.limited:
+            bundled_aggregations = (
+                await self._relations_handler.get_bundled_aggregations(
+                    filtered_recents, user_id
+                )
+            )
+
+        prev_batch = sync_result_builder.now_token.copy_and_replace(
+            StreamKeyType.ROOM,
+            await RoomStreamToken.parse(self.store, snapshot.prev_batch),
+        )
+        batch = TimelineBatch(
+            events=filtered_recents,
+            prev_batch=prev_batch,
+            limited=snapshot.limited,
+            bundled_aggregations=bundled_aggregations,
+        )
+
+        state: MutableStateMap[EventBase] = {
+            (e.type, e.state_key): e for e in state_events.values()
+        }
+
+        # Keep the lazy-loaded members cache in step with what
+        # `compute_state_delta` would have done for this room.
+        if (
+            sync_config.filter_collection.lazy_load_members()
+            and not sync_config.filter_collection.include_redundant_members()
+        ):
+            cache_key = (user_id, sync_config.device_id)
+            cache = self.get_lazy_loaded_members_cache(cache_key)
+            cache.clear()
+            for event in itertools.chain(state.values(), filtered_recents):
+                if event.is_state() and event.type == EventTypes.Member:
+                    cache.set(event.state_key, event.event_id)
+
+        return batch, state, snapshot.summary
+
+    async def _add_room_snapshot(
+        self,
+        sync_result_builder: "SyncResultBuilder",
+        room_id: str,
+        batch: TimelineBatch,
+        state: StateMap[EventBase],
+        summary: Optional[JsonDict],
+    ) -> None:
+        """Record a snapshot of a joined room computed during an initial sync, to
+        be persisted once the sync completes.
+        """
+        # The state of partial state rooms will change without any new events
+        # turning up, so we can't safely reuse it.
+        if await self.store.is_partial_state_room(room_id):
+            return
+
+        sync_result_builder.new_room_snapshots.append(
+            RoomSyncSnapshot(
+                room_id=room_id,
+                stream_ordering=sync_result_builder.now_token.room_key.stream,
+                timeline_event_ids=[e.event_id for e in batch.events],
+                prev_batch=await batch.prev_batch.room_key.to_string(self.store),
+                limited=batch.limited,
+                state_event_ids=[e.event_id for e in state.values()],
+                summary=summary,
+            )
+        )
+
+
+def _get_wake_up_stream_keys(
+    filter_collection: FilterCollection,
+) -> Optional[FrozenSet[StreamKeyType]]:
+    """Works out which streams can add anything to an incremental sync with the
+    given filter, so that a waiting sync isn't woken up by updates to the others.
+
+    Returns:
+        The streams to wake up for, or None if the sync is interested in all of
+        them.
+    """
+    ignored_stream_keys = set()
+    if filter_collection.blocks_all_presence():
+        ignored_stream_keys.add(StreamKeyType.PRESENCE)
+    if filter_collection.blocks_room_ephemeral_type(EduTypes.TYPING):
+        ignored_stream_keys.add(StreamKeyType.TYPING)
+    if filter_collection.blocks_room_ephemeral_type(EduTypes.RECEIPT):
+        ignored_stream_keys.add(StreamKeyType.RECEIPT)
+
+    if not ignored_stream_keys:
+        return None
+
+    return frozenset(StreamKeyType) - ignored_stream_keys
+
+
+def _get_sync_snapshot_filter_key(filter_collection: FilterCollection) -> str:
+    """Get the key identifying the filter that sync snapshots were computed with."""
+    return hashlib.sha256(
+        encode_canonical_json(filter_collection.get_filter_json())
+    ).hexdigest()
+
 
 def _action_has_highlight(actions: List[JsonDict]) -> bool:
     for action in actions:
@@ -2686,6 +3178,9 @@ class SyncResultBuilder:
             (This is useful if the room was previously excluded from a /sync response,
             and now the client should be made aware of it.)
             Only used by incremental syncs.
+        room_snapshots: The still-valid room snapshots to serve an initial sync
+            from, or None if sync snapshots are not in use for this sync.
+        new_room_snapshots: The room snapshots computed during this sync.
 
         # The following mirror the fields in a sync response
         presence
@@ -2706,6 +3201,9 @@ class SyncResultBuilder:
     forced_newly_joined_room_ids: FrozenSet[str]
     membership_change_events: List[EventBase]
 
+    room_snapshots: Optional[Dict[str, RoomSyncSnapshot]] = None
+    new_room_snapshots: List[RoomSyncSnapshot] = attr.Factory(list)
+
     presence: List[UserPresenceState] = attr.Factory(list)
     account_data: List[JsonDict] = attr.Factory(list)
     joined: List[JoinedSyncResult] = attr.Factory(list)
@@ -43,6 +43,7 @@ from canonicaljson import encode_canonical_json
 from prometheus_client import Counter
 from signedjson.sign import sign_json
 from typing_extensions import Literal
+from unpaddedbase64 import encode_base64
 
 from twisted.internet import defer
 from twisted.internet.error import DNSLookupError
@@ -149,6 +150,11 @@ class MatrixFederationRequest:
     """A callback to generate the JSON.
     """
 
+    encoded_json_callback: Optional[Callable[[], bytes]] = None
+    """A callback to generate the body, already encoded as canonical JSON. Takes
+    precedence over `json` and `json_callback`.
+    """
+
     query: Optional[QueryParams] = None
     """Query arguments.
     """
@@ -190,6 +196,15 @@ class MatrixFederationRequest:
             return self.json_callback()
         return self.json
 
+    def get_encoded_json(self) -> Optional[bytes]:
+        """Returns the body encoded as canonical JSON, or None if there is no body."""
+        if self.encoded_json_callback:
+            return self.encoded_json_callback()
+        json = self.get_json()
+        if json:
+            return encode_canonical_json(json)
+        return None
+
 
 class _BaseJsonParser(ByteParser[T]):
     """A parser that buffers the response and tries to parse it as JSON."""
@@ -638,13 +653,15 @@ class MatrixFederationHttpClient:
 
             while True:
                 try:
-                    json = request.get_json()
-                    if json:
+                    data = request.get_encoded_json()
+                    if data is not None:
                         headers_dict[b"Content-Type"] = [b"application/json"]
                         auth_headers = self.build_auth_headers(
-                            destination_bytes, method_bytes, url_to_sign_bytes, json
+                            destination_bytes,
+                            method_bytes,
+                            url_to_sign_bytes,
+                            encoded_content=data,
                         )
-                        data = encode_canonical_json(json)
                         producer: Optional[IBodyProducer] = QuieterFileBodyProducer(
                             BytesIO(data), cooperator=self._cooperator
                         )
@@ -823,6 +840,7 @@ class MatrixFederationHttpClient:
         url_bytes: bytes,
         content: Optional[JsonDict] = None,
         destination_is: Optional[bytes] = None,
+        encoded_content: Optional[bytes] = None,
     ) -> List[bytes]:
         """
         Builds the Authorization headers for a federation request
@@ -835,6 +853,8 @@ class MatrixFederationHttpClient:
             content: The body of the request
             destination_is: As 'destination', but if the destination is an
                 identity server
+            encoded_content: The body of the request, already encoded as
+                canonical JSON. Used instead of `content`.
 
         Returns:
             A list of headers to be added as "Authorization:" headers
@@ -857,14 +877,32 @@ class MatrixFederationHttpClient:
         if destination_is is not None:
             request["destination_is"] = destination_is.decode("ascii")
 
-        if content is not None:
-            request["content"] = content
+        if encoded_content is not None:
+            # "content" sorts before all the other keys of the request, so we can
+            # sign the canonical JSON of the request without re-encoding the body
+            # by splicing it in at the start.
+            message_bytes = b"".join(
+                (
+                    b'{"content":',
+                    encoded_content,
+                    b",",
+                    encode_canonical_json(request)[1:],
+                )
+            )
+            key_id = "%s:%s" % (self.signing_key.alg, self.signing_key.version)
+            signatures = {
+                key_id: encode_base64(self.signing_key.sign(message_bytes).signature)
+            }
+        else:
+            if content is not None:
+                request["content"] = content
 
-        request = sign_json(request, self.server_name, self.signing_key)
+            request = sign_json(request, self.server_name, self.signing_key)
+            signatures = request["signatures"][self.server_name]
 
         auth_headers = []
 
-        for key, sig in request["signatures"][self.server_name].items():
+        for key, sig in signatures.items():
             auth_headers.append(
                 (
                     'X-Matrix origin="%s",key="%s",sig="%s",destination="%s"'
@@ -886,6 +924,7 @@ class MatrixFederationHttpClient:
         args: Optional[QueryParams] = None,
         data: Optional[JsonDict] = None,
         json_data_callback: Optional[Callable[[], JsonDict]] = None,
+        encoded_data_callback: Optional[Callable[[], bytes]] = None,
         long_retries: bool = False,
         timeout: Optional[int] = None,
         ignore_backoff: bool = False,
@@ -904,6 +943,7 @@ class MatrixFederationHttpClient:
         args: Optional[QueryParams] = None,
         data: Optional[JsonDict] = None,
         json_data_callback: Optional[Callable[[], JsonDict]] = None,
+        encoded_data_callback: Optional[Callable[[], bytes]] = None,
         long_retries: bool = False,
         timeout: Optional[int] = None,
         ignore_backoff: bool = False,
@@ -921,6 +961,7 @@ class MatrixFederationHttpClient:
         args: Optional[QueryParams] = None,
         data: Optional[JsonDict] = None,
         json_data_callback: Optional[Callable[[], JsonDict]] = None,
+        encoded_data_callback: Optional[Callable[[], bytes]] = None,
         long_retries: bool = False,
         timeout: Optional[int] = None,
         ignore_backoff: bool = False,
@@ -939,6 +980,9 @@ class MatrixFederationHttpClient:
                 the request body. This will be encoded as JSON.
             json_data_callback: A callable returning the dict to
                 use as the request body.
+            encoded_data_callback: A callable returning the request body,
+                already encoded as canonical JSON. Takes precedence over `data`
+                and `json_data_callback`.
 
             long_retries: whether to use the long retry algorithm. See
                 docs on _send_request for details.
@@ -985,6 +1029,7 @@ class MatrixFederationHttpClient:
             path=path,
             query=args,
             json_callback=json_data_callback,
+            encoded_json_callback=encoded_data_callback,
             json=data,
         )
 
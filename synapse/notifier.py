@@ -13,12 +13,15 @@
 # limitations under the License.
 
 import logging
+import random
 from typing import (
     TYPE_CHECKING,
+    AbstractSet,
     Awaitable,
     Callable,
     Collection,
     Dict,
+    FrozenSet,
     Iterable,
     List,
     Optional,
@@ -29,7 +32,7 @@ from typing import (
 )
 
 import attr
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -52,6 +55,7 @@ from synapse.types import (
     UserID,
 )
 from synapse.util.async_helpers import ObservableDeferred, timeout_deferred
+from synapse.util.iterutils import batch_iter
 from synapse.util.metrics import Measure
 from synapse.visibility import filter_events_for_client
 
@@ -66,6 +70,35 @@ users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"]
 )
 
+# Counts the listeners which were not woken up by an update to a user's streams,
+# because they only asked to be woken up for changes to other streams.
+listener_wakeups_skipped_counter = Counter(
+    "synapse_notifier_listener_wakeups_skipped",
+    "Number of times a listener was not woken up for a stream it isn't interested in",
+    ["stream"],
+)
+
+# Counts the listeners which were woken up, but found nothing new to return.
+spurious_wakeups_counter = Counter(
+    "synapse_notifier_spurious_wakeups",
+    "Number of times a listener was woken up but had nothing new to return",
+)
+
+# The number of updates whose wakeups were coalesced into a single batch, when
+# `notifier_coalescing` is enabled.
+coalesced_wakeups_batch_size = Histogram(
+    "synapse_notifier_coalesced_wakeups_batch_size",
+    "Number of updates whose wakeups were coalesced into one batch",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+
+# The delay added to the wakeups of listeners by coalescing (and jittering) them.
+coalesced_wakeups_delay = Histogram(
+    "synapse_notifier_coalesced_wakeups_delay_seconds",
+    "Time between the first coalesced update and the listeners being woken up",
+    buckets=(0.001, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
 T = TypeVar("T")
 
 
@@ -120,9 +153,11 @@ class _NotifierUserStream:
         self.last_notified_token = current_token
         self.last_notified_ms = time_now_ms
 
-        self.notify_deferred: ObservableDeferred[StreamToken] = ObservableDeferred(
-            defer.Deferred()
-        )
+        # The deferreds the listeners of this user are waiting on, keyed by the
+        # streams the listeners want to be woken up for (or None for all streams).
+        self.notify_deferreds: Dict[
+            Optional[FrozenSet[StreamKeyType]], ObservableDeferred[StreamToken]
+        ] = {}
 
     def notify(
         self,
@@ -132,6 +167,23 @@ class _NotifierUserStream:
     ) -> None:
         """Notify any listeners for this user of a new event from an
         event source.
+        Args:
+            stream_key: The stream the event came from.
+            stream_id: The new id for the stream the event came from.
+            time_now_ms: The current time in milliseconds.
+        """
+        self.advance(stream_key, stream_id, time_now_ms)
+        self.wake_listeners({stream_key})
+
+    def advance(
+        self,
+        stream_key: StreamKeyType,
+        stream_id: Union[int, RoomStreamToken],
+        time_now_ms: int,
+    ) -> None:
+        """Advance the token of this user for a new event from an event source,
+        without waking up the listeners.
+
         Args:
             stream_key: The stream the event came from.
             stream_id: The new id for the stream the event came from.
@@ -140,7 +192,6 @@ class _NotifierUserStream:
         self.current_token = self.current_token.copy_and_advance(stream_key, stream_id)
         self.last_notified_token = self.current_token
         self.last_notified_ms = time_now_ms
-        notify_deferred = self.notify_deferred
 
         log_kv(
             {
@@ -153,9 +204,28 @@ class _NotifierUserStream:
 
         users_woken_by_stream_counter.labels(stream_key).inc()
 
+    def wake_listeners(self, stream_keys: AbstractSet[StreamKeyType]) -> None:
+        """Wake up the listeners for this user which are interested in updates to
+        any of the given streams, with the current token.
+
+        The other listeners will pick up the new token when they are next woken
+        up.
+        """
+        notify_deferreds = []
+        for listener_keys, notify_deferred in list(self.notify_deferreds.items()):
+            if listener_keys is not None and listener_keys.isdisjoint(stream_keys):
+                for stream_key in stream_keys:
+                    listener_wakeups_skipped_counter.labels(stream_key).inc(
+                        len(notify_deferred.observers())
+                    )
+                continue
+
+            del self.notify_deferreds[listener_keys]
+            notify_deferreds.append(notify_deferred)
+
         with PreserveLoggingContext():
-            self.notify_deferred = ObservableDeferred(defer.Deferred())
-            notify_deferred.callback(self.current_token)
+            for notify_deferred in notify_deferreds:
+                notify_deferred.callback(self.current_token)
 
     def remove(self, notifier: "Notifier") -> None:
         """Remove this listener from all the indexes in the Notifier
@@ -169,22 +239,44 @@ class _NotifierUserStream:
         notifier.user_to_user_stream.pop(self.user_id)
 
     def count_listeners(self) -> int:
-        return len(self.notify_deferred.observers())
+        return sum(
+            len(notify_deferred.observers())
+            for notify_deferred in self.notify_deferreds.values()
+        )
 
-    def new_listener(self, token: StreamToken) -> _NotificationListener:
+    def new_listener(
+        self,
+        token: StreamToken,
+        stream_keys: Optional[FrozenSet[StreamKeyType]] = None,
+    ) -> _NotificationListener:
         """Returns a deferred that is resolved when there is a new token
         greater than the given token.
 
         Args:
             token: The token from which we are streaming from, i.e. we shouldn't
                 notify for things that happened before this.
+            stream_keys: The streams to wake up the listener for. Defaults to all
+                streams.
         """
         # Immediately wake up stream if something has already since happened
         # since their last token.
-        if self.last_notified_token != token:
-            return _NotificationListener(defer.succeed(self.current_token))
+        if stream_keys is None:
+            has_changed = self.last_notified_token != token
         else:
-            return _NotificationListener(self.notify_deferred.observe())
+            has_changed = any(
+                self.last_notified_token.get_field(stream_key)
+                != token.get_field(stream_key)
+                for stream_key in stream_keys
+            )
+
+        if has_changed:
+            return _NotificationListener(defer.succeed(self.current_token))
+
+        notify_deferred = self.notify_deferreds.get(stream_keys)
+        if notify_deferred is None:
+            notify_deferred = ObservableDeferred(defer.Deferred())
+            self.notify_deferreds[stream_keys] = notify_deferred
+        return _NotificationListener(notify_deferred.observe())
 
 
 @attr.s(slots=True, frozen=True, auto_attribs=True)
@@ -247,6 +339,20 @@ class Notifier:
 
         self.state_handler = hs.get_state_handler()
 
+        self._coalesce_window_ms = hs.config.server.notifier_coalesce_window_ms
+        self._fanout_jitter_ms = hs.config.server.notifier_fanout_jitter_ms
+        self._fanout_jitter_threshold = (
+            hs.config.server.notifier_fanout_jitter_threshold
+        )
+
+        # When coalescing wakeups, the user streams whose listeners are waiting
+        # to be woken up, with the streams which have been updated for each.
+        self._pending_wakeups: Dict[_NotifierUserStream, Set[StreamKeyType]] = {}
+        # The time the first of the pending wakeups was queued at, and the number
+        # of updates which have been coalesced into them.
+        self._pending_wakeups_since_ms: Optional[int] = None
+        self._pending_wakeups_updates = 0
+
         self.clock.looping_call(
             self.remove_expired_streams, self.UNUSED_STREAM_EXPIRY_MS
         )
@@ -499,11 +605,14 @@ class Notifier:
                 )
 
             time_now_ms = self.clock.time_msec()
-            for user_stream in user_streams:
-                try:
-                    user_stream.notify(stream_key, new_token, time_now_ms)
-                except Exception:
-                    logger.exception("Failed to notify listener")
+            if self._coalesce_window_ms:
+                self._queue_wakeups(user_streams, stream_key, new_token, time_now_ms)
+            else:
+                for user_stream in user_streams:
+                    try:
+                        user_stream.notify(stream_key, new_token, time_now_ms)
+                    except Exception:
+                        logger.exception("Failed to notify listener")
 
             self.notify_replication()
 
@@ -519,6 +628,85 @@ class Notifier:
                     "Error notifying application services of ephemeral events"
                 )
 
+    def _queue_wakeups(
+        self,
+        user_streams: Iterable[_NotifierUserStream],
+        stream_key: StreamKeyType,
+        new_token: Union[int, RoomStreamToken],
+        time_now_ms: int,
+    ) -> None:
+        """Advance the tokens of the given user streams, and queue up waking up
+        their listeners until the end of the coalescing window.
+        """
+        queued = False
+        for user_stream in user_streams:
+            try:
+                user_stream.advance(stream_key, new_token, time_now_ms)
+            except Exception:
+                logger.exception("Failed to notify listener")
+                continue
+
+            self._pending_wakeups.setdefault(user_stream, set()).add(stream_key)
+            queued = True
+
+        if not queued:
+            return
+
+        self._pending_wakeups_updates += 1
+        if self._pending_wakeups_since_ms is None:
+            self._pending_wakeups_since_ms = time_now_ms
+            self.clock.call_later(
+                self._coalesce_window_ms / 1000, self._flush_pending_wakeups
+            )
+
+    def _flush_pending_wakeups(self) -> None:
+        """Wake up the listeners of the user streams updated during the last
+        coalescing window.
+
+        If there are a lot of them, the wakeups are spread out over the fan-out
+        jitter period, so that the woken requests don't all hit the database at
+        once.
+        """
+        pending_wakeups = list(self._pending_wakeups.items())
+        since_ms = self._pending_wakeups_since_ms
+        assert since_ms is not None
+
+        coalesced_wakeups_batch_size.observe(self._pending_wakeups_updates)
+
+        self._pending_wakeups = {}
+        self._pending_wakeups_since_ms = None
+        self._pending_wakeups_updates = 0
+
+        if (
+            not self._fanout_jitter_ms
+            or len(pending_wakeups) <= self._fanout_jitter_threshold
+        ):
+            self._wake_user_streams(pending_wakeups, since_ms)
+            return
+
+        batches = batch_iter(pending_wakeups, self._fanout_jitter_threshold)
+        self._wake_user_streams(next(batches), since_ms)
+        for batch in batches:
+            self.clock.call_later(
+                random.uniform(0, self._fanout_jitter_ms) / 1000,
+                self._wake_user_streams,
+                batch,
+                since_ms,
+            )
+
+    def _wake_user_streams(
+        self,
+        wakeups: Iterable[Tuple[_NotifierUserStream, Set[StreamKeyType]]],
+        since_ms: int,
+    ) -> None:
+        coalesced_wakeups_delay.observe((self.clock.time_msec() - since_ms) / 1000)
+
+        for user_stream, stream_keys in wakeups:
+            try:
+                user_stream.wake_listeners(stream_keys)
+            except Exception:
+                logger.exception("Failed to notify listener")
+
     def on_new_replication_data(self) -> None:
         """Used to inform replication listeners that something has happened
         without waking up any of the normal user event streams"""
@@ -531,10 +719,18 @@ class Notifier:
         callback: Callable[[StreamToken, StreamToken], Awaitable[T]],
         room_ids: Optional[StrCollection] = None,
         from_token: StreamToken = StreamToken.START,
+        stream_keys: Optional[AbstractSet[StreamKeyType]] = None,
     ) -> T:
         """Wait until the callback returns a non empty response or the
         timeout fires.
+
+        If `stream_keys` is given, only updates to those streams wake up the
+        callback: it must only return a non empty response for changes to them.
         """
+        wake_up_stream_keys = None
+        if stream_keys is not None:
+            wake_up_stream_keys = frozenset(stream_keys)
+
         user_stream = self.user_to_user_stream.get(user_id)
         if user_stream is None:
             current_token = self.event_sources.get_current_token()
@@ -562,7 +758,9 @@ class Notifier:
 
                         # Now we wait for the _NotifierUserStream to be told there
                         # is a new token.
-                        listener = user_stream.new_listener(prev_token)
+                        listener = user_stream.new_listener(
+                            prev_token, wake_up_stream_keys
+                        )
                         listener.deferred = timeout_deferred(
                             listener.deferred,
                             (end_time - now) / 1000.0,
@@ -598,6 +796,8 @@ class Notifier:
                         if result:
                             break
 
+                        spurious_wakeups_counter.inc()
+
                         # Update the prev_token to the current_token since nothing
                         # has happened between the old prev_token and the current_token
                         prev_token = current_token
@@ -113,6 +113,7 @@ class BackgroundUpdateStartJobRestServlet(RestServlet):
     def __init__(self, hs: "HomeServer"):
         self._auth = hs.get_auth()
         self._store = hs.get_datastores().main
+        self._state_store = hs.get_datastores().state
 
     async def on_POST(self, request: SynapseRequest) -> Tuple[int, JsonDict]:
         await assert_requester_is_admin(self._auth, request)
@@ -122,6 +123,9 @@ class BackgroundUpdateStartJobRestServlet(RestServlet):
 
         job_name = body["job_name"]
 
+        # Most jobs are background updates of the main database.
+        db_pool = self._store.db_pool
+
         if job_name == "populate_stats_process_rooms":
             jobs = [("populate_stats_process_rooms", "{}", "")]
         elif job_name == "regenerate_directory":
@@ -143,22 +147,25 @@ class BackgroundUpdateStartJobRestServlet(RestServlet):
                     "populate_user_directory_process_users",
                 ),
             ]
+        elif job_name == "compact_state_groups":
+            jobs = [(self._state_store.STATE_GROUP_COMPACTION_UPDATE_NAME, "{}", "")]
+            db_pool = self._state_store.db_pool
         else:
             raise SynapseError(HTTPStatus.BAD_REQUEST, "Invalid job_name")
 
         try:
-            await self._store.db_pool.simple_insert_many(
+            await db_pool.simple_insert_many(
                 table="background_updates",
                 keys=("update_name", "progress_json", "depends_on"),
                 values=jobs,
                 desc=f"admin_api_run_{job_name}",
             )
-        except self._store.db_pool.engine.module.IntegrityError:
+        except db_pool.engine.module.IntegrityError:
             raise SynapseError(
                 HTTPStatus.BAD_REQUEST,
                 "Job %s is already in queue of background updates." % (job_name,),
             )
 
-        self._store.db_pool.updates.start_doing_background_updates()
+        db_pool.updates.start_doing_background_updates()
 
         return HTTPStatus.OK, {}
@@ -20,6 +20,7 @@ from typing import (
     Any,
     Awaitable,
     Callable,
+    Collection,
     DefaultDict,
     Dict,
     FrozenSet,
@@ -47,11 +48,15 @@ from synapse.logging.context import ContextResourceUsage
 from synapse.logging.opentracing import tag_args, trace
 from synapse.replication.http.state import ReplicationUpdateCurrentStateRestServlet
 from synapse.state import v1, v2
+from synapse.state.process_pool import StateResProcessPool
+from synapse.state.scheduler import StateResPriority, StateResScheduler
 from synapse.storage.databases.main.events_worker import EventRedactBehaviour
 from synapse.types import StateMap, StrCollection
 from synapse.types.state import StateFilter
+from synapse.types.state_map import CompactStateMap
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.metrics import Measure, measure_func
 
 if TYPE_CHECKING:
@@ -106,7 +111,7 @@ class _StateCacheEntry:
         # This can be None if we have a `state_group` (as then we can fetch the
         # state from the DB.)
         self._state: Optional[StateMap[str]] = (
-            immutabledict(state) if state is not None else None
+            CompactStateMap(state) if state is not None else None
         )
 
         # the ID of a state group if one and only one is involved.
@@ -305,6 +310,9 @@ class StateHandler:
         """
         assert not event.internal_metadata.is_outlier()
 
+        if self.hs.is_mine_id(event.sender):
+            self._state_resolution_handler.note_local_activity(event.room_id)
+
         #
         # first of all, figure out the state before the event, unless we
         # already have it.
@@ -562,6 +570,14 @@ class _StateResMetrics:
     # number of events fetched from the db.
     db_events: int = 0
 
+    # time spent waiting in the queue of the state res scheduler, in seconds
+    wait_time: float = 0.0
+
+    # wall clock time spent resolving full conflicted sets when the state res
+    # process pool is enabled, in seconds, by where they were resolved
+    # ("process_pool" or "in_process")
+    wall_time_by_mode: Dict[str, float] = attr.Factory(dict)
+
 
 _biggest_room_by_cpu_counter = Counter(
     "synapse_state_res_cpu_for_biggest_room_seconds",
@@ -574,6 +590,18 @@ _biggest_room_by_db_counter = Counter(
     "expensive room for state resolution",
 )
 
+_biggest_room_by_wait_counter = Counter(
+    "synapse_state_res_wait_for_biggest_room_seconds",
+    "Time spent waiting for the state res scheduler for the single room which "
+    "waited the longest",
+)
+
+_biggest_room_by_process_pool_counter = Counter(
+    "synapse_state_res_process_pool_for_biggest_room_seconds",
+    "Wall clock time spent resolving state in the state res process pool for the "
+    "single room which spent the longest there",
+)
+
 _cpu_times = Histogram(
     "synapse_state_res_cpu_for_all_rooms_seconds",
     "CPU time (utime+stime) spent computing a single state resolution",
@@ -619,6 +647,65 @@ class StateResolutionHandler:
 
         self.clock.looping_call(self._report_metrics, 120 * 1000)
 
+        self._process_pool: Optional[StateResProcessPool] = None
+        if hs.config.server.state_res_process_pool_enabled:
+            self._process_pool = StateResProcessPool(
+                hs.get_reactor(),
+                hs.config.server.state_res_process_pool_workers,
+                hs.config.server.state_res_process_pool_min_conflicted_events,
+            )
+
+        self._scheduler: Optional[StateResScheduler] = None
+        max_concurrent = hs.config.server.state_res_max_concurrent_resolutions
+        if max_concurrent is not None:
+            self._scheduler = StateResScheduler(self.clock, max_concurrent)
+
+        # The rooms in which local users have recently sent events, whose state
+        # resolutions get priority.
+        self._active_rooms: ExpiringCache[str, bool] = ExpiringCache(
+            cache_name="state_res_active_rooms",
+            clock=self.clock,
+            max_len=10000,
+            expiry_ms=hs.config.server.state_res_active_room_period_ms,
+        )
+
+        # The rooms which used more than `_flooding_room_threshold` seconds of
+        # state res time in the last reporting period, whose state resolutions are
+        # deferred until there are none from other rooms waiting.
+        self._flooding_room_threshold = (
+            hs.config.server.state_res_flooding_room_threshold
+        )
+        self._flooding_rooms: Set[str] = set()
+
+        # The power levels mainlines of rooms, which are reused between state
+        # resolutions. Sized by the number of events.
+        self._mainline_caches: LruCache[str, v2.MainlineCache] = LruCache(
+            max_size=1000000, cache_name="state_res_mainline_cache", size_callback=len
+        )
+
+    def note_local_activity(self, room_id: str) -> None:
+        """Notes that a local user has sent an event in the given room."""
+        if self._scheduler is not None:
+            self._active_rooms[room_id] = True
+
+    def _get_priority(self, room_id: str) -> StateResPriority:
+        if room_id in self._active_rooms:
+            return StateResPriority.ACTIVE
+
+        if room_id in self._flooding_rooms:
+            return StateResPriority.FLOODING
+
+        # The room may have started flooding during this reporting period.
+        room_metrics = self._state_res_metrics.get(room_id)
+        if (
+            room_metrics is not None
+            and room_metrics.cpu_time + room_metrics.db_time
+            >= self._flooding_room_threshold
+        ):
+            return StateResPriority.FLOODING
+
+        return StateResPriority.NORMAL
+
     async def resolve_state_groups(
         self,
         room_id: str,
@@ -667,13 +754,28 @@ class StateResolutionHandler:
 
             state_groups_histogram.observe(len(state_groups_ids))
 
-            new_state = await self.resolve_events_with_store(
-                room_id,
-                room_version,
-                list(state_groups_ids.values()),
-                event_map=event_map,
-                state_res_store=state_res_store,
-            )
+            if self._scheduler is None:
+                new_state = await self.resolve_events_with_store(
+                    room_id,
+                    room_version,
+                    list(state_groups_ids.values()),
+                    event_map=event_map,
+                    state_res_store=state_res_store,
+                )
+            else:
+                start = self.clock.time()
+                async with self._scheduler.schedule(self._get_priority(room_id)):
+                    self._state_res_metrics[room_id].wait_time += (
+                        self.clock.time() - start
+                    )
+
+                    new_state = await self.resolve_events_with_store(
+                        room_id,
+                        room_version,
+                        list(state_groups_ids.values()),
+                        event_map=event_map,
+                        state_res_store=state_res_store,
+                    )
 
             # if the new state matches any of the input state groups, we can
             # use that state group again. Otherwise we will generate a state_id
@@ -728,15 +830,36 @@ class StateResolutionHandler:
                         event_map,
                         state_res_store.get_events,
                     )
-                else:
-                    return await v2.resolve_events_with_store(
-                        self.clock,
-                        room_id,
-                        room_version_obj,
-                        state_sets,
-                        event_map,
-                        state_res_store,
-                    )
+
+                mainline_cache = self._mainline_caches.get(room_id)
+                if mainline_cache is None:
+                    mainline_cache = v2.MainlineCache()
+
+                try:
+                    if self._process_pool is not None:
+                        return await self._process_pool.resolve_events_with_store(
+                            self.clock,
+                            room_id,
+                            room_version_obj,
+                            state_sets,
+                            event_map,
+                            state_res_store,
+                            mainline_cache,
+                            self._state_res_metrics[room_id].wall_time_by_mode,
+                        )
+                    else:
+                        return await v2.resolve_events_with_store(
+                            self.clock,
+                            room_id,
+                            room_version_obj,
+                            state_sets,
+                            event_map,
+                            state_res_store,
+                            mainline_cache,
+                        )
+                finally:
+                    # (Re-)insert the entry so that its size gets updated.
+                    self._mainline_caches.set(room_id, mainline_cache)
         finally:
             self._record_state_res_metrics(room_id, m.get_resource_usage())
 
@@ -752,6 +875,19 @@ class StateResolutionHandler:
         _db_times.observe(rusage.db_txn_duration_sec)
 
     def _report_metrics(self) -> None:
+        self._flooding_rooms = {
+            room_id
+            for room_id, room_metrics in self._state_res_metrics.items()
+            if room_metrics.cpu_time + room_metrics.db_time
+            >= self._flooding_room_threshold
+        }
+        if self._flooding_rooms and self._scheduler is not None:
+            logger.info(
+                "Deferring state resolution for rooms using too much state res "
+                "time: %s",
+                sorted(self._flooding_rooms),
+            )
+
         if not self._state_res_metrics:
             # no state res has happened since the last iteration: don't bother logging.
             return
@@ -768,6 +904,20 @@ class StateResolutionHandler:
             _biggest_room_by_db_counter,
         )
 
+        if self._scheduler is not None:
+            self._report_biggest(
+                lambda i: i.wait_time,
+                "wait time",
+                _biggest_room_by_wait_counter,
+            )
+
+        if self._process_pool is not None:
+            self._report_biggest(
+                lambda i: i.wall_time_by_mode.get("process_pool", 0.0),
+                "process pool time",
+                _biggest_room_by_process_pool_counter,
+            )
+
         self._state_res_metrics.clear()
 
     def _report_biggest(
@@ -832,13 +982,11 @@ def _make_state_cache_entry(
     # not get persisted.
 
     # first look for exact matches
-    new_state_event_ids = set(new_state.values())
     for sg, state in state_groups_ids.items():
-        if len(new_state_event_ids) != len(state):
+        if len(new_state) != len(state):
             continue
 
-        old_state_event_ids = set(state.values())
-        if new_state_event_ids == old_state_event_ids:
+        if new_state == state:
             # got an exact match.
             return _StateCacheEntry(state=None, state_group=sg)
 
@@ -851,7 +999,7 @@ def _make_state_cache_entry(
     delta_ids: Optional[StateMap[str]] = None
 
     for old_group, old_state in state_groups_ids.items():
-        if old_state.keys() - new_state.keys():
+        if not old_state.keys() <= new_state.keys():
             # Currently we don't support deltas that remove keys from the state
             # map, so we have to ignore this group as a candidate to base the
             # new group on.
@@ -915,3 +1063,19 @@ class StateResolutionStore:
         """
 
         return self.store.get_auth_chain_difference(room_id, state_sets)
+
+    def get_auth_chain_ids(
+        self, room_id: str, event_ids: Collection[str], include_given: bool = False
+    ) -> Awaitable[Set[str]]:
+        """Get the IDs of the auth chains of the given state events.
+
+        Args:
+            room_id: The room the events are in.
+            event_ids: state events
+            include_given: include the given events in result
+
+        Returns:
+            An awaitable that resolves to a set of event IDs.
+        """
+
+        return self.store.get_auth_chain_ids(room_id, event_ids, include_given)
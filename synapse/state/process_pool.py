@@ -0,0 +1,400 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Running state resolution v2 in a pool of worker processes.
+
+Resolving the state of a very large room can keep the CPU busy for seconds, during
+which the reactor can't do anything else. `StateResProcessPool` does the database
+work (working out the full conflicted set and fetching the events) in the main
+process as usual, and then sends the events to a worker process which runs the
+CPU-bound part of the algorithm (`v2.resolve_full_conflicted_set`).
+
+The worker processes can't access the database, so every event the algorithm might
+look at has to be sent over. If the algorithm turns out to need an event which
+wasn't sent, the worker gives up and the state is resolved in the main process.
+"""
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import (
+    Any,
+    Awaitable,
+    Collection,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+from prometheus_client import Histogram
+from typing_extensions import Protocol
+
+from twisted.internet import defer
+
+from synapse import event_auth
+from synapse.api.constants import EventTypes
+from synapse.api.room_versions import KNOWN_ROOM_VERSIONS, RoomVersion
+from synapse.events import EventBase, make_event_from_dict
+from synapse.logging.context import make_deferred_yieldable
+from synapse.state import v2
+from synapse.types import ISynapseReactor, JsonDict, StateMap, StrCollection
+
+logger = logging.getLogger(__name__)
+
+state_res_wall_time = Histogram(
+    "synapse_state_res_v2_wall_time_seconds",
+    "Wall clock time spent resolving the full conflicted set of a single state "
+    "resolution, by where it was resolved",
+    ["mode"],
+)
+
+
+class PrefetchingStateResolutionStore(v2.StateResolutionStore, Protocol):
+    # This is usually synapse.state.StateResolutionStore.
+    def get_auth_chain_ids(
+        self, room_id: str, event_ids: Collection[str], include_given: bool = False
+    ) -> Awaitable[Set[str]]:
+        ...
+
+
+class MissingPrefetchedEventError(Exception):
+    """Raised in a worker process when state resolution needs an event which
+    wasn't sent to it.
+    """
+
+
+# An event, as sent to the worker processes: its dict, its internal metadata and
+# its rejection reason.
+_SerializedEvent = Tuple[JsonDict, JsonDict, Optional[str]]
+
+
+class StateResProcessPool:
+    """Runs the CPU-bound part of state resolution v2 in worker processes, for
+    resolutions with at least `min_conflicted_events` events in their full
+    conflicted set. Smaller resolutions are run in-process.
+
+    The worker processes are only started when they are first needed.
+    """
+
+    def __init__(
+        self,
+        reactor: ISynapseReactor,
+        workers: int,
+        min_conflicted_events: int,
+    ):
+        self._reactor = reactor
+        self._workers = workers
+        self._min_conflicted_events = min_conflicted_events
+
+        self._executor: Optional[Executor] = None
+
+    async def resolve_events_with_store(
+        self,
+        clock: v2.Clock,
+        room_id: str,
+        room_version: RoomVersion,
+        state_sets: Sequence[StateMap[str]],
+        event_map: Optional[Dict[str, EventBase]],
+        state_res_store: PrefetchingStateResolutionStore,
+        mainline_cache: Optional[v2.MainlineCache] = None,
+        wall_time_by_mode: Optional[Dict[str, float]] = None,
+    ) -> StateMap[str]:
+        """Resolves the state using state resolution v2. Takes the same arguments
+        as `v2.resolve_events_with_store`.
+
+        `mainline_cache` is only used when resolving the state in-process.
+
+        If `wall_time_by_mode` is given, the wall clock time spent resolving the
+        full conflicted set is added to it, keyed by where it was resolved
+        ("process_pool" or "in_process").
+        """
+        if wall_time_by_mode is None:
+            wall_time_by_mode = {}
+
+        if event_map is None:
+            event_map = {}
+
+        unconflicted_state, full_conflicted_set = await v2.get_full_conflicted_set(
+            room_id, state_sets, event_map, state_res_store
+        )
+
+        if not full_conflicted_set:
+            return unconflicted_state
+
+        if len(full_conflicted_set) >= self._min_conflicted_events:
+            try:
+                return await self._resolve_in_pool(
+                    room_id,
+                    room_version,
+                    unconflicted_state,
+                    full_conflicted_set,
+                    event_map,
+                    state_res_store,
+                    wall_time_by_mode,
+                )
+            except MissingPrefetchedEventError as e:
+                logger.info(
+                    "Resolving state for %s in-process as the worker needed %s",
+                    room_id,
+                    e,
+                )
+            except Exception:
+                logger.warning(
+                    "Failed to resolve state for %s in a worker process; "
+                    "resolving it in-process instead",
+                    room_id,
+                    exc_info=True,
+                )
+
+        start = time.monotonic()
+        try:
+            return await v2.resolve_full_conflicted_set(
+                clock,
+                room_id,
+                room_version,
+                unconflicted_state,
+                full_conflicted_set,
+                event_map,
+                state_res_store,
+                mainline_cache,
+            )
+        finally:
+            _record_wall_time(wall_time_by_mode, "in_process", start)
+
+    async def _resolve_in_pool(
+        self,
+        room_id: str,
+        room_version: RoomVersion,
+        unconflicted_state: StateMap[str],
+        full_conflicted_set: Set[str],
+        event_map: Dict[str, EventBase],
+        state_res_store: PrefetchingStateResolutionStore,
+        wall_time_by_mode: Dict[str, float],
+    ) -> StateMap[str]:
+        events = await _prefetch_events(
+            room_id,
+            room_version,
+            unconflicted_state,
+            full_conflicted_set,
+            event_map,
+            state_res_store,
+        )
+
+        start = time.monotonic()
+        try:
+            resolved_state = await self._run(
+                resolve_in_worker,
+                room_id,
+                room_version.identifier,
+                dict(unconflicted_state),
+                full_conflicted_set,
+                [
+                    (
+                        event.get_dict(),
+                        event.internal_metadata.get_dict(),
+                        event.rejected_reason,
+                    )
+                    for event in events
+                ],
+            )
+        finally:
+            _record_wall_time(wall_time_by_mode, "process_pool", start)
+
+        return resolved_state
+
+    async def _run(self, f: Any, *args: Any) -> Any:
+        """Run the given top-level function in a worker process, and wait for its
+        result.
+        """
+        executor = self._get_executor()
+
+        d: "defer.Deferred[Any]" = defer.Deferred()
+
+        def on_done(future: "Future[Any]") -> None:
+            # This is called from a thread of the executor, unless the future
+            # has already completed.
+            exception = future.exception()
+            if exception is not None:
+                self._reactor.callFromThread(d.errback, exception)
+            else:
+                self._reactor.callFromThread(d.callback, future.result())
+
+        try:
+            executor.submit(f, *args).add_done_callback(on_done)
+            return await make_deferred_yieldable(d)
+        except BrokenProcessPool:
+            # One of the worker processes died: start a new pool next time.
+            self._executor = None
+            executor.shutdown(wait=False)
+            raise
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            self._reactor.addSystemEventTrigger(
+                "during", "shutdown", self._executor.shutdown, wait=False
+            )
+        return self._executor
+
+
+def _record_wall_time(
+    wall_time_by_mode: Dict[str, float], mode: str, start: float
+) -> None:
+    wall_time = time.monotonic() - start
+    state_res_wall_time.labels(mode).observe(wall_time)
+    wall_time_by_mode[mode] = wall_time_by_mode.get(mode, 0.0) + wall_time
+
+
+async def _prefetch_events(
+    room_id: str,
+    room_version: RoomVersion,
+    unconflicted_state: StateMap[str],
+    full_conflicted_set: Set[str],
+    event_map: Dict[str, EventBase],
+    state_res_store: PrefetchingStateResolutionStore,
+) -> List[EventBase]:
+    """Fetch the events which `v2.resolve_full_conflicted_set` will need, i.e.
+    the events in the full conflicted set, the unconflicted state events they
+    could be authorised by, and the auth chains of all of those.
+    """
+    needed = set(full_conflicted_set)
+    auth_types = {(EventTypes.PowerLevels, "")}
+    for event_id in full_conflicted_set:
+        auth_types.update(
+            event_auth.auth_types_for_event(room_version, event_map[event_id])
+        )
+    needed.update(
+        unconflicted_state[key] for key in auth_types if key in unconflicted_state
+    )
+
+    # Events which haven't been persisted yet won't be found in the database, so
+    # we start from their auth events.
+    auth_chain_roots = set(needed)
+    for event_id in needed:
+        event = event_map.get(event_id)
+        if event is not None:
+            auth_chain_roots.update(event.auth_event_ids())
+
+    needed.update(
+        await state_res_store.get_auth_chain_ids(
+            room_id, auth_chain_roots, include_given=True
+        )
+    )
+
+    event_map.update(
+        await state_res_store.get_events(
+            [event_id for event_id in needed if event_id not in event_map],
+            allow_rejected=True,
+        )
+    )
+
+    return [event_map[event_id] for event_id in needed if event_id in event_map]
+
+
+class _ImmediateClock:
+    """A clock which doesn't sleep: the worker processes have nothing else to do
+    while resolving state.
+    """
+
+    async def sleep(self, duration_ms: float) -> None:
+        pass
+
+
+class _PrefetchedEventsStore:
+    """A `v2.StateResolutionStore` for the worker processes, which have been sent
+    all of the events they should need, including their auth chains.
+    """
+
+    def __init__(self, event_map: Dict[str, EventBase]):
+        self._event_map = event_map
+
+    async def get_events(
+        self, event_ids: StrCollection, allow_rejected: bool = False
+    ) -> Dict[str, EventBase]:
+        raise MissingPrefetchedEventError(", ".join(event_ids))
+
+    async def get_auth_chain_difference(
+        self, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
+        auth_chains = [self._get_auth_chain(state_set) for state_set in state_sets]
+        common = auth_chains[0].intersection(*auth_chains[1:])
+        return auth_chains[0].union(*auth_chains[1:]) - common
+
+    def _get_auth_chain(self, event_ids: Collection[str]) -> Set[str]:
+        """Returns the auth chain of the given events, including the events
+        themselves.
+        """
+        auth_chain: Set[str] = set()
+        to_visit = list(event_ids)
+        while to_visit:
+            event_id = to_visit.pop()
+            if event_id in auth_chain:
+                continue
+            event = self._event_map.get(event_id)
+            if event is None:
+                raise MissingPrefetchedEventError(event_id)
+            auth_chain.add(event_id)
+            to_visit.extend(event.auth_event_ids())
+        return auth_chain
+
+
+def resolve_in_worker(
+    room_id: str,
+    room_version_id: str,
+    unconflicted_state: Dict[Tuple[str, str], str],
+    full_conflicted_set: Set[str],
+    events: List[_SerializedEvent],
+) -> StateMap[str]:
+    """Runs `v2.resolve_full_conflicted_set` on the given events. This is what
+    runs in the worker processes.
+
+    Raises:
+        MissingPrefetchedEventError: if an event needed to resolve the state is
+            not in `events`.
+    """
+    room_version = KNOWN_ROOM_VERSIONS[room_version_id]
+
+    event_map = {}
+    for event_dict, internal_metadata_dict, rejected_reason in events:
+        event = make_event_from_dict(
+            event_dict, room_version, internal_metadata_dict, rejected_reason
+        )
+        event_map[event.event_id] = event
+
+    coro = v2.resolve_full_conflicted_set(
+        _ImmediateClock(),
+        room_id,
+        room_version,
+        unconflicted_state,
+        full_conflicted_set,
+        event_map,
+        _PrefetchedEventsStore(event_map),
+    )
+
+    # Nothing ever actually waits, so the coroutine runs to completion in one go.
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+    coro.close()
+    raise RuntimeError("State resolution unexpectedly waited in a worker process")
@@ -0,0 +1,139 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import heapq
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import AsyncContextManager, AsyncIterator, List, Tuple
+
+from prometheus_client import Gauge, Histogram
+
+from twisted.internet import defer
+from twisted.internet.defer import CancelledError
+
+from synapse.logging.context import PreserveLoggingContext, make_deferred_yieldable
+from synapse.util import Clock
+
+logger = logging.getLogger(__name__)
+
+
+class StateResPriority(IntEnum):
+    """The priority of a state resolution: lower values are run first."""
+
+    # Rooms in which local users have recently sent events.
+    ACTIVE = 0
+    NORMAL = 1
+    # Rooms which have recently used more than their share of state resolution
+    # time, e.g. because they are being flooded with events.
+    FLOODING = 2
+
+
+state_res_queue_depth = Gauge(
+    "synapse_state_res_scheduler_queue_depth",
+    "Number of state resolutions waiting to be run, by priority",
+    ["priority"],
+)
+
+state_res_wait_time = Histogram(
+    "synapse_state_res_scheduler_wait_seconds",
+    "Time state resolutions spent waiting to be run, by priority",
+    ["priority"],
+)
+
+
+class StateResScheduler:
+    """Limits the number of state resolutions which run at the same time.
+
+    When the limit is reached, the state resolutions wait in a queue, and are run
+    in order of priority (and then in the order they were queued).
+
+    Example:
+
+        async with scheduler.schedule(StateResPriority.NORMAL):
+            # resolve the state.
+    """
+
+    def __init__(self, clock: Clock, max_concurrent: int):
+        self._clock = clock
+        self._max_concurrent = max_concurrent
+
+        # The number of state resolutions currently running.
+        self._running = 0
+
+        # A heap of the waiting state resolutions, as (priority, sequence number,
+        # deferred to resolve when it can run).
+        self._queue: List[Tuple[int, int, "defer.Deferred[None]"]] = []
+        self._sequence = itertools.count()
+
+    def schedule(self, priority: StateResPriority) -> AsyncContextManager[None]:
+        @asynccontextmanager
+        async def _ctx_manager() -> AsyncIterator[None]:
+            await self._acquire(priority)
+            try:
+                yield
+            finally:
+                self._release()
+
+        return _ctx_manager()
+
+    async def _acquire(self, priority: StateResPriority) -> None:
+        """Waits until there is room to run a state resolution of the given
+        priority.
+        """
+        start = self._clock.time()
+        label = priority.name.lower()
+
+        if self._running < self._max_concurrent and not self._queue:
+            self._running += 1
+            state_res_wait_time.labels(label).observe(0)
+            return
+
+        deferred: "defer.Deferred[None]" = defer.Deferred()
+        entry = (priority.value, next(self._sequence), deferred)
+        heapq.heappush(self._queue, entry)
+        state_res_queue_depth.labels(label).inc()
+
+        try:
+            await make_deferred_yieldable(deferred)
+        except CancelledError:
+            # We were cancelled while waiting: take ourselves back out of the queue.
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+            raise
+        finally:
+            state_res_queue_depth.labels(label).dec()
+
+        # `_release` has handed its slot over to us.
+        state_res_wait_time.labels(label).observe(self._clock.time() - start)
+
+        # If the state resolution holding the slot completed synchronously, we
+        # would be run recursively, so fall back to the reactor first (as
+        # `Linearizer` does).
+        try:
+            await self._clock.sleep(0)
+        except CancelledError:
+            self._release()
+            raise
+
+    def _release(self) -> None:
+        if not self._queue:
+            self._running -= 1
+            return
+
+        # Hand our slot over to the next state resolution in the queue.
+        _, _, next_deferred = heapq.heappop(self._queue)
+        with PreserveLoggingContext():
+            next_deferred.callback(None)
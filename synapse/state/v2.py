@@ -70,8 +70,63 @@ class StateResolutionStore(Protocol):
 _AWAIT_AFTER_ITERATIONS = 100
 
 
+# The number of resolved power levels events to keep mainline depths for in a
+# `MainlineCache`.
+_MAX_CACHED_MAINLINES = 4
+
+
+class MainlineCache:
+    """Caches the power levels "mainlines" of a room, which are used to sort events
+    during state resolution, across the state resolutions in the room.
+
+    An event's power levels auth event never changes, so is cached indefinitely.
+    The mainline depths of events depend on the resolved power levels event, so are
+    only cached for the few most recently resolved power levels events; in
+    practice they change only when new power levels events arrive.
+    """
+
+    def __init__(self) -> None:
+        # Map from event ID to the ID of the power levels event in its auth events
+        # (or None if there isn't one).
+        self.power_level_auth_events: Dict[str, Optional[str]] = {}
+
+        # Map from resolved power levels event ID to its mainline (a map from the
+        # power levels events in it to their position), and a map from event ID
+        # to the mainline depth of the event. Ordered from least to most recently
+        # used.
+        self.mainlines: Dict[str, Tuple[Dict[str, int], Dict[str, int]]] = {}
+
+    def __len__(self) -> int:
+        return len(self.power_level_auth_events) + sum(
+            len(mainline_map) + len(depths)
+            for mainline_map, depths in self.mainlines.values()
+        )
+
+    def get_mainline(
+        self, resolved_power_event_id: str
+    ) -> Optional[Tuple[Dict[str, int], Dict[str, int]]]:
+        mainline = self.mainlines.pop(resolved_power_event_id, None)
+        if mainline is not None:
+            # Move it to the end, as the most recently used.
+            self.mainlines[resolved_power_event_id] = mainline
+        return mainline
+
+    def add_mainline(
+        self, resolved_power_event_id: str, mainline_map: Dict[str, int]
+    ) -> Tuple[Dict[str, int], Dict[str, int]]:
+        while len(self.mainlines) >= _MAX_CACHED_MAINLINES:
+            del self.mainlines[next(iter(self.mainlines))]
+
+        mainline: Tuple[Dict[str, int], Dict[str, int]] = (mainline_map, {})
+        self.mainlines[resolved_power_event_id] = mainline
+        return mainline
+
+
 __all__ = [
     "resolve_events_with_store",
+    "get_full_conflicted_set",
+    "resolve_full_conflicted_set",
+    "MainlineCache",
 ]
 
 
@@ -82,6 +137,7 @@ async def resolve_events_with_store(
     state_sets: Sequence[StateMap[str]],
     event_map: Optional[Dict[str, EventBase]],
     state_res_store: StateResolutionStore,
+    mainline_cache: Optional[MainlineCache] = None,
 ) -> StateMap[str]:
     """Resolves the state using the v2 state resolution algorithm
 
@@ -100,22 +156,67 @@ async def resolve_events_with_store(
             If None, all events will be fetched via state_res_store.
 
         state_res_store:
+        mainline_cache: the mainlines of the room, if we are keeping track of
+            them between state resolutions.
 
     Returns:
         A map from (type, state_key) to event_id.
     """
 
-    logger.debug("Computing conflicted state")
-
     # We use event_map as a cache, so if its None we need to initialize it
     if event_map is None:
         event_map = {}
 
+    unconflicted_state, full_conflicted_set = await get_full_conflicted_set(
+        room_id, state_sets, event_map, state_res_store
+    )
+
+    if not full_conflicted_set:
+        return unconflicted_state
+
+    return await resolve_full_conflicted_set(
+        clock,
+        room_id,
+        room_version,
+        unconflicted_state,
+        full_conflicted_set,
+        event_map,
+        state_res_store,
+        mainline_cache,
+    )
+
+
+async def get_full_conflicted_set(
+    room_id: str,
+    state_sets: Sequence[StateMap[str]],
+    event_map: Dict[str, EventBase],
+    state_res_store: StateResolutionStore,
+) -> Tuple[StateMap[str], Set[str]]:
+    """Works out the unconflicted state and the full conflicted set (i.e. the
+    conflicted state events plus the auth chain difference) of the given state
+    sets. This is the part of the v2 state resolution algorithm which needs the
+    database, other than for fetching events.
+
+    Args:
+        room_id: the room we are working in
+        state_sets: List of dicts of (type, state_key) -> event_id,
+            which are the different state groups to resolve.
+        event_map: a dict from event_id to event, for any events that we happen
+            to have in flight. The events of the full conflicted set are added
+            to it.
+        state_res_store:
+
+    Returns:
+        The unconflicted state, and the IDs of the events in the full conflicted
+        set. The latter is empty if there are no conflicts.
+    """
+    logger.debug("Computing conflicted state")
+
     # First split up the un/conflicted state
     unconflicted_state, conflicted_state = _seperate(state_sets)
 
     if not conflicted_state:
-        return unconflicted_state
+        return unconflicted_state, set()
 
     logger.debug("%d conflicted state entries", len(conflicted_state))
     logger.debug("Calculating auth chain difference")
@@ -154,6 +255,41 @@ async def resolve_events_with_store(
 
     logger.debug("%d full_conflicted_set entries", len(full_conflicted_set))
 
+    return unconflicted_state, full_conflicted_set
+
+
+async def resolve_full_conflicted_set(
+    clock: Clock,
+    room_id: str,
+    room_version: RoomVersion,
+    unconflicted_state: StateMap[str],
+    full_conflicted_set: Set[str],
+    event_map: Dict[str, EventBase],
+    state_res_store: StateResolutionStore,
+    mainline_cache: Optional[MainlineCache] = None,
+) -> StateMap[str]:
+    """Resolves the state given the output of `get_full_conflicted_set`.
+
+    This is the CPU-bound part of the v2 state resolution algorithm: the only
+    thing it needs from `state_res_store` is the events it doesn't find in
+    `event_map`.
+
+    Args:
+        clock
+        room_id: the room we are working in
+        room_version: The room version
+        unconflicted_state: The unconflicted state.
+        full_conflicted_set: The IDs of the events in the full conflicted set,
+            which must all be in `event_map`.
+        event_map: a dict from event_id to event.
+        state_res_store:
+        mainline_cache: the mainlines of the room, if we are keeping track of
+            them between state resolutions.
+
+    Returns:
+        A map from (type, state_key) to event_id.
+    """
+
     # Get and sort all the power events (kicks/bans/etc)
     power_events = (
         eid for eid in full_conflicted_set if _is_power_event(event_map[eid])
@@ -190,7 +326,13 @@ async def resolve_events_with_store(
 
     pl = resolved_state.get((EventTypes.PowerLevels, ""), None)
     leftover_events = await _mainline_sort(
-        clock, room_id, leftover_events, pl, event_map, state_res_store
+        clock,
+        room_id,
+        leftover_events,
+        pl,
+        event_map,
+        state_res_store,
+        mainline_cache,
     )
 
     logger.debug("resolving remaining events")
@@ -615,6 +757,7 @@ async def _mainline_sort(
     resolved_power_event_id: Optional[str],
     event_map: Dict[str, EventBase],
     state_res_store: StateResolutionStore,
+    mainline_cache: Optional[MainlineCache] = None,
 ) -> List[str]:
     """Returns a sorted list of event_ids sorted by mainline ordering based on
     the given event resolved_power_event_id
@@ -626,6 +769,8 @@ async def _mainline_sort(
         resolved_power_event_id: The final resolved power level event ID
         event_map
         state_res_store
+        mainline_cache: the mainlines of the room, if we are keeping track of
+            them between state resolutions.
 
     Returns:
         The sorted list
@@ -635,37 +780,57 @@ async def _mainline_sort(
         # skip calculating the mainline in that case.
         return []
 
-    mainline = []
-    pl = resolved_power_event_id
-    idx = 0
-    while pl:
-        mainline.append(pl)
-        pl_ev = await _get_event(room_id, pl, event_map, state_res_store)
-        auth_events = pl_ev.auth_event_ids()
-        pl = None
-        for aid in auth_events:
-            ev = await _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
-            )
-            if ev and (ev.type, ev.state_key) == (EventTypes.PowerLevels, ""):
-                pl = aid
-                break
+    if mainline_cache is None:
+        mainline_cache = MainlineCache()
+
+    mainline_map: Dict[str, int] = {}
+    depths: Dict[str, int] = {}
+    if resolved_power_event_id:
+        mainline = mainline_cache.get_mainline(resolved_power_event_id)
+        if mainline is None:
+            mainline_ids = []
+            pl: Optional[str] = resolved_power_event_id
+            # Whether we had all the auth events of the power levels events in the
+            # mainline, so can cache it.
+            complete = True
+            idx = 0
+            while pl:
+                mainline_ids.append(pl)
+                pl, have_all_auth_events = await _get_power_level_auth_event_id(
+                    room_id, pl, event_map, state_res_store, mainline_cache
+                )
+                complete = complete and have_all_auth_events
 
-        # We await occasionally when we're working with large data sets to
-        # ensure that we don't block the reactor loop for too long.
-        if idx != 0 and idx % _AWAIT_AFTER_ITERATIONS == 0:
-            await clock.sleep(0)
+                # We await occasionally when we're working with large data sets to
+                # ensure that we don't block the reactor loop for too long.
+                if idx != 0 and idx % _AWAIT_AFTER_ITERATIONS == 0:
+                    await clock.sleep(0)
 
-        idx += 1
+                idx += 1
 
-    mainline_map = {ev_id: i + 1 for i, ev_id in enumerate(reversed(mainline))}
+            mainline_map = {
+                ev_id: i + 1 for i, ev_id in enumerate(reversed(mainline_ids))
+            }
+            if complete:
+                mainline = mainline_cache.add_mainline(
+                    resolved_power_event_id, mainline_map
+                )
+            else:
+                mainline = (mainline_map, {})
+        mainline_map, depths = mainline
 
     event_ids = list(event_ids)
 
     order_map = {}
     for idx, ev_id in enumerate(event_ids, start=1):
         depth = await _get_mainline_depth_for_event(
-            clock, event_map[ev_id], mainline_map, event_map, state_res_store
+            clock,
+            event_map[ev_id],
+            mainline_map,
+            event_map,
+            state_res_store,
+            mainline_cache,
+            depths,
         )
         order_map[ev_id] = (depth, event_map[ev_id].origin_server_ts, ev_id)
 
@@ -685,6 +850,8 @@ async def _get_mainline_depth_for_event(
     mainline_map: Dict[str, int],
     event_map: Dict[str, EventBase],
     state_res_store: StateResolutionStore,
+    mainline_cache: MainlineCache,
+    depths: Dict[str, int],
 ) -> int:
     """Get the mainline depths for the given event based on the mainline map
 
@@ -693,40 +860,92 @@ async def _get_mainline_depth_for_event(
         mainline_map: Map from event_id to mainline depth for events in the mainline.
         event_map
         state_res_store
+        mainline_cache
+        depths: Map from event_id to the mainline depth of events we've already
+            calculated it for. Updated with the events we walk through.
 
     Returns:
         The mainline depth
     """
 
     room_id = event.room_id
-    tmp_event: Optional[EventBase] = event
+    tmp_event_id: Optional[str] = event.event_id
+
+    # The events we've walked through, which all have the same mainline depth.
+    walked: List[str] = []
 
     # We do an iterative search, replacing `event with the power level in its
     # auth events (if any)
+    depth = 0
     idx = 0
-    while tmp_event:
-        depth = mainline_map.get(tmp_event.event_id)
-        if depth is not None:
-            return depth
-
-        auth_events = tmp_event.auth_event_ids()
-        tmp_event = None
+    while tmp_event_id:
+        mainline_depth = mainline_map.get(tmp_event_id)
+        if mainline_depth is None:
+            mainline_depth = depths.get(tmp_event_id)
+        if mainline_depth is not None:
+            depth = mainline_depth
+            break
 
-        for aid in auth_events:
-            aev = await _get_event(
-                room_id, aid, event_map, state_res_store, allow_none=True
-            )
-            if aev and (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
-                tmp_event = aev
-                break
+        walked.append(tmp_event_id)
+        tmp_event_id, have_all_auth_events = await _get_power_level_auth_event_id(
+            room_id, tmp_event_id, event_map, state_res_store, mainline_cache
+        )
+        if not have_all_auth_events:
+            # A missing auth event may turn out to be a power levels event, which
+            # would change the depth of the events we've walked through so far.
+            walked.clear()
 
         idx += 1
 
         if idx % _AWAIT_AFTER_ITERATIONS == 0:
             await clock.sleep(0)
 
-    # Didn't find a power level auth event, so we just return 0
-    return 0
+    # If we didn't find a power level auth event, the depth is 0.
+    #
+    # Only the depths which don't depend on missing auth events are recorded.
+    for event_id in walked:
+        depths[event_id] = depth
+
+    return depth
+
+
+async def _get_power_level_auth_event_id(
+    room_id: str,
+    event_id: str,
+    event_map: Dict[str, EventBase],
+    state_res_store: StateResolutionStore,
+    mainline_cache: MainlineCache,
+) -> Tuple[Optional[str], bool]:
+    """Get the ID of the power levels event in the auth events of the given event,
+    if any.
+
+    Returns:
+        A tuple of the ID of the power levels event, and whether we had all the
+        auth events of the given event.
+    """
+    if event_id in mainline_cache.power_level_auth_events:
+        return mainline_cache.power_level_auth_events[event_id], True
+
+    event = await _get_event(room_id, event_id, event_map, state_res_store)
+
+    # We can only cache the result if we had all the auth events we looked at, as
+    # a missing one may turn out to be the power levels event.
+    have_all_auth_events = True
+    pl = None
+    for aid in event.auth_event_ids():
+        aev = await _get_event(
+            room_id, aid, event_map, state_res_store, allow_none=True
+        )
+        if aev is None:
+            have_all_auth_events = False
+        elif (aev.type, aev.state_key) == (EventTypes.PowerLevels, ""):
+            pl = aid
+            break
+
+    if have_all_auth_events:
+        mainline_cache.power_level_auth_events[event_id] = pl
+
+    return pl, have_all_auth_events
 
 
 @overload
@@ -42,6 +42,7 @@ import attr
 from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
+from twisted.internet.interfaces import IDelayedCall
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.events import EventBase
@@ -67,6 +68,7 @@ from synapse.types import (
     get_domain_from_id,
 )
 from synapse.types.state import StateFilter
+from synapse.util import Clock
 from synapse.util.async_helpers import ObservableDeferred, yieldable_gather_results
 from synapse.util.metrics import Measure
 
@@ -121,6 +123,43 @@ times_pruned_extremities = Counter(
     "Number of times we were actually be able to prune extremities",
 )
 
+persist_event_batch_time = Histogram(
+    "synapse_storage_events_persist_batch_seconds",
+    "Time taken to persist a batch of events in a room, including calculating its "
+    "new forward extremities and current state unless that was deferred",
+)
+
+extremity_maintenance_time = Histogram(
+    "synapse_storage_events_extremity_maintenance_seconds",
+    "Time taken to recalculate the forward extremities and current state of a room "
+    "after persisting events without doing so",
+)
+
+# How long to wait before retrying a failed recalculation of the forward
+# extremities and current state of a room, doubling with each failure up to the
+# maximum.
+EXTREMITY_MAINTENANCE_RETRY_DELAY_SECONDS = 5
+EXTREMITY_MAINTENANCE_MAX_RETRY_DELAY_SECONDS = 10 * 60
+
+current_state_lag_time = Histogram(
+    "synapse_storage_events_current_state_lag_seconds",
+    "Time between persisting events without recalculating the current state of "
+    "their room and recalculating it",
+)
+
+events_per_persist_transaction = Histogram(
+    "synapse_storage_events_per_persist_transaction",
+    "Number of events written by each event persistence transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, "+Inf"),
+)
+
+rooms_per_persist_transaction = Histogram(
+    "synapse_storage_rooms_per_persist_transaction",
+    "Number of rooms whose events were written by each event persistence "
+    "transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, "+Inf"),
+)
+
 
 @attr.s(auto_attribs=True, slots=True)
 class _PersistEventsTask:
@@ -154,7 +193,35 @@ class _UpdateCurrentStateTask:
         return isinstance(task, _UpdateCurrentStateTask)
 
 
-_EventPersistQueueTask = Union[_PersistEventsTask, _UpdateCurrentStateTask]
+@attr.s(auto_attribs=True, slots=True)
+class _MaintainExtremitiesTask:
+    """A room whose forward extremities and current state need recalculating, as
+    events were persisted without doing so.
+    """
+
+    name: ClassVar[str] = "maintain_extremities"  # used for opentracing
+
+    # The events which were persisted.
+    events_and_contexts: List[Tuple[EventBase, EventContext]]
+
+    # When the first of the events was queued for maintenance.
+    queued_at: float
+
+    # The number of times the recalculation has failed.
+    failures: int = 0
+
+    def try_merge(self, task: "_EventPersistQueueTask") -> bool:
+        """Coalesces consecutive recalculations."""
+        if not isinstance(task, _MaintainExtremitiesTask):
+            return False
+
+        self.events_and_contexts.extend(task.events_and_contexts)
+        return True
+
+
+_EventPersistQueueTask = Union[
+    _PersistEventsTask, _UpdateCurrentStateTask, _MaintainExtremitiesTask
+]
 _PersistResult = TypeVar("_PersistResult")
 
 
@@ -308,6 +375,152 @@ class _EventPeristenceQueue(Generic[_PersistResult]):
             pass
 
 
+# The arguments of `EventsPersistenceStorageController._persist_events_and_state_updates`:
+# the events and contexts, the state deltas and the new forward extremities (by
+# room), and whether the events were backfilled.
+_PersistEventsCallback = Callable[
+    [
+        List[Tuple[EventBase, EventContext]],
+        Dict[str, DeltaState],
+        Dict[str, Set[str]],
+        bool,
+    ],
+    Awaitable[None],
+]
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _PendingWrite:
+    """A batch of events waiting to be written by the `_GroupCommitter`."""
+
+    events_and_contexts: List[Tuple[EventBase, EventContext]]
+    state_delta_for_room: Dict[str, DeltaState]
+    new_forward_extremities: Dict[str, Set[str]]
+    deferred: "defer.Deferred[None]" = attr.Factory(defer.Deferred)
+
+
+class _GroupCommitter:
+    """Merges the batches of events of different rooms which are ready to be
+    written into shared transactions ("group commit"), rather than writing each
+    in its own transaction.
+
+    Batches wait up to `max_latency_ms` for others to join them, unless there are
+    already `max_events` events waiting. Each room only has one batch being
+    persisted at a time (see `_EventPeristenceQueue`), so this doesn't change the
+    order in which the events of a room are written.
+    """
+
+    def __init__(
+        self,
+        clock: Clock,
+        persist_callback: _PersistEventsCallback,
+        max_latency_ms: int,
+        max_events: int,
+    ):
+        self._clock = clock
+        self._persist_callback = persist_callback
+        self._max_latency_ms = max_latency_ms
+        self._max_events = max_events
+
+        # The batches waiting to be written, and the number of events in them, by
+        # whether they were backfilled.
+        self._pending: Dict[bool, List[_PendingWrite]] = {}
+        self._pending_events: Dict[bool, int] = {}
+        self._flush_calls: Dict[bool, IDelayedCall] = {}
+
+    async def write(
+        self,
+        events_and_contexts: List[Tuple[EventBase, EventContext]],
+        state_delta_for_room: Dict[str, DeltaState],
+        new_forward_extremities: Dict[str, Set[str]],
+        backfilled: bool,
+    ) -> None:
+        """Write the events of a room, along with the changes to its current state
+        and forward extremities. Returns once they have been written.
+        """
+        write = _PendingWrite(
+            events_and_contexts, state_delta_for_room, new_forward_extremities
+        )
+        self._pending.setdefault(backfilled, []).append(write)
+        self._pending_events[backfilled] = self._pending_events.get(
+            backfilled, 0
+        ) + len(events_and_contexts)
+
+        if self._pending_events[backfilled] >= self._max_events:
+            self._flush(backfilled)
+        elif backfilled not in self._flush_calls:
+            self._flush_calls[backfilled] = self._clock.call_later(
+                self._max_latency_ms / 1000, self._flush, backfilled
+            )
+
+        await make_deferred_yieldable(write.deferred)
+
+    def _flush(self, backfilled: bool) -> None:
+        writes = self._pending.pop(backfilled, [])
+        self._pending_events.pop(backfilled, None)
+        flush_call = self._flush_calls.pop(backfilled, None)
+        if flush_call is not None and flush_call.active():
+            flush_call.cancel()
+
+        if writes:
+            run_as_background_process(
+                "persist_events_group_commit", self._write_group, writes, backfilled
+            )
+
+    async def _write_group(self, writes: List[_PendingWrite], backfilled: bool) -> None:
+        events_and_contexts: List[Tuple[EventBase, EventContext]] = []
+        state_delta_for_room: Dict[str, DeltaState] = {}
+        new_forward_extremities: Dict[str, Set[str]] = {}
+        for write in writes:
+            events_and_contexts.extend(write.events_and_contexts)
+            state_delta_for_room.update(write.state_delta_for_room)
+            new_forward_extremities.update(write.new_forward_extremities)
+
+        try:
+            await self._persist_callback(
+                events_and_contexts,
+                state_delta_for_room,
+                new_forward_extremities,
+                backfilled,
+            )
+        except Exception:
+            if len(writes) == 1:
+                with PreserveLoggingContext():
+                    writes[0].deferred.errback()
+                return
+
+            # Write the batches one by one, so that a problem with one room
+            # doesn't stop the events of the others being persisted.
+            logger.warning(
+                "Failed to persist events of %d rooms together; "
+                "retrying room by room",
+                len(writes),
+                exc_info=True,
+            )
+            for write in writes:
+                await self._write_one(write, backfilled)
+            return
+
+        for write in writes:
+            with PreserveLoggingContext():
+                write.deferred.callback(None)
+
+    async def _write_one(self, write: _PendingWrite, backfilled: bool) -> None:
+        try:
+            await self._persist_callback(
+                write.events_and_contexts,
+                write.state_delta_for_room,
+                write.new_forward_extremities,
+                backfilled,
+            )
+        except Exception:
+            with PreserveLoggingContext():
+                write.deferred.errback()
+        else:
+            with PreserveLoggingContext():
+                write.deferred.callback(None)
+
+
 class EventsPersistenceStorageController:
     """High level interface for handling persisting newly received events.
 
@@ -340,6 +553,34 @@ class EventsPersistenceStorageController:
         self._state_controller = state_controller
         self.hs = hs
 
+        # Whether to recalculate the forward extremities and current state of
+        # rooms after persisting their events when that involves state resolution,
+        # rather than before.
+        self._defer_extremity_maintenance = (
+            hs.config.server.deferred_extremity_maintenance
+        )
+        # The rooms with a pending `_MaintainExtremitiesTask`, whose current state
+        # in the database may not match their forward extremities.
+        self._rooms_awaiting_maintenance: Set[str] = set()
+        self._events_shard_config = hs.config.worker.events_shard_config
+
+        # Pick up any recalculations which didn't happen before we last stopped.
+        self._clock.call_later(
+            0,
+            run_as_background_process,
+            "resume_extremity_maintenance",
+            self._resume_extremity_maintenance,
+        )
+
+        self._group_committer: Optional[_GroupCommitter] = None
+        if hs.config.server.event_persistence_group_commit_enabled:
+            self._group_committer = _GroupCommitter(
+                self._clock,
+                self._persist_events_and_state_updates,
+                hs.config.server.event_persistence_group_commit_max_latency_ms,
+                hs.config.server.event_persistence_group_commit_max_events,
+            )
+
     async def _process_event_persist_queue_task(
         self,
         room_id: str,
@@ -359,10 +600,25 @@ class EventsPersistenceStorageController:
             NEW_EVENT_DURING_PURGE_LOCK_NAME, room_id, write=False
         ):
             if isinstance(task, _PersistEventsTask):
-                return await self._persist_event_batch(room_id, task)
+                with persist_event_batch_time.time():
+                    return await self._persist_event_batch(room_id, task)
             elif isinstance(task, _UpdateCurrentStateTask):
                 await self._update_current_state(room_id, task)
                 return {}
+            elif isinstance(task, _MaintainExtremitiesTask):
+                try:
+                    with extremity_maintenance_time.time():
+                        await self._maintain_extremities(room_id, task)
+                except Exception:
+                    # The room is left awaiting maintenance, so we have to try
+                    # again: otherwise its current state would stay stale, and
+                    # the later events in the room would keep being deferred.
+                    logger.exception(
+                        "Failed to recalculate the current state of room %s",
+                        room_id,
+                    )
+                    self._retry_extremity_maintenance(room_id, task)
+                return {}
             else:
                 raise AssertionError(
                     f"Found an unexpected task type in event persistence queue: {task}"
@@ -607,6 +863,10 @@ class EventsPersistenceStorageController:
             # room
             state_delta_for_room: Dict[str, DeltaState] = {}
 
+            # map room_id->events whose forward extremities and current state
+            # are to be recalculated once they have been persisted.
+            maintenance_for_room: Dict[str, List[Tuple[EventBase, EventContext]]] = {}
+
             if not backfilled:
                 with Measure(self._clock, "_calculate_state_and_extrem"):
                     # Work out the new "current state" for each room.
@@ -673,6 +933,13 @@ class EventsPersistenceStorageController:
                                     state_delta_reuse_delta_counter.inc()
                                     break
 
+                        if room_id in self._rooms_awaiting_maintenance:
+                            # The current state in the database may not match the
+                            # old forward extremities, so it will have to be
+                            # recalculated from scratch anyway.
+                            maintenance_for_room[room_id] = ev_ctx_rm
+                            continue
+
                         logger.debug("Calculating state delta for room %s", room_id)
                         with Measure(
                             self._clock, "persist_events.get_new_state_after_events"
@@ -682,7 +949,12 @@ class EventsPersistenceStorageController:
                                 ev_ctx_rm,
                                 latest_event_ids,
                                 new_latest_event_ids,
+                                defer_state_res=self._defer_extremity_maintenance,
                             )
+                            if res is None:
+                                maintenance_for_room[room_id] = ev_ctx_rm
+                                continue
+
                             current_state, delta_ids, new_latest_event_ids = res
 
                             # there should always be at least one forward extremity.
@@ -727,16 +999,177 @@ class EventsPersistenceStorageController:
 
                             state_delta_for_room[room_id] = delta
 
-            await self.persist_events_store._persist_events_and_state_updates(
-                chunk,
-                state_delta_for_room=state_delta_for_room,
-                new_forward_extremities=new_forward_extremities,
-                use_negative_stream_ordering=backfilled,
-                inhibit_local_membership_updates=backfilled,
-            )
+            # Record the rooms awaiting maintenance in the database before
+            # persisting their events, so that we know to do it should we be
+            # restarted first.
+            for room_id in maintenance_for_room:
+                if room_id not in self._rooms_awaiting_maintenance:
+                    await self.persist_events_store.mark_room_awaiting_extremity_maintenance(
+                        room_id
+                    )
+
+            if self._group_committer is not None:
+                await self._group_committer.write(
+                    chunk, state_delta_for_room, new_forward_extremities, backfilled
+                )
+            else:
+                await self._persist_events_and_state_updates(
+                    chunk, state_delta_for_room, new_forward_extremities, backfilled
+                )
+
+            for room_id, ev_ctx_rm in maintenance_for_room.items():
+                self._queue_extremity_maintenance(room_id, ev_ctx_rm)
 
         return replaced_events
 
+    async def _persist_events_and_state_updates(
+        self,
+        events_and_contexts: List[Tuple[EventBase, EventContext]],
+        state_delta_for_room: Dict[str, DeltaState],
+        new_forward_extremities: Dict[str, Set[str]],
+        backfilled: bool,
+    ) -> None:
+        """Persist the events, alongside updates to the current state and forward
+        extremities of their rooms, in a single transaction.
+        """
+        events_per_persist_transaction.observe(len(events_and_contexts))
+        rooms_per_persist_transaction.observe(
+            len({event.room_id for event, _ in events_and_contexts})
+        )
+
+        await self.persist_events_store._persist_events_and_state_updates(
+            events_and_contexts,
+            state_delta_for_room=state_delta_for_room,
+            new_forward_extremities=new_forward_extremities,
+            use_negative_stream_ordering=backfilled,
+            inhibit_local_membership_updates=backfilled,
+        )
+
+    async def _resume_extremity_maintenance(self) -> None:
+        """Queue up the recalculations of forward extremities and current state
+        which were still pending when we last stopped.
+        """
+        room_ids = (
+            await self.persist_events_store.get_rooms_awaiting_extremity_maintenance()
+        )
+        for room_id in room_ids:
+            if self._events_shard_config.get_instance(room_id) != self._instance_name:
+                continue
+
+            logger.info("Resuming extremity maintenance of room %s", room_id)
+            self._queue_extremity_maintenance(room_id, [])
+
+    def _queue_extremity_maintenance(
+        self, room_id: str, events_and_contexts: List[Tuple[EventBase, EventContext]]
+    ) -> None:
+        """Queue up a recalculation of the forward extremities and current state of
+        the room, which must already have been marked as awaiting it in the
+        database.
+        """
+        self._rooms_awaiting_maintenance.add(room_id)
+
+        # We're being called from the room's queue, so can't wait for this.
+        run_as_background_process(
+            "queue_extremity_maintenance",
+            self._event_persist_queue.add_to_queue,
+            room_id,
+            _MaintainExtremitiesTask(
+                events_and_contexts=list(events_and_contexts),
+                queued_at=self._clock.time(),
+            ),
+        )
+
+    def _retry_extremity_maintenance(
+        self, room_id: str, task: _MaintainExtremitiesTask
+    ) -> None:
+        """Queue up a failed recalculation of the forward extremities and current
+        state of the room again, after a backoff.
+        """
+        delay = min(
+            EXTREMITY_MAINTENANCE_RETRY_DELAY_SECONDS * 2**task.failures,
+            EXTREMITY_MAINTENANCE_MAX_RETRY_DELAY_SECONDS,
+        )
+        task.failures += 1
+        logger.info("Retrying extremity maintenance of room %s in %ds", room_id, delay)
+        self._clock.call_later(
+            delay,
+            run_as_background_process,
+            "retry_extremity_maintenance",
+            self._event_persist_queue.add_to_queue,
+            room_id,
+            task,
+        )
+
+    async def _maintain_extremities(
+        self, room_id: str, task: _MaintainExtremitiesTask
+    ) -> None:
+        """Callback for the _event_persist_queue
+
+        Recalculates the current state of a room from its forward extremities,
+        pruning the forward extremities if possible, and persists both.
+        """
+        latest_event_ids = await self.main_store.get_latest_event_ids_in_room(room_id)
+        new_latest_event_ids = set(latest_event_ids)
+
+        event_id_to_state_group = dict(
+            await self.main_store._get_state_group_for_events(latest_event_ids)
+        )
+        state_groups = set(event_id_to_state_group.values())
+        state_groups_map = await self.state_store._get_state_for_groups(state_groups)
+
+        current_state: StateMap[str]
+        if len(state_groups) == 1:
+            current_state = state_groups_map[state_groups.pop()]
+        else:
+            # Avoid a circular import.
+            from synapse.state import StateResolutionStore
+
+            room_version = await self.main_store.get_room_version_id(room_id)
+            res = await self._state_resolution_handler.resolve_state_groups(
+                room_id,
+                room_version,
+                state_groups_map,
+                {ev.event_id: ev for ev, _ in task.events_and_contexts},
+                state_res_store=StateResolutionStore(self.main_store),
+            )
+            state_resolutions_during_persistence.inc()
+
+            if (
+                task.events_and_contexts
+                and res.state_group
+                and res.state_group in state_groups
+            ):
+                new_latest_event_ids = await self._prune_extremities(
+                    room_id,
+                    new_latest_event_ids,
+                    res.state_group,
+                    event_id_to_state_group,
+                    task.events_and_contexts,
+                )
+
+            current_state = await res.get_state(self._state_controller)
+
+        delta = await self._calculate_state_delta(room_id, current_state)
+        is_still_joined = await self._is_server_still_joined(
+            room_id, task.events_and_contexts, delta
+        )
+        if not is_still_joined:
+            logger.info("Server no longer in room %s", room_id)
+            delta.no_longer_in_room = True
+
+        await self.persist_events_store.update_current_state(
+            room_id,
+            delta,
+            new_forward_extremities=(
+                new_latest_event_ids
+                if new_latest_event_ids != latest_event_ids
+                else None
+            ),
+        )
+
+        self._rooms_awaiting_maintenance.discard(room_id)
+        current_state_lag_time.observe(self._clock.time() - task.queued_at)
+
     async def _calculate_new_extremities(
         self,
         room_id: str,
@@ -799,7 +1232,8 @@ class EventsPersistenceStorageController:
         events_context: List[Tuple[EventBase, EventContext]],
         old_latest_event_ids: AbstractSet[str],
         new_latest_event_ids: Set[str],
-    ) -> Tuple[Optional[StateMap[str]], Optional[StateMap[str]], Set[str]]:
+        defer_state_res: bool = False,
+    ) -> Optional[Tuple[Optional[StateMap[str]], Optional[StateMap[str]], Set[str]]]:
         """Calculate the current state dict after adding some new events to
         a room
 
@@ -816,6 +1250,9 @@ class EventsPersistenceStorageController:
             new_latest_event_ids :
                 the new forward extremities for the room.
 
+            defer_state_res: whether to give up if calculating the new current
+                state requires state resolution.
+
         Returns:
             Returns a tuple of two state maps and a set of new forward
             extremities.
@@ -832,6 +1269,9 @@ class EventsPersistenceStorageController:
             already been calculated. Conversely if we do know the delta then
             the new current state is only returned if we've already calculated
             it.
+
+            Returns None if `defer_state_res` is set and calculating the new
+            current state requires state resolution.
         """
         # Map from (prev state group, new state group) -> delta state dict
         state_group_deltas = {}
@@ -917,6 +1357,8 @@ class EventsPersistenceStorageController:
             return state_groups_map[new_state_groups.pop()], None, new_latest_event_ids
 
         # Ok, we need to defer to the state handler to resolve our state sets.
+        if defer_state_res:
+            return None
 
         state_groups = {sg: state_groups_map[sg] for sg in new_state_groups}
 
@@ -69,6 +69,7 @@ from .signatures import SignatureStore
 from .state import StateStore
 from .stats import StatsStore
 from .stream import StreamWorkerStore
+from .sync_snapshots import SyncSnapshotsWorkerStore
 from .tags import TagsStore
 from .task_scheduler import TaskSchedulerWorkerStore
 from .transactions import TransactionWorkerStore
@@ -129,6 +130,7 @@ class DataStore(
     LockStore,
     SessionStore,
     TaskSchedulerWorkerStore,
+    SyncSnapshotsWorkerStore,
 ):
     def __init__(
         self,
@@ -744,6 +744,22 @@ class AccountDataWorkerStore(PushRulesWorkerStore, CacheInvalidationWorkerStore)
             self._invalidate_cache_and_stream(txn, self.ignored_by, (ignored_user_id,))
         self._invalidate_cache_and_stream(txn, self.ignored_users, (user_id,))
 
+        self._delete_sync_snapshots_for_ignorer_txn(txn, user_id)
+
+    def _delete_sync_snapshots_for_ignorer_txn(
+        self, txn: LoggingTransaction, user_id: str
+    ) -> None:
+        """Delete the initial sync snapshots of a user whose ignored users have
+        changed.
+
+        Snapshots are rechecked against the ignored users when they are used, but
+        that only catches events which have become hidden: events from users who
+        are no longer ignored would never be added back.
+        """
+        self.db_pool.simple_delete_txn(
+            txn, table="sync_snapshots", keyvalues={"user_id": user_id}
+        )
+
     async def remove_account_data_for_user(
         self,
         user_id: str,
@@ -825,6 +841,9 @@ class AccountDataWorkerStore(PushRulesWorkerStore, CacheInvalidationWorkerStore)
                 # Invalidate for this user the cache tracking ignored users.
                 self._invalidate_cache_and_stream(txn, self.ignored_users, (user_id,))
 
+                if previously_ignored_users:
+                    self._delete_sync_snapshots_for_ignorer_txn(txn, user_id)
+
             return True
 
         async with self._account_data_id_gen.get_next() as next_id:
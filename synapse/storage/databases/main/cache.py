@@ -367,6 +367,8 @@ class CacheInvalidationWorkerStore(SQLBaseStore):
         """
 
         self._invalidate_local_get_event_cache_all()  # type: ignore[attr-defined]
+        self._invalidate_auth_dag_cache_for_room(room_id)  # type: ignore[attr-defined]
+        self._invalidate_chain_cover_index_cache_for_room(room_id)  # type: ignore[attr-defined]
 
         self._attempt_to_invalidate_cache("have_seen_event", (room_id,))
         self._attempt_to_invalidate_cache("get_latest_event_ids_in_room", (room_id,))
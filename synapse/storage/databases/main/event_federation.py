@@ -14,6 +14,8 @@
 import datetime
 import itertools
 import logging
+from array import array
+from bisect import bisect_right
 from queue import Empty, PriorityQueue
 from typing import (
     TYPE_CHECKING,
@@ -74,8 +76,27 @@ pdus_pruned_from_federation_queue = Counter(
     "pruned due to the queue getting too long",
 )
 
+auth_dag_cache_lookups = Counter(
+    "synapse_storage_auth_dag_cache_lookups",
+    "Number of auth chain difference calculations which could (hit) or could not "
+    "(miss) be done entirely from the auth DAG cache",
+    ["result"],
+)
+
+chain_cover_index_cache_lookups = Counter(
+    "synapse_storage_chain_cover_index_cache_lookups",
+    "Number of auth chain queries which could be answered from the in-memory chain "
+    "cover index of the room as it was (hit), after updating it from the database "
+    "(update), or not at all (miss)",
+    ["result"],
+)
+
 logger = logging.getLogger(__name__)
 
+# The maximum number of events in a room's chain cover index for us to keep a copy
+# of it in memory.
+MAX_CACHED_CHAIN_COVER_INDEX_SIZE = 50000
+
 # Parameters controlling exponential backoff between backfill failures.
 # After the first failure to backfill, we wait 2 hours before trying again. If the
 # second attempt fails, we wait 4 hours before trying again. If the third attempt fails,
@@ -110,6 +131,190 @@ class BackfillQueueNavigationItem:
     type: str
 
 
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class AuthDagNode:
+    """An event in the auth DAG of a room."""
+
+    auth_event_ids: Tuple[str, ...]
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _RoomAuthDag:
+    """The part of the auth DAG of a room we have cached.
+
+    The auth events of every event in `nodes` are also in `nodes`, so the full auth
+    chain of any event in `nodes` can be worked out without going to the database.
+    As an event's auth events never change, this only ever needs to be extended
+    with new events.
+    """
+
+    nodes: Dict[str, AuthDagNode] = attr.Factory(dict)
+
+    # The number of auth chain difference calculations for the room which could
+    # and could not be done from `nodes`.
+    hits: int = 0
+    misses: int = 0
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _RoomChainCoverIndex:
+    """An in-memory copy of (part of) the chain cover index of a room, used to
+    answer auth chain queries without going to the database.
+
+    See docs/auth_chain_difference_algorithm.md for how the index works. Events are
+    only ever appended to chains, and links are only ever added from new events,
+    so this only needs extending as the room's events are persisted.
+    """
+
+    # Map from event ID to its chain ID and sequence number.
+    event_to_chain: Dict[str, Tuple[int, int]] = attr.Factory(dict)
+
+    # Map from chain ID to the event IDs in the chain, where the event with
+    # sequence number `n` is at index `n - 1`.
+    chains: Dict[int, List[str]] = attr.Factory(dict)
+
+    # Map from chain ID to the links from the chain, as parallel arrays of the
+    # origin sequence number, target chain ID and target sequence number, ordered
+    # by origin sequence number.
+    links: Dict[int, Tuple["array[int]", "array[int]", "array[int]"]] = attr.Factory(
+        dict
+    )
+
+    def __len__(self) -> int:
+        return len(self.event_to_chain)
+
+    def add(
+        self,
+        event_rows: Iterable[Tuple[str, int, int]],
+        link_rows: Iterable[Tuple[int, int, int, int]],
+    ) -> bool:
+        """Extends the index with rows from `event_auth_chains` and
+        `event_auth_chain_links`. Rows we already have are ignored, as are links
+        from events we don't have.
+
+        Returns:
+            False if the rows don't follow on from the index, in which case it
+            must be discarded.
+        """
+        # The number of events we had in each chain we are adding to.
+        old_lengths: Dict[int, int] = {}
+
+        for event_id, chain_id, sequence_number in sorted(
+            event_rows, key=lambda row: (row[1], row[2])
+        ):
+            chain = self.chains.setdefault(chain_id, [])
+            old_lengths.setdefault(chain_id, len(chain))
+
+            if sequence_number <= len(chain):
+                continue
+            if sequence_number != len(chain) + 1:
+                # There's a gap in the chain.
+                return False
+
+            chain.append(event_id)
+            self.event_to_chain[event_id] = (chain_id, sequence_number)
+
+        for origin_chain_id, origin_seq, target_chain_id, target_seq in sorted(
+            link_rows
+        ):
+            # We only want the links from the events we've just added.
+            old_length = old_lengths.get(origin_chain_id)
+            if old_length is None or origin_seq <= old_length:
+                continue
+            if origin_seq > len(self.chains[origin_chain_id]):
+                continue
+
+            links = self.links.get(origin_chain_id)
+            if links is None:
+                links = self.links[origin_chain_id] = (
+                    array("q"),
+                    array("q"),
+                    array("q"),
+                )
+            origin_seqs, target_chain_ids, target_seqs = links
+            origin_seqs.append(origin_seq)
+            target_chain_ids.append(target_chain_id)
+            target_seqs.append(target_seq)
+
+        return True
+
+    def _get_linked_chains(self, event_chains: Dict[int, int]) -> Dict[int, int]:
+        """Given a map from chain ID to sequence number, returns a map from chain
+        ID to the maximum sequence number reachable via links from those events.
+        """
+        chains: Dict[int, int] = {}
+        for chain_id, seq in event_chains.items():
+            links = self.links.get(chain_id)
+            if links is None:
+                continue
+
+            origin_seqs, target_chain_ids, target_seqs = links
+            # Links are only followed from the events in the auth chain.
+            for idx in range(bisect_right(origin_seqs, seq)):
+                target_chain_id = target_chain_ids[idx]
+                if target_seqs[idx] > chains.get(target_chain_id, 0):
+                    chains[target_chain_id] = target_seqs[idx]
+
+        return chains
+
+    def _get_event_chains(self, event_ids: Iterable[str]) -> Dict[int, int]:
+        """Returns a map from chain ID to the maximum sequence number of the given
+        events in that chain.
+        """
+        event_chains: Dict[int, int] = {}
+        for event_id in event_ids:
+            chain_id, seq = self.event_to_chain[event_id]
+            if seq > event_chains.get(chain_id, 0):
+                event_chains[chain_id] = seq
+        return event_chains
+
+    def get_auth_chain_ids(
+        self, event_ids: Collection[str], include_given: bool
+    ) -> Set[str]:
+        """Calculates the auth chain IDs of the given events, which must all be in
+        the index. c.f. `_get_auth_chain_ids_using_cover_index_txn`
+        """
+        event_chains = self._get_event_chains(event_ids)
+        chains = self._get_linked_chains(event_chains)
+
+        # The given events' own chains are only reachable from below the events.
+        for chain_id, seq in event_chains.items():
+            chains[chain_id] = max(seq - 1, chains.get(chain_id, 0))
+
+        results = set(event_ids) if include_given else set()
+        for chain_id, max_seq in chains.items():
+            results.update(self.chains[chain_id][:max_seq])
+
+        return results
+
+    def get_auth_chain_difference(self, state_sets: List[Set[str]]) -> Set[str]:
+        """Calculates the auth chain difference of the given state sets, whose
+        events must all be in the index. c.f.
+        `_get_auth_chain_difference_using_cover_index_txn`
+        """
+        # Corresponds to `state_sets`, except as a map from chain ID to max
+        # sequence number reachable from the state set.
+        set_to_chain: List[Dict[int, int]] = []
+        for state_set in state_sets:
+            event_chains = self._get_event_chains(state_set)
+            chains = self._get_linked_chains(event_chains)
+            for chain_id, seq in event_chains.items():
+                chains[chain_id] = max(seq, chains.get(chain_id, 0))
+            set_to_chain.append(chains)
+
+        # Events between the minimum sequence number reachable from *all* state
+        # sets and the maximum reachable from *any* state set are in the auth
+        # chain difference.
+        result: Set[str] = set()
+        for chain_id in set().union(*set_to_chain):
+            min_seq = min(chains.get(chain_id, 0) for chains in set_to_chain)
+            max_seq = max(chains.get(chain_id, 0) for chains in set_to_chain)
+            if min_seq < max_seq:
+                result.update(self.chains[chain_id][min_seq:max_seq])
+
+        return result
+
+
 class _NoChainCoverIndex(Exception):
     def __init__(self, room_id: str):
         super().__init__("Unexpectedly no chain cover for events in %s" % (room_id,))
@@ -140,6 +345,32 @@ class EventFederationWorkerStore(SignatureWorkerStore, EventsWorkerStore, SQLBas
             500000, "_event_auth_cache", size_callback=len
         )
 
+        # Cache of room ID to the part of its auth DAG we know about, sized by the
+        # number of events.
+        self._auth_dag_cache: LruCache[str, _RoomAuthDag] = LruCache(
+            500000, "_auth_dag_cache", size_callback=lambda dag: len(dag.nodes)
+        )
+        # The number of times the auth DAG cache of each room has been invalidated,
+        # so that we don't cache a DAG fetched from before an invalidation.
+        self._auth_dag_cache_invalidations: Dict[str, int] = {}
+
+        # Cache of room ID to an in-memory copy of its chain cover index, sized by
+        # the number of events.
+        self._chain_cover_index_cache: LruCache[str, _RoomChainCoverIndex] = LruCache(
+            500000, "_chain_cover_index_cache", size_callback=len
+        )
+
+        # The number of times the chain cover index cache of each room has been
+        # invalidated, so that we don't cache rows fetched from before an
+        # invalidation.
+        self._chain_cover_index_cache_invalidations: Dict[str, int] = {}
+
+        # Rooms whose chain cover index is too big to keep in memory, or has gaps
+        # in it, so can't be cached.
+        self._rooms_with_uncached_chain_cover_index: LruCache[str, bool] = LruCache(
+            10000, "_rooms_with_uncached_chain_cover_index"
+        )
+
         self._clock.looping_call(self._get_stats_for_federation_staging, 30 * 1000)
 
         if isinstance(self.database_engine, PostgresEngine):
@@ -190,6 +421,10 @@ class EventFederationWorkerStore(SignatureWorkerStore, EventsWorkerStore, SQLBas
             set of event_ids
         """
 
+        index = await self._get_chain_cover_index(room_id, event_ids)
+        if index is not None:
+            return index.get_auth_chain_ids(event_ids, include_given)
+
         # Check if we have indexed the room so we can use the chain cover
         # algorithm.
         room = await self.get_room(room_id)  # type: ignore[attr-defined]
@@ -408,6 +643,341 @@ class EventFederationWorkerStore(SignatureWorkerStore, EventsWorkerStore, SQLBas
             The set of the difference in auth chains.
         """
 
+        initial_events = set(state_sets[0]).union(*state_sets[1:])
+
+        index = self._chain_cover_index_cache.get(room_id)
+        if index is not None and initial_events.issubset(index.event_to_chain):
+            chain_cover_index_cache_lookups.labels("hit").inc()
+            return index.get_auth_chain_difference(state_sets)
+
+        dag = self._auth_dag_cache.get(room_id)
+        if dag is not None and initial_events.issubset(dag.nodes):
+            dag.hits += 1
+            auth_dag_cache_lookups.labels("hit").inc()
+            return _auth_chain_difference_from_dag(dag.nodes, state_sets)
+
+        index = await self._get_chain_cover_index(room_id, initial_events)
+        if index is not None:
+            return index.get_auth_chain_difference(state_sets)
+
+        auth_dag_cache_lookups.labels("miss").inc()
+        dag = await self._extend_auth_dag_cache(room_id, initial_events)
+        if dag is not None:
+            dag.misses += 1
+            logger.debug(
+                "Auth DAG cache for %s: %d events, %d hits, %d misses",
+                room_id,
+                len(dag.nodes),
+                dag.hits,
+                dag.misses,
+            )
+            return _auth_chain_difference_from_dag(dag.nodes, state_sets)
+
+        return await self._get_auth_chain_difference_from_db(room_id, state_sets)
+
+    async def _get_chain_cover_index(
+        self, room_id: str, event_ids: Collection[str]
+    ) -> Optional[_RoomChainCoverIndex]:
+        """Get the in-memory chain cover index of the room, updating it from the
+        database if it doesn't include the given events.
+
+        Returns:
+            The chain cover index of the room, or None if we don't have a chain
+            cover index for all the events, or it is too big to keep in memory.
+        """
+        index = self._chain_cover_index_cache.get(room_id)
+        if index is not None and index.event_to_chain.keys() >= set(event_ids):
+            chain_cover_index_cache_lookups.labels("hit").inc()
+            return index
+
+        if self._rooms_with_uncached_chain_cover_index.get(room_id):
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        room = await self.get_room(room_id)  # type: ignore[attr-defined]
+        if not room or not room["has_auth_chain_index"]:
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        invalidations = self._chain_cover_index_cache_invalidations.get(room_id, 0)
+        rows = await self.db_pool.runInteraction(
+            "get_chain_cover_index_rows",
+            self._get_chain_cover_index_rows_txn,
+            room_id,
+            index,
+            event_ids,
+        )
+        if rows is None:
+            self._rooms_with_uncached_chain_cover_index.set(room_id, True)
+            self._chain_cover_index_cache.invalidate(room_id)
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        if self._chain_cover_index_cache_invalidations.get(room_id, 0) != invalidations:
+            # Events in the room were deleted while we were fetching, so the rows
+            # may not match the index any more.
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        if index is None:
+            # We may have been racing with another fetch of the whole index, so
+            # make sure we're adding to the latest copy. (Otherwise the rows
+            # follow on from `index`, so must be added to it, even if it has been
+            # evicted from the cache meanwhile.)
+            index = self._chain_cover_index_cache.get(room_id)
+            if index is None:
+                index = _RoomChainCoverIndex()
+        event_rows, link_rows = rows
+        if not index.add(event_rows, link_rows):
+            logger.warning("Found a gap in the chain cover index of %s", room_id)
+            self._rooms_with_uncached_chain_cover_index.set(room_id, True)
+            self._chain_cover_index_cache.invalidate(room_id)
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        if len(index) > MAX_CACHED_CHAIN_COVER_INDEX_SIZE:
+            self._rooms_with_uncached_chain_cover_index.set(room_id, True)
+            self._chain_cover_index_cache.invalidate(room_id)
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        # (Re-)insert the entry so that its size gets updated.
+        self._chain_cover_index_cache.set(room_id, index)
+
+        if not index.event_to_chain.keys() >= set(event_ids):
+            # Some of the events don't have a chain cover index.
+            chain_cover_index_cache_lookups.labels("miss").inc()
+            return None
+
+        chain_cover_index_cache_lookups.labels("update").inc()
+        return index
+
+    def _get_chain_cover_index_rows_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        index: Optional[_RoomChainCoverIndex],
+        event_ids: Collection[str],
+    ) -> Optional[Tuple[List[Tuple[str, int, int]], List[Tuple[int, int, int, int]]]]:
+        """Fetch the rows of the chain cover index of the room which are needed to
+        extend the given in-memory index (if any) to include the given events.
+
+        Returns:
+            The rows of `event_auth_chains` and `event_auth_chain_links` to add to
+            the index, or None if the index of the room is too big to keep in
+            memory.
+        """
+        event_rows: List[Tuple[str, int, int]] = []
+        link_rows: List[Tuple[int, int, int, int]] = []
+
+        if index is None:
+            # Fetch the whole index for the room.
+            txn.execute(
+                """
+                SELECT event_id, chain_id, sequence_number
+                FROM event_auth_chains
+                INNER JOIN events USING (event_id)
+                WHERE room_id = ?
+                LIMIT ?
+                """,
+                (room_id, MAX_CACHED_CHAIN_COVER_INDEX_SIZE + 1),
+            )
+            event_rows = cast(List[Tuple[str, int, int]], txn.fetchall())
+            if len(event_rows) > MAX_CACHED_CHAIN_COVER_INDEX_SIZE:
+                return None
+
+            link_rows = cast(
+                List[Tuple[int, int, int, int]],
+                self.db_pool.simple_select_many_txn(
+                    txn,
+                    table="event_auth_chain_links",
+                    column="origin_chain_id",
+                    iterable={chain_id for _, chain_id, _ in event_rows},
+                    keyvalues={},
+                    retcols=(
+                        "origin_chain_id",
+                        "origin_sequence_number",
+                        "target_chain_id",
+                        "target_sequence_number",
+                    ),
+                ),
+            )
+            return event_rows, link_rows
+
+        # Otherwise we look up the chains of the missing events, and extend each
+        # chain up to the event, along with the chains they link to (and so on).
+        missing_event_ids = [
+            event_id for event_id in event_ids if event_id not in index.event_to_chain
+        ]
+        new_chain_rows = cast(
+            List[Tuple[int, int]],
+            self.db_pool.simple_select_many_txn(
+                txn,
+                table="event_auth_chains",
+                column="event_id",
+                iterable=missing_event_ids,
+                keyvalues={},
+                retcols=("chain_id", "sequence_number"),
+            ),
+        )
+
+        # Map from chain ID to the number of events we now have in it.
+        chain_lengths: Dict[int, int] = {}
+        known_chains = index.chains
+
+        def get_length(chain_id: int) -> int:
+            length = chain_lengths.get(chain_id)
+            if length is None:
+                length = len(known_chains.get(chain_id, ()))
+            return length
+
+        while new_chain_rows:
+            chains_to_extend = {
+                chain_id
+                for chain_id, seq in new_chain_rows
+                if seq > get_length(chain_id)
+            }
+            new_chain_rows = []
+
+            for chain_id in chains_to_extend:
+                length = get_length(chain_id)
+                txn.execute(
+                    """
+                    SELECT event_id, chain_id, sequence_number
+                    FROM event_auth_chains
+                    WHERE chain_id = ? AND sequence_number > ?
+                    """,
+                    (chain_id, length),
+                )
+                rows = cast(List[Tuple[str, int, int]], txn.fetchall())
+                event_rows.extend(rows)
+                chain_lengths[chain_id] = length + len(rows)
+
+                txn.execute(
+                    """
+                    SELECT
+                        origin_chain_id, origin_sequence_number,
+                        target_chain_id, target_sequence_number
+                    FROM event_auth_chain_links
+                    WHERE origin_chain_id = ? AND origin_sequence_number > ?
+                    """,
+                    (chain_id, length),
+                )
+                for (
+                    origin_chain_id,
+                    origin_sequence_number,
+                    target_chain_id,
+                    target_sequence_number,
+                ) in txn:
+                    link_rows.append(
+                        (
+                            origin_chain_id,
+                            origin_sequence_number,
+                            target_chain_id,
+                            target_sequence_number,
+                        )
+                    )
+                    new_chain_rows.append((target_chain_id, target_sequence_number))
+
+        if len(index) + len(event_rows) > MAX_CACHED_CHAIN_COVER_INDEX_SIZE:
+            return None
+
+        return event_rows, link_rows
+
+    def _invalidate_chain_cover_index_cache_for_room(self, room_id: str) -> None:
+        self._chain_cover_index_cache_invalidations[room_id] = (
+            self._chain_cover_index_cache_invalidations.get(room_id, 0) + 1
+        )
+        self._chain_cover_index_cache.invalidate(room_id)
+        self._rooms_with_uncached_chain_cover_index.invalidate(room_id)
+
+    async def _extend_auth_dag_cache(
+        self, room_id: str, event_ids: Collection[str]
+    ) -> Optional[_RoomAuthDag]:
+        """Add the auth chains of the given events to the auth DAG cache of the
+        room.
+
+        Returns:
+            The cached auth DAG of the room, or None if we couldn't find the full
+            auth chains of the events.
+        """
+        invalidations = self._auth_dag_cache_invalidations.get(room_id, 0)
+        dag = self._auth_dag_cache.get(room_id)
+        if dag is None:
+            dag = _RoomAuthDag()
+
+        missing = [event_id for event_id in event_ids if event_id not in dag.nodes]
+        auth_chain_ids = await self.get_auth_chain_ids(
+            room_id, missing, include_given=True
+        )
+        to_fetch = auth_chain_ids.difference(dag.nodes)
+
+        new_nodes = await self.db_pool.runInteraction(
+            "get_auth_dag_nodes", self._get_auth_dag_nodes_txn, room_id, to_fetch
+        )
+
+        if self._auth_dag_cache_invalidations.get(room_id, 0) != invalidations:
+            # Events in the room were deleted while we were fetching, so what we
+            # have may include some of them.
+            return None
+
+        # The auth DAG of a room is only cached with the full auth chain of each
+        # event in it.
+        if len(new_nodes) != len(to_fetch) or any(
+            auth_event_id not in dag.nodes and auth_event_id not in new_nodes
+            for node in new_nodes.values()
+            for auth_event_id in node.auth_event_ids
+        ):
+            return None
+
+        dag.nodes.update(new_nodes)
+        if not dag.nodes.keys() >= set(event_ids):
+            # Some of the events aren't in the database.
+            return None
+
+        # Re-insert the entry so that its size gets updated.
+        self._auth_dag_cache.set(room_id, dag)
+
+        return dag
+
+    def _get_auth_dag_nodes_txn(
+        self, txn: LoggingTransaction, room_id: str, event_ids: Collection[str]
+    ) -> Dict[str, AuthDagNode]:
+        auth_event_ids: Dict[str, List[str]] = {}
+        found_event_ids: List[str] = []
+        for batch in batch_iter(event_ids, 1000):
+            clause, args = make_in_list_sql_clause(
+                txn.database_engine, "event_id", batch
+            )
+            txn.execute(
+                "SELECT event_id, auth_id FROM event_auth WHERE " + clause, args
+            )
+            for event_id, auth_id in txn:
+                auth_event_ids.setdefault(event_id, []).append(auth_id)
+
+            # Only include the events we have in the room.
+            txn.execute(
+                "SELECT event_id FROM events WHERE room_id = ? AND " + clause,
+                [room_id] + args,
+            )
+            found_event_ids.extend(event_id for event_id, in txn)
+
+        return {
+            event_id: AuthDagNode(
+                auth_event_ids=tuple(auth_event_ids.get(event_id, ()))
+            )
+            for event_id in found_event_ids
+        }
+
+    def _invalidate_auth_dag_cache_for_room(self, room_id: str) -> None:
+        self._auth_dag_cache_invalidations[room_id] = (
+            self._auth_dag_cache_invalidations.get(room_id, 0) + 1
+        )
+        self._auth_dag_cache.invalidate(room_id)
+
+    async def _get_auth_chain_difference_from_db(
+        self, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
         # Check if we have indexed the room so we can use the chain cover
         # algorithm.
         room = await self.get_room(room_id)  # type: ignore[attr-defined]
@@ -2008,6 +2578,28 @@ class EventFederationWorkerStore(SignatureWorkerStore, EventsWorkerStore, SQLBas
         oldest_pdu_in_federation_staging.set(age)
 
 
+def _auth_chain_difference_from_dag(
+    nodes: Dict[str, AuthDagNode], state_sets: List[Set[str]]
+) -> Set[str]:
+    """Calculates the auth chain difference of the given state sets, all of whose
+    full auth chains must be in `nodes`.
+    """
+    auth_chains = []
+    for state_set in state_sets:
+        auth_chain: Set[str] = set()
+        stack = list(state_set)
+        while stack:
+            event_id = stack.pop()
+            if event_id in auth_chain:
+                continue
+            auth_chain.add(event_id)
+            stack.extend(nodes[event_id].auth_event_ids)
+        auth_chains.append(auth_chain)
+
+    common = auth_chains[0].intersection(*auth_chains[1:])
+    return auth_chains[0].union(*auth_chains[1:]) - common
+
+
 class EventFederationStore(EventFederationWorkerStore):
     """Responsible for storing and serving up the various graphs associated
     with an event. Including the main event graph and the auth chains for an
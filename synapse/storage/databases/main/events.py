@@ -1019,17 +1019,84 @@ class PersistEventsStore:
         self,
         room_id: str,
         state_delta: DeltaState,
+        new_forward_extremities: Optional[Set[str]] = None,
     ) -> None:
-        """Update the current state stored in the datatabase for the given room"""
+        """Update the current state stored in the datatabase for the given room
+
+        Args:
+            room_id:
+            state_delta: The delta to apply to the current state of the room.
+            new_forward_extremities: If given, the new forward extremities of the
+                room.
+        """
 
         async with self._stream_id_gen.get_next() as stream_ordering:
             await self.db_pool.runInteraction(
                 "update_current_state",
-                self._update_current_state_txn,
-                state_delta_by_room={room_id: state_delta},
+                self._update_current_state_and_extremities_txn,
+                room_id=room_id,
+                state_delta=state_delta,
+                new_forward_extremities=new_forward_extremities,
                 stream_id=stream_ordering,
             )
 
+        if new_forward_extremities is not None:
+            self.store.get_latest_event_ids_in_room.prefill(
+                (room_id,), frozenset(new_forward_extremities)
+            )
+
+    def _update_current_state_and_extremities_txn(
+        self,
+        txn: LoggingTransaction,
+        room_id: str,
+        state_delta: DeltaState,
+        new_forward_extremities: Optional[Set[str]],
+        stream_id: int,
+    ) -> None:
+        if new_forward_extremities is not None:
+            self._update_forward_extremities_txn(
+                txn,
+                new_forward_extremities={room_id: new_forward_extremities},
+                max_stream_order=stream_id,
+            )
+            self.store._invalidate_cache_and_stream(
+                txn, self.store.get_latest_event_ids_in_room, (room_id,)
+            )
+
+        self._update_current_state_txn(
+            txn, state_delta_by_room={room_id: state_delta}, stream_id=stream_id
+        )
+
+        # The current state now matches the forward extremities.
+        self.db_pool.simple_delete_txn(
+            txn,
+            table="rooms_awaiting_extremity_maintenance",
+            keyvalues={"room_id": room_id},
+        )
+
+    async def mark_room_awaiting_extremity_maintenance(self, room_id: str) -> None:
+        """Record that events of the room are being persisted without
+        recalculating its forward extremities and current state, which is done
+        by a later call to `update_current_state`.
+        """
+        await self.db_pool.simple_upsert(
+            table="rooms_awaiting_extremity_maintenance",
+            keyvalues={"room_id": room_id},
+            values={},
+            desc="mark_room_awaiting_extremity_maintenance",
+        )
+
+    async def get_rooms_awaiting_extremity_maintenance(self) -> List[str]:
+        """Get the rooms marked by `mark_room_awaiting_extremity_maintenance` whose
+        forward extremities and current state haven't been updated since.
+        """
+        return await self.db_pool.simple_select_onecol(
+            table="rooms_awaiting_extremity_maintenance",
+            keyvalues=None,
+            retcol="room_id",
+            desc="get_rooms_awaiting_extremity_maintenance",
+        )
+
     def _update_current_state_txn(
         self,
         txn: LoggingTransaction,
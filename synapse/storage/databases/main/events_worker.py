@@ -1399,6 +1399,10 @@ class EventsWorkerStore(SQLBaseStore):
                 original_ev, redactions, event_map
             )
 
+            # Most cached events are only ever looked at for their top-level
+            # fields, so hold on to the rest as JSON until it is needed.
+            original_ev.drop_decoded_fields(fetched_events[event_id].json)
+
             cache_entry = EventCacheEntry(
                 event=original_ev, redacted_event=redacted_event
             )
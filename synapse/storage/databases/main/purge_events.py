@@ -447,7 +447,9 @@ class PurgeEventsStore(StateGroupWorkerStore, CacheInvalidationWorkerStore):
             "room_stats_state",
             "room_stats_current",
             "room_stats_earliest_token",
+            "rooms_awaiting_extremity_maintenance",
             "stream_ordering_to_exterm",
+            "sync_snapshots",
             "users_in_public_rooms",
             "users_who_share_private_rooms",
             # no useful index, but let's clear them anyway
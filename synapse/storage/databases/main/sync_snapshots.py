@@ -0,0 +1,188 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import TYPE_CHECKING, Collection, Dict, List, Optional, Tuple, cast
+
+import attr
+
+from synapse.storage._base import SQLBaseStore, db_to_json
+from synapse.storage.database import (
+    DatabasePool,
+    LoggingDatabaseConnection,
+    LoggingTransaction,
+    make_in_list_sql_clause,
+)
+from synapse.types import JsonDict
+from synapse.util import json_encoder
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+
+
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class RoomSyncSnapshot:
+    """The parts of a joined room's entry in an initial sync which are expensive to
+    compute, as of a given position in the room stream.
+
+    Attributes:
+        room_id
+        stream_ordering: The room stream position the snapshot was computed at. The
+            snapshot is only valid while the room has no events after this position.
+        timeline_event_ids: The IDs of the events in the timeline, in order.
+        prev_batch: The serialised room stream token to paginate back from.
+        limited: Whether the timeline was limited.
+        state_event_ids: The IDs of the state events to return for the room.
+        summary: The room summary, if one was computed.
+    """
+
+    room_id: str
+    stream_ordering: int
+    timeline_event_ids: List[str]
+    prev_batch: str
+    limited: bool
+    state_event_ids: List[str]
+    summary: Optional[JsonDict]
+
+    def to_json(self) -> JsonDict:
+        return {
+            "timeline": self.timeline_event_ids,
+            "prev_batch": self.prev_batch,
+            "limited": self.limited,
+            "state": self.state_event_ids,
+            "summary": self.summary,
+        }
+
+    @classmethod
+    def from_json(
+        cls, room_id: str, stream_ordering: int, json: JsonDict
+    ) -> "RoomSyncSnapshot":
+        return cls(
+            room_id=room_id,
+            stream_ordering=stream_ordering,
+            timeline_event_ids=json["timeline"],
+            prev_batch=json["prev_batch"],
+            limited=json["limited"],
+            state_event_ids=json["state"],
+            summary=json["summary"],
+        )
+
+
+class SyncSnapshotsWorkerStore(SQLBaseStore):
+    def __init__(
+        self,
+        database: DatabasePool,
+        db_conn: LoggingDatabaseConnection,
+        hs: "HomeServer",
+    ):
+        super().__init__(database, db_conn, hs)
+
+    async def get_sync_snapshots(
+        self, user_id: str, filter_key: str, max_stream_ordering: int
+    ) -> Dict[str, RoomSyncSnapshot]:
+        """Get the still-valid room snapshots for a user's initial sync.
+
+        A snapshot is only returned if no events have been persisted in the room
+        since it was taken.
+
+        Args:
+            user_id: The user to fetch the snapshots of.
+            filter_key: The key of the filter the snapshots must have been
+                computed with.
+            max_stream_ordering: Snapshots taken after this room stream position
+                are ignored.
+
+        Returns:
+            A map from room ID to its snapshot.
+        """
+
+        def get_sync_snapshots_txn(
+            txn: LoggingTransaction,
+        ) -> List[Tuple[str, int, str]]:
+            sql = """
+                SELECT s.room_id, s.stream_ordering, s.snapshot_json
+                FROM sync_snapshots AS s
+                WHERE s.user_id = ? AND s.filter_key = ? AND s.stream_ordering <= ?
+                    AND NOT EXISTS (
+                        SELECT 1 FROM events AS e
+                        WHERE e.room_id = s.room_id
+                            AND e.stream_ordering > s.stream_ordering
+                    )
+            """
+            txn.execute(sql, (user_id, filter_key, max_stream_ordering))
+            return cast(List[Tuple[str, int, str]], txn.fetchall())
+
+        rows = await self.db_pool.runInteraction(
+            "get_sync_snapshots", get_sync_snapshots_txn
+        )
+        return {
+            room_id: RoomSyncSnapshot.from_json(
+                room_id, stream_ordering, db_to_json(snapshot_json)
+            )
+            for room_id, stream_ordering, snapshot_json in rows
+        }
+
+    async def store_sync_snapshots(
+        self,
+        user_id: str,
+        filter_key: str,
+        snapshots: Collection[RoomSyncSnapshot],
+        joined_room_ids: Collection[str],
+    ) -> None:
+        """Store the room snapshots computed during an initial sync.
+
+        Snapshots for rooms the user is no longer joined to are removed, as are
+        snapshots computed with a different filter.
+
+        Args:
+            user_id: The user the snapshots belong to.
+            filter_key: The key of the filter the snapshots were computed with.
+            snapshots: The newly computed snapshots.
+            joined_room_ids: The rooms the user is currently joined to.
+        """
+
+        def store_sync_snapshots_txn(txn: LoggingTransaction) -> None:
+            self.db_pool.simple_upsert_many_txn(
+                txn,
+                table="sync_snapshots",
+                key_names=("user_id", "room_id"),
+                key_values=[(user_id, s.room_id) for s in snapshots],
+                value_names=("filter_key", "stream_ordering", "snapshot_json"),
+                value_values=[
+                    (filter_key, s.stream_ordering, json_encoder.encode(s.to_json()))
+                    for s in snapshots
+                ],
+            )
+
+            clause, args = make_in_list_sql_clause(
+                txn.database_engine, "room_id", joined_room_ids
+            )
+            txn.execute(
+                f"""
+                    DELETE FROM sync_snapshots
+                    WHERE user_id = ? AND (filter_key != ? OR NOT {clause})
+                """,
+                (user_id, filter_key, *args),
+            )
+
+        await self.db_pool.runInteraction(
+            "store_sync_snapshots", store_sync_snapshots_txn
+        )
+
+    async def delete_sync_snapshots_for_user(self, user_id: str) -> None:
+        """Remove all the sync snapshots of a user."""
+        await self.db_pool.simple_delete(
+            "sync_snapshots",
+            keyvalues={"user_id": user_id},
+            desc="delete_sync_snapshots_for_user",
+        )
@@ -16,6 +16,7 @@ import logging
 from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple, Union
 
 from synapse.logging.opentracing import tag_args, trace
+from synapse.metrics.background_process_metrics import wrap_as_background_process
 from synapse.storage._base import SQLBaseStore
 from synapse.storage.database import (
     DatabasePool,
@@ -274,6 +275,7 @@ class StateBackgroundUpdateStore(StateGroupBackgroundUpdateStore):
     STATE_GROUP_INDEX_UPDATE_NAME = "state_group_state_type_index"
     STATE_GROUPS_ROOM_INDEX_UPDATE_NAME = "state_groups_room_id_idx"
     STATE_GROUP_EDGES_UNIQUE_INDEX_UPDATE_NAME = "state_group_edges_unique_idx"
+    STATE_GROUP_COMPACTION_UPDATE_NAME = "state_group_compaction"
 
     CURRENT_STATE_EVENTS_STREAM_ORDERING_INDEX_UPDATE_NAME = (
         "current_state_events_stream_ordering_idx"
@@ -342,6 +344,200 @@ class StateBackgroundUpdateStore(StateGroupBackgroundUpdateStore):
             columns=["event_stream_ordering"],
         )
 
+        self.db_pool.updates.register_background_update_handler(
+            self.STATE_GROUP_COMPACTION_UPDATE_NAME,
+            self._background_compact_state_groups,
+        )
+
+        config = hs.config.server
+        self._compaction_max_chain_length = (
+            config.state_group_compaction_max_delta_chain_length
+        )
+        if (
+            hs.config.worker.run_background_tasks
+            and config.state_group_compaction_enabled
+        ):
+            self._clock.looping_call(
+                self.schedule_state_group_compaction,
+                config.state_group_compaction_interval_ms,
+            )
+
+    @wrap_as_background_process("schedule_state_group_compaction")
+    async def schedule_state_group_compaction(self) -> None:
+        """Queue the state group compaction background update, unless it is
+        already queued.
+        """
+
+        def schedule_state_group_compaction_txn(txn: LoggingTransaction) -> bool:
+            existing = self.db_pool.simple_select_one_onecol_txn(
+                txn,
+                table="background_updates",
+                keyvalues={"update_name": self.STATE_GROUP_COMPACTION_UPDATE_NAME},
+                retcol="update_name",
+                allow_none=True,
+            )
+            if existing is not None:
+                return False
+
+            self.db_pool.simple_insert_txn(
+                txn,
+                table="background_updates",
+                values={
+                    "update_name": self.STATE_GROUP_COMPACTION_UPDATE_NAME,
+                    "progress_json": "{}",
+                },
+            )
+            return True
+
+        scheduled = await self.db_pool.runInteraction(
+            "schedule_state_group_compaction", schedule_state_group_compaction_txn
+        )
+        if scheduled:
+            self.db_pool.updates.start_doing_background_updates()
+
+    async def _background_compact_state_groups(
+        self, progress: dict, batch_size: int
+    ) -> int:
+        """This background update shortens the chains of state group deltas, by
+        storing the full state of state groups at the end of long chains (a
+        "snapshot"). The chains of the state groups after a snapshot then stop
+        at the snapshot.
+
+        Chains are cut at `max_delta_chain_length` deltas.
+
+        The state of the state groups doesn't change, so there are no caches to
+        invalidate.
+        """
+        last_state_group = progress.get("last_state_group", 0)
+        snapshots = progress.get("snapshots", 0)
+        max_group = progress.get("max_group", None)
+
+        if max_group is None:
+            rows = await self.db_pool.execute(
+                "_background_compact_state_groups",
+                None,
+                "SELECT coalesce(max(id), 0) FROM state_groups",
+            )
+            max_group = rows[0][0]
+
+        def compact_txn(txn: LoggingTransaction) -> Tuple[bool, int]:
+            # State groups are always created after their previous group, so if we
+            # go through them in order we snapshot the first state group to exceed
+            # the maximum length of each chain, which shortens the chains after it.
+            txn.execute(
+                """
+                SELECT e.state_group, e.prev_state_group, g.room_id
+                FROM state_group_edges AS e
+                INNER JOIN state_groups AS g ON g.id = e.state_group
+                WHERE ? < e.state_group AND e.state_group <= ?
+                ORDER BY e.state_group ASC
+                LIMIT ?
+                """,
+                (last_state_group, max_group, batch_size),
+            )
+            rows = txn.fetchall()
+            if not rows:
+                return True, 0
+
+            # The length of the chain of deltas of the state groups we've seen.
+            chain_lengths: Dict[int, int] = {}
+            new_snapshots = 0
+            for state_group, prev_group, room_id in rows:
+                chain_length = (
+                    self._get_delta_chain_length_txn(txn, prev_group, chain_lengths) + 1
+                )
+
+                if chain_length > self._compaction_max_chain_length:
+                    self._snapshot_state_group_txn(txn, state_group, room_id)
+                    chain_length = 0
+                    new_snapshots += 1
+
+                chain_lengths[state_group] = chain_length
+
+            self.db_pool.updates._background_update_progress_txn(
+                txn,
+                self.STATE_GROUP_COMPACTION_UPDATE_NAME,
+                {
+                    "last_state_group": rows[-1][0],
+                    "snapshots": snapshots + new_snapshots,
+                    "max_group": max_group,
+                },
+            )
+
+            return False, len(rows)
+
+        finished, result = await self.db_pool.runInteraction(
+            self.STATE_GROUP_COMPACTION_UPDATE_NAME, compact_txn
+        )
+
+        if finished:
+            logger.info(
+                "Finished compacting state groups: stored %d snapshots", snapshots
+            )
+            await self.db_pool.updates._end_background_update(
+                self.STATE_GROUP_COMPACTION_UPDATE_NAME
+            )
+
+        return result
+
+    def _get_delta_chain_length_txn(
+        self, txn: LoggingTransaction, state_group: int, chain_lengths: Dict[int, int]
+    ) -> int:
+        """Get the number of deltas in the chain of the given state group, i.e. the
+        number of edges to follow to get to a state group with its full state.
+
+        Args:
+            txn: The transaction object.
+            state_group: The state group.
+            chain_lengths: The known chain lengths of state groups, which is
+                updated with the state groups we walk through.
+        """
+        # The state groups whose lengths we don't know yet, newest first.
+        chain: List[int] = []
+        next_group: Optional[int] = state_group
+        while next_group is not None and next_group not in chain_lengths:
+            chain.append(next_group)
+            next_group = self.db_pool.simple_select_one_onecol_txn(
+                txn,
+                table="state_group_edges",
+                keyvalues={"state_group": next_group},
+                retcol="prev_state_group",
+                allow_none=True,
+            )
+
+        # If we got to the start of the chain, the last group in `chain` has its
+        # full state.
+        length = -1 if next_group is None else chain_lengths[next_group]
+        for group in reversed(chain):
+            length += 1
+            chain_lengths[group] = length
+
+        return chain_lengths[state_group]
+
+    def _snapshot_state_group_txn(
+        self, txn: LoggingTransaction, state_group: int, room_id: str
+    ) -> None:
+        """Replace the delta of a state group with its full state."""
+        curr_state = self._get_state_groups_from_groups_txn(txn, [state_group])[
+            state_group
+        ]
+
+        self.db_pool.simple_delete_txn(
+            txn, table="state_groups_state", keyvalues={"state_group": state_group}
+        )
+        self.db_pool.simple_delete_txn(
+            txn, table="state_group_edges", keyvalues={"state_group": state_group}
+        )
+        self.db_pool.simple_insert_many_txn(
+            txn,
+            table="state_groups_state",
+            keys=("state_group", "room_id", "type", "state_key", "event_id"),
+            values=[
+                (state_group, room_id, key[0], key[1], state_id)
+                for key, state_id in curr_state.items()
+            ],
+        )
+
     async def _background_deduplicate_state(
         self, progress: dict, batch_size: int
     ) -> int:
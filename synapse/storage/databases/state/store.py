@@ -42,6 +42,7 @@ from synapse.storage.types import Cursor
 from synapse.storage.util.sequence import build_sequence_generator
 from synapse.types import MutableStateMap, StateKey, StateMap
 from synapse.types.state import StateFilter
+from synapse.types.state_map import CompactStateMap
 from synapse.util.caches.descriptors import cached
 from synapse.util.caches.dictionary_cache import DictionaryCache
 from synapse.util.cancellation import cancellable
@@ -408,17 +409,27 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
                 else:
                     state_dict_non_members[k] = v
 
+            # The full state maps are kept in the cache as a whole, so we store
+            # them compactly.
             self._state_group_members_cache.update(
                 cache_seq_num_members,
                 key=group,
-                value=state_dict_members,
+                value=(
+                    CompactStateMap(state_dict_members)
+                    if member_types is None
+                    else state_dict_members
+                ),
                 fetched_keys=member_types,
             )
 
             self._state_group_cache.update(
                 cache_seq_num_non_members,
                 key=group,
-                value=state_dict_non_members,
+                value=(
+                    CompactStateMap(state_dict_non_members)
+                    if non_member_types is None
+                    else state_dict_non_members
+                ),
                 fetched_keys=non_member_types,
             )
 
@@ -659,11 +670,13 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
             # is immutable. (If the map wasn't immutable then this prefill could
             # race with another update)
 
-            current_member_state_ids = {
-                s: ev
-                for (s, ev) in current_state_ids.items()
-                if s[0] == EventTypes.Member
-            }
+            current_member_state_ids = CompactStateMap(
+                {
+                    s: ev
+                    for (s, ev) in current_state_ids.items()
+                    if s[0] == EventTypes.Member
+                }
+            )
             txn.call_after(
                 self._state_group_members_cache.update,
                 self._state_group_members_cache.sequence,
@@ -671,11 +684,13 @@ class StateGroupDataStore(StateBackgroundUpdateStore, SQLBaseStore):
                 value=current_member_state_ids,
             )
 
-            current_non_member_state_ids = {
-                s: ev
-                for (s, ev) in current_state_ids.items()
-                if s[0] != EventTypes.Member
-            }
+            current_non_member_state_ids = CompactStateMap(
+                {
+                    s: ev
+                    for (s, ev) in current_state_ids.items()
+                    if s[0] != EventTypes.Member
+                }
+            )
             txn.call_after(
                 self._state_group_cache.update,
                 self._state_group_cache.sequence,
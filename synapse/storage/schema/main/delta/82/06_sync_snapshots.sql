@@ -0,0 +1,29 @@
+/* Copyright 2023 The Matrix.org Foundation C.I.C
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- Per-user, per-room snapshots of the rooms section of an initial sync. See
+-- `RoomSyncSnapshot` for the meaning of the fields.
+CREATE TABLE IF NOT EXISTS sync_snapshots(
+    user_id TEXT NOT NULL,
+    -- A hash of the filter the snapshot was computed with.
+    filter_key TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    -- The room stream position the snapshot is valid at.
+    stream_ordering BIGINT NOT NULL,
+    snapshot_json TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS sync_snapshots_user_room ON sync_snapshots(user_id, room_id);
+CREATE INDEX IF NOT EXISTS sync_snapshots_room ON sync_snapshots(room_id);
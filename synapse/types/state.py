@@ -303,7 +303,11 @@ class StateFilter:
             This is a copy, so it's safe to mutate.
         """
         if self.is_full():
-            return dict(state_dict)
+            if isinstance(state_dict, dict):
+                return dict(state_dict)
+            # For other mappings (e.g. `CompactStateMap`) iterating over the items
+            # can be much faster than looking up each key.
+            return dict(state_dict.items())
 
         filtered_state = {}
         for k, v in state_dict.items():
@@ -0,0 +1,188 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import sys
+from bisect import bisect_left
+from typing import (
+    Any,
+    Dict,
+    ItemsView,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    ValuesView,
+    overload,
+)
+
+from synapse.types import StateKey, StateMap
+from synapse.util.caches import intern_string
+from synapse.util.caches.sizing import register_size_estimator
+
+T = TypeVar("T")
+
+
+class CompactStateMap(StateMap[str]):
+    """An immutable state map (i.e. a mapping from `(type, state_key)` to event
+    ID) which uses much less memory than a dict.
+
+    The entries are stored sorted, in parallel tuples, so each takes up two
+    pointers rather than a dict entry and a `(type, state_key)` tuple. The strings
+    are interned, so that the many state maps of a room share the same event ID
+    and state key strings rather than each having their own copies.
+
+    Lookups are O(log n). Iterating over the keys creates a new tuple for each
+    key, so prefer `items()` or `to_dict()` to `dict(...)` when copying the whole
+    map.
+    """
+
+    __slots__ = ["_types", "_offsets", "_state_keys", "_event_ids"]
+
+    def __init__(self, state: Optional[StateMap[str]] = None):
+        if isinstance(state, CompactStateMap):
+            self._types: Tuple[str, ...] = state._types
+            self._offsets: Tuple[int, ...] = state._offsets
+            self._state_keys: Tuple[str, ...] = state._state_keys
+            self._event_ids: Tuple[str, ...] = state._event_ids
+            return
+
+        items = sorted(state.items()) if state else []
+
+        # The distinct event types, and the index of the first entry of each (plus
+        # the number of entries).
+        types: List[str] = []
+        offsets: List[int] = []
+        for idx, ((typ, _), _) in enumerate(items):
+            if not types or types[-1] != typ:
+                types.append(intern_string(typ))
+                offsets.append(idx)
+        offsets.append(len(items))
+
+        self._types = tuple(types)
+        self._offsets = tuple(offsets)
+        self._state_keys = tuple(
+            intern_string(state_key) for (_, state_key), _ in items
+        )
+        self._event_ids = tuple(intern_string(event_id) for _, event_id in items)
+
+    def _index(self, key: Any) -> int:
+        """Get the index of the entry for the given key, or -1 if there isn't one."""
+        try:
+            typ, state_key = key
+            type_idx = self._types.index(typ)
+        except (TypeError, ValueError):
+            return -1
+
+        lo = self._offsets[type_idx]
+        hi = self._offsets[type_idx + 1]
+        idx = bisect_left(self._state_keys, state_key, lo, hi)
+        if idx < hi and self._state_keys[idx] == state_key:
+            return idx
+        return -1
+
+    def __getitem__(self, key: StateKey) -> str:
+        idx = self._index(key)
+        if idx < 0:
+            raise KeyError(key)
+        return self._event_ids[idx]
+
+    @overload
+    def get(self, key: StateKey) -> Optional[str]:
+        ...
+
+    @overload
+    def get(self, key: StateKey, default: Union[str, T]) -> Union[str, T]:
+        ...
+
+    def get(
+        self, key: StateKey, default: Union[str, T, None] = None
+    ) -> Union[str, T, None]:
+        idx = self._index(key)
+        if idx < 0:
+            return default
+        return self._event_ids[idx]
+
+    def __contains__(self, key: object) -> bool:
+        return self._index(key) >= 0
+
+    def __len__(self) -> int:
+        return len(self._event_ids)
+
+    def __iter__(self) -> Iterator[StateKey]:
+        return itertools.chain.from_iterable(
+            zip(
+                itertools.repeat(typ),
+                itertools.islice(
+                    self._state_keys, self._offsets[idx], self._offsets[idx + 1]
+                ),
+            )
+            for idx, typ in enumerate(self._types)
+        )
+
+    def items(self) -> "_CompactItemsView":
+        return _CompactItemsView(self)
+
+    def values(self) -> "_CompactValuesView":
+        return _CompactValuesView(self)
+
+    def to_dict(self) -> Dict[StateKey, str]:
+        """Get a (mutable) dict copy of the state map."""
+        return dict(zip(self, self._event_ids))
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, CompactStateMap):
+            return (
+                self._event_ids == other._event_ids
+                and self._state_keys == other._state_keys
+                and self._types == other._types
+                and self._offsets == other._offsets
+            )
+        return super().__eq__(other)
+
+    def __repr__(self) -> str:
+        return "%s(%r)" % (type(self).__name__, self.to_dict())
+
+
+class _CompactItemsView(ItemsView[StateKey, str]):
+    _mapping: CompactStateMap
+
+    def __iter__(self) -> Iterator[Tuple[StateKey, str]]:
+        return zip(self._mapping, self._mapping._event_ids)
+
+
+class _CompactValuesView(ValuesView[str]):
+    _mapping: CompactStateMap
+
+    def __contains__(self, value: object) -> bool:
+        return value in self._mapping._event_ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._mapping._event_ids)
+
+
+def _estimate_compact_state_map_size(state: CompactStateMap) -> int:
+    # The strings are interned, so are shared with other state maps.
+    return (
+        sys.getsizeof(state)
+        + sys.getsizeof(state._types)
+        + sys.getsizeof(state._offsets)
+        + sys.getsizeof(state._state_keys)
+        + sys.getsizeof(state._event_ids)
+    )
+
+
+register_size_estimator(CompactStateMap, _estimate_compact_state_map_size)
@@ -32,6 +32,11 @@ logger = logging.getLogger(__name__)
 # Whether to track estimated memory usage of the LruCaches.
 TRACK_MEMORY_USAGE = False
 
+# Whether the LruCaches should remember the keys they recently evicted, to count
+# the lookups which would have hit had they been bigger. See
+# `synapse.util.caches.adaptive`.
+TRACK_GHOST_ENTRIES = False
+
 # We track cache metrics in a special registry that lets us update the metrics
 # just before they are returned from the scrape endpoint.
 CACHE_METRIC_REGISTRY = DynamicCollectorRegistry()
@@ -56,6 +61,12 @@ cache_total = Gauge(
 cache_max_size = Gauge(
     "synapse_util_caches_cache_max_size", "", ["name"], registry=CACHE_METRIC_REGISTRY
 )
+cache_ghost_hits = Gauge(
+    "synapse_util_caches_cache_ghost_hits",
+    "Number of lookups which missed but would have hit had the cache been bigger",
+    ["name"],
+    registry=CACHE_METRIC_REGISTRY,
+)
 cache_memory_usage = Gauge(
     "synapse_util_caches_cache_size_bytes",
     "Estimated memory usage of the caches",
@@ -105,6 +116,7 @@ class CacheMetric:
 
     hits: int = 0
     misses: int = 0
+    ghost_hits: int = 0
     eviction_size_by_reason: typing.Counter[EvictionReason] = attr.ib(
         factory=collections.Counter
     )
@@ -116,6 +128,9 @@ class CacheMetric:
     def inc_misses(self) -> None:
         self.misses += 1
 
+    def inc_ghost_hits(self) -> None:
+        self.ghost_hits += 1
+
     def inc_evictions(self, reason: EvictionReason, size: int = 1) -> None:
         self.eviction_size_by_reason[reason] += size
 
@@ -156,11 +171,14 @@ class CacheMetric:
                         self.eviction_size_by_reason[reason]
                     )
                 cache_total.labels(self._cache_name).set(self.hits + self.misses)
+                if TRACK_GHOST_ENTRIES:
+                    cache_ghost_hits.labels(self._cache_name).set(self.ghost_hits)
                 max_size = getattr(self._cache, "max_size", None)
                 if max_size:
                     cache_max_size.labels(self._cache_name).set(max_size)
 
-                if TRACK_MEMORY_USAGE:
+                # self.memory_usage is also set if the caches have a memory budget.
+                if TRACK_MEMORY_USAGE or self.memory_usage is not None:
                     # self.memory_usage can be None if nothing has been inserted
                     # into the cache yet.
                     cache_memory_usage.labels(self._cache_name).set(
@@ -0,0 +1,205 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Adaptive sizing of the LruCaches.
+
+Each cache remembers the keys it most recently evicted for lack of space (its
+"ghost entries"). A lookup which misses the cache but hits a ghost entry is one
+which would have hit had the cache been bigger, so the number of such "ghost
+hits" per entry tells us how much a cache would gain from growing.
+
+Periodically, `AdaptiveCacheSizer` moves entries from the caches which would
+gain the least to those which would gain the most, keeping the total number of
+entries the same.
+"""
+
+import logging
+import weakref
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, Generic, Hashable, TypeVar
+
+from prometheus_client import Gauge
+
+from synapse.config.cache import _canonicalise_cache_name
+from synapse.util import caches
+from synapse.util.caches import CACHE_METRIC_REGISTRY
+
+if TYPE_CHECKING:
+    from synapse.server import HomeServer
+    from synapse.util.caches.lrucache import LruCache
+
+logger = logging.getLogger(__name__)
+
+KT = TypeVar("KT", bound=Hashable)
+
+# The proportion of its entries a cache gives up each time it is shrunk.
+_SHRINK_STEP = 0.1
+
+# How far the adaptive sizing may move a cache's factor away from the one it was
+# configured with.
+_MIN_FACTOR_SCALE = 0.25
+_MAX_FACTOR_SCALE = 4.0
+
+adaptive_cache_factor = Gauge(
+    "synapse_util_caches_adaptive_factor",
+    "The cache factor chosen (or recommended) by the adaptive cache sizing",
+    ["name"],
+    registry=CACHE_METRIC_REGISTRY,
+)
+
+# The caches which can be resized by the adaptive sizing, by name.
+_resizable_caches: "weakref.WeakValueDictionary[str, LruCache]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+def register_adaptive_cache(cache_name: str, cache: "LruCache") -> None:
+    """Register a cache to be resized by the adaptive cache sizing, if enabled."""
+    _resizable_caches[cache_name] = cache
+
+
+class GhostEntries(Generic[KT]):
+    """The keys most recently evicted from a cache, without their values."""
+
+    __slots__ = ["_keys", "max_size"]
+
+    def __init__(self, max_size: int):
+        self._keys: "OrderedDict[KT, None]" = OrderedDict()
+        self.max_size = max_size
+
+    def add(self, key: KT) -> None:
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+
+    def pop(self, key: KT) -> bool:
+        """Remove the given key, returning whether it was present."""
+        try:
+            del self._keys[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+class AdaptiveCacheSizer:
+    """Periodically redistributes entries between the caches according to how
+    many ghost hits they have had since the last time.
+
+    In "recommend only" mode, the caches are left alone and the factors they
+    would have been given are logged (in the format of `caches.per_cache_factors`)
+    and exported as metrics instead.
+    """
+
+    def __init__(self, hs: "HomeServer"):
+        config = hs.config.caches
+        self._recommend_only = config.adaptive_sizing_recommend_only
+        self._global_factor = config.global_factor
+        self._cache_factors = config.cache_factors
+
+        # The number of ghost hits of each cache at the last rebalance.
+        self._last_ghost_hits: Dict[str, int] = {}
+
+        hs.get_clock().looping_call(self.rebalance, config.adaptive_sizing_interval_ms)
+
+    def rebalance(self) -> None:
+        resizable_caches = dict(_resizable_caches.items())
+
+        gains: Dict[str, float] = {}
+        for name, cache in resizable_caches.items():
+            if cache.metrics is None or cache.max_size <= 0:
+                continue
+
+            ghost_hits = cache.metrics.ghost_hits
+            new_ghost_hits = ghost_hits - self._last_ghost_hits.get(name, 0)
+            self._last_ghost_hits[name] = ghost_hits
+
+            gains[name] = new_ghost_hits / cache.max_size
+
+        if not gains or not any(gains.values()):
+            return
+
+        mean_gain = sum(gains.values()) / len(gains)
+
+        new_sizes: Dict[str, int] = {}
+        freed = 0
+        for name, gain in gains.items():
+            if gain < mean_gain:
+                cache = resizable_caches[name]
+                min_size = int(
+                    cache.original_max_size
+                    * self._configured_factor(name)
+                    * _MIN_FACTOR_SCALE
+                )
+                new_size = max(int(cache.max_size * (1 - _SHRINK_STEP)), min_size)
+                freed += max(cache.max_size - new_size, 0)
+                new_sizes[name] = new_size
+
+        total_excess_gain = sum(
+            gain - mean_gain for gain in gains.values() if gain > mean_gain
+        )
+        for name, gain in gains.items():
+            if gain > mean_gain:
+                cache = resizable_caches[name]
+                max_size = int(
+                    cache.original_max_size
+                    * self._configured_factor(name)
+                    * _MAX_FACTOR_SCALE
+                )
+                extra = int(freed * (gain - mean_gain) / total_excess_gain)
+                new_sizes[name] = min(cache.max_size + extra, max_size)
+
+        factors: Dict[str, float] = {}
+        for name, new_size in new_sizes.items():
+            cache = resizable_caches[name]
+            if new_size == cache.max_size or not cache.original_max_size:
+                continue
+
+            factor = new_size / cache.original_max_size
+            factors[name] = factor
+            adaptive_cache_factor.labels(name).set(factor)
+
+            if not self._recommend_only:
+                cache.set_cache_factor(factor)
+
+        if not factors:
+            return
+
+        if self._recommend_only:
+            logger.info(
+                "Suggested caches.per_cache_factors: %s",
+                {
+                    _canonicalise_cache_name(name): round(factor, 3)
+                    for name, factor in sorted(factors.items())
+                },
+            )
+        else:
+            logger.info("Resized caches: %s", factors)
+
+    def _configured_factor(self, cache_name: str) -> float:
+        return self._cache_factors.get(
+            _canonicalise_cache_name(cache_name), self._global_factor
+        )
+
+
+def setup_adaptive_cache_sizing(hs: "HomeServer") -> None:
+    """Start tracking ghost entries and resizing the caches, if enabled."""
+    if not hs.config.caches.adaptive_sizing_enabled:
+        return
+
+    caches.TRACK_GHOST_ENTRIES = True
+    AdaptiveCacheSizer(hs)
@@ -14,7 +14,7 @@
 import enum
 import logging
 import threading
-from typing import Dict, Generic, Iterable, Optional, Set, Tuple, TypeVar, Union
+from typing import Generic, Iterable, Mapping, Optional, Set, Tuple, TypeVar, Union
 
 import attr
 from typing_extensions import Literal
@@ -49,7 +49,7 @@ class DictionaryEntry(Generic[DKT, DV]):
 
     full: bool
     known_absent: Set[DKT]
-    value: Dict[DKT, DV]
+    value: Mapping[DKT, DV]
 
     def __len__(self) -> int:
         return len(self.value)
@@ -130,10 +130,10 @@ class DictionaryCache(Generic[KT, DKT, DV]):
         #
         # Typing:
         #     * A key of `(KT, DKT)` has a value of `_PerKeyValue`
-        #     * A key of `(KT, _FullCacheKey.KEY)` has a value of `Dict[DKT, DV]`
+        #     * A key of `(KT, _FullCacheKey.KEY)` has a value of `Mapping[DKT, DV]`
         self.cache: LruCache[
             Tuple[KT, Union[DKT, Literal[_FullCacheKey.KEY]]],
-            Union[_PerKeyValue, Dict[DKT, DV]],
+            Union[_PerKeyValue, Mapping[DKT, DV]],
         ] = LruCache(
             max_size=max_entries,
             cache_name=name,
@@ -217,7 +217,7 @@ class DictionaryCache(Generic[KT, DKT, DV]):
             return DictionaryEntry(False, known_absent, values)
 
         # We have the full dict!
-        assert isinstance(entry, dict)
+        assert not isinstance(entry, _PerKeyValue)
 
         for dict_key in missing:
             # We explicitly add each dict key to the cache, so that cache hit
@@ -239,7 +239,7 @@ class DictionaryCache(Generic[KT, DKT, DV]):
         # First we check if we have cached the full dict.
         entry = self.cache.get((key, _FullCacheKey.KEY), _Sentinel.sentinel)
         if entry is not _Sentinel.sentinel:
-            assert isinstance(entry, dict)
+            assert not isinstance(entry, _PerKeyValue)
             return DictionaryEntry(True, set(), entry)
 
         return DictionaryEntry(False, set(), {})
@@ -267,7 +267,7 @@ class DictionaryCache(Generic[KT, DKT, DV]):
         self,
         sequence: int,
         key: KT,
-        value: Dict[DKT, DV],
+        value: Mapping[DKT, DV],
         fetched_keys: Optional[Iterable[DKT]] = None,
     ) -> None:
         """Updates the entry in the cache.
@@ -302,7 +302,7 @@ class DictionaryCache(Generic[KT, DKT, DV]):
                 self._update_subset(key, value, fetched_keys)
 
     def _update_subset(
-        self, key: KT, value: Dict[DKT, DV], fetched_keys: Iterable[DKT]
+        self, key: KT, value: Mapping[DKT, DV], fetched_keys: Iterable[DKT]
     ) -> None:
         """Add the given dictionary values as explicit keys in the cache.
 
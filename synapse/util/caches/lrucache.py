@@ -46,6 +46,8 @@ from synapse.metrics.background_process_metrics import wrap_as_background_proces
 from synapse.metrics.jemalloc import get_jemalloc_stats
 from synapse.util import Clock, caches
 from synapse.util.caches import CacheMetric, EvictionReason, register_cache
+from synapse.util.caches.adaptive import GhostEntries, register_adaptive_cache
+from synapse.util.caches.sizing import estimate_size
 from synapse.util.caches.treecache import (
     TreeCache,
     iterate_tree_cache_entry,
@@ -110,6 +112,27 @@ USE_GLOBAL_LIST = False
 # A linked list of all cache entries, allowing efficient time based eviction.
 GLOBAL_ROOT = ListNode["_Node"].create_root_node()
 
+# The estimated number of bytes that entries on the global list may use, if set.
+# When it is, the size of each new cache entry is estimated on insertion and
+# the least recently used entries are evicted once the total goes over budget.
+MEMORY_BUDGET: Optional[int] = None
+
+# The estimated number of bytes used by the entries on the global list. Only
+# tracked if `MEMORY_BUDGET` is set.
+_global_memory_usage = 0
+
+
+def _update_global_memory_usage(delta: int) -> None:
+    global _global_memory_usage
+    _global_memory_usage += delta
+
+
+def get_global_memory_usage() -> int:
+    """Get the estimated number of bytes used by the cache entries which count
+    towards `MEMORY_BUDGET`.
+    """
+    return _global_memory_usage
+
 
 @wrap_as_background_process("LruCache._expire_old_entries")
 async def _expire_old_entries(
@@ -117,17 +140,23 @@ async def _expire_old_entries(
 ) -> None:
     """Walks the global cache list to find cache entries that haven't been
     accessed in the given number of seconds, or if a given memory threshold has been breached.
+
+    When evicting due to memory, entries from caches with a higher hit ratio are
+    kept for longer: an entry is protected for `min_cache_ttl * (1 + hit ratio)`
+    after it was last accessed.
     """
     if autotune_config:
         max_cache_memory_usage = autotune_config["max_cache_memory_usage"]
         target_cache_memory_usage = autotune_config["target_cache_memory_usage"]
         min_cache_ttl = autotune_config["min_cache_ttl"] / 1000
+        memory_stat = autotune_config.get("memory_stat", "allocated")
 
     now = int(clock.time())
     node = GLOBAL_ROOT.prev_node
     assert node is not None
 
     i = 0
+    dropped = 0
 
     logger.debug("Searching for stale caches")
 
@@ -138,7 +167,7 @@ async def _expire_old_entries(
     if jemalloc_interface and autotune_config:
         try:
             jemalloc_interface.refresh_stats()
-            mem_usage = jemalloc_interface.get_stat("allocated")
+            mem_usage = jemalloc_interface.get_stat(memory_stat)
             if mem_usage > max_cache_memory_usage:
                 logger.info("Begin memory-based cache eviction.")
                 evicting_due_to_memory = True
@@ -171,23 +200,35 @@ async def _expire_old_entries(
         # list.
         assert next_node is not None
         assert cache_entry is not None
-        cache_entry.drop_from_cache()
 
-        # Check mem allocation periodically if we are evicting a bunch of caches
-        if jemalloc_interface and evicting_due_to_memory and (i + 1) % 100 == 0:
-            try:
-                jemalloc_interface.refresh_stats()
-                mem_usage = jemalloc_interface.get_stat("allocated")
-                if mem_usage < target_cache_memory_usage:
+        age = now - node.last_access_ts_secs
+        # If we're only here because we're evicting due to memory, and this
+        # entry belongs to a cache that is worth keeping it in for a bit longer,
+        # we skip over it.
+        keep_for_longer = (
+            evicting_due_to_memory
+            and age <= expiry_seconds
+            and age < min_cache_ttl * (1 + cache_entry.get_cache_hit_ratio())
+        )
+        if not keep_for_longer:
+            cache_entry.drop_from_cache()
+            dropped += 1
+
+            # Check mem allocation periodically if we are evicting a bunch of caches
+            if jemalloc_interface and evicting_due_to_memory and dropped % 100 == 0:
+                try:
+                    jemalloc_interface.refresh_stats()
+                    mem_usage = jemalloc_interface.get_stat(memory_stat)
+                    if mem_usage < target_cache_memory_usage:
+                        evicting_due_to_memory = False
+                        logger.info("Stop memory-based cache eviction.")
+                except Exception:
+                    logger.warning(
+                        "Unable to read allocated memory, this may affect memory-based cache eviction."
+                    )
+                    # If we've failed to read the current memory usage then we
+                    # should stop trying to evict based on memory usage
                     evicting_due_to_memory = False
-                    logger.info("Stop memory-based cache eviction.")
-            except Exception:
-                logger.warning(
-                    "Unable to read allocated memory, this may affect memory-based cache eviction."
-                )
-                # If we've failed to read the current memory usage then we
-                # should stop trying to evict based on memory usage
-                evicting_due_to_memory = False
 
         # If we do lots of work at once we yield to allow other stuff to happen.
         if (i + 1) % 10000 == 0:
@@ -207,14 +248,74 @@ async def _expire_old_entries(
 
         i += 1
 
-    logger.info("Dropped %d items from caches", i)
+    logger.info("Dropped %d items from caches", dropped)
+
+
+@wrap_as_background_process("LruCache._evict_for_memory_budget")
+async def _evict_for_memory_budget(clock: Clock) -> None:
+    """Walks the global cache list from the least recently used entry, dropping
+    entries until their estimated memory usage is back within `MEMORY_BUDGET`.
+    """
+    if MEMORY_BUDGET is None or _global_memory_usage <= MEMORY_BUDGET:
+        return
+
+    logger.info(
+        "Cache entries are using an estimated %d bytes, over the budget of %d bytes",
+        _global_memory_usage,
+        MEMORY_BUDGET,
+    )
+
+    node = GLOBAL_ROOT.prev_node
+    assert node is not None
+
+    i = 0
+    while node is not GLOBAL_ROOT and _global_memory_usage > MEMORY_BUDGET:
+        # Only the root node isn't a `_TimedListNode`.
+        assert isinstance(node, _TimedListNode)
+
+        cache_entry = node.get_cache_entry()
+        next_node = node.prev_node
+
+        # As in `_expire_old_entries`, these are only dropped when the node is
+        # removed from the list.
+        assert next_node is not None
+        assert cache_entry is not None
+        cache_entry.drop_from_cache()
+
+        # If we do lots of work at once we yield to allow other stuff to happen.
+        if (i + 1) % 10000 == 0:
+            await clock.sleep(0)
+
+        node = next_node
+
+        # If we've yielded then our current node may have been evicted, so we
+        # need to check that its still valid.
+        if node.prev_node is None:
+            break
+
+        i += 1
+
+    logger.info("Dropped %d items from caches to stay within the memory budget", i)
 
 
 def setup_expire_lru_cache_entries(hs: "HomeServer") -> None:
     """Start a background job that expires all cache entries if they have not
     been accessed for the given number of seconds, or if a given memory usage threshold has been
     breached.
+
+    Also start evicting cache entries once their estimated memory usage goes over
+    `caches.memory_budget`, if set.
     """
+    global USE_GLOBAL_LIST
+    global MEMORY_BUDGET
+
+    if hs.config.caches.memory_budget is not None:
+        MEMORY_BUDGET = hs.config.caches.memory_budget
+        USE_GLOBAL_LIST = True
+
+        logger.info("Limiting LRU caches to an estimated %d bytes", MEMORY_BUDGET)
+        hs.get_clock().looping_call(_evict_for_memory_budget, 1000, hs.get_clock())
+
     if not hs.config.caches.expiry_time_msec and not hs.config.caches.cache_autotuning:
         return
 
@@ -224,13 +325,16 @@ def setup_expire_lru_cache_entries(hs: "HomeServer") -> None:
     else:
         expiry_time = math.inf
 
-    global USE_GLOBAL_LIST
     USE_GLOBAL_LIST = True
 
+    check_interval_ms = 30 * 1000
+    if hs.config.caches.cache_autotuning:
+        check_interval_ms = hs.config.caches.cache_autotuning["check_interval"]
+
     clock = hs.get_clock()
     clock.looping_call(
         _expire_old_entries,
-        30 * 1000,
+        check_interval_ms,
         clock,
         expiry_time,
         hs.config.caches.cache_autotuning,
@@ -286,7 +390,9 @@ class _Node(Generic[KT, VT]):
         self.add_callbacks(callbacks)
 
         self.memory = 0
-        if caches.TRACK_MEMORY_USAGE:
+        if MEMORY_BUDGET is not None:
+            self.memory = estimate_size(key) + estimate_size(value)
+        elif caches.TRACK_MEMORY_USAGE:
             self.memory = (
                 _get_size_of(key)
                 + _get_size_of(value)
@@ -341,6 +447,24 @@ class _Node(Generic[KT, VT]):
             # already been removed from the cache.
             self.drop_from_lists()
 
+    def get_cache_hit_ratio(self) -> float:
+        """Get the proportion of lookups which hit, for the cache this entry is in."""
+        cache = self._cache()
+        metrics = cache.metrics if cache is not None else None
+        if metrics is None:
+            return 0.0
+
+        total = metrics.hits + metrics.misses
+        return metrics.hits / total if total else 0.0
+
+    def counts_towards_memory_budget(self) -> bool:
+        """Whether this entry's memory usage is counted against `MEMORY_BUDGET`.
+
+        Only entries on the global list can be evicted to stay within the budget,
+        so only they are counted.
+        """
+        return self._global_list_node is not None
+
     def drop_from_lists(self) -> None:
         """Remove this node from the cache lists."""
         self._list_node.remove_from_list()
@@ -448,6 +572,11 @@ class LruCache(Generic[KT, VT]):
         # this is exposed for access from outside this class
         self.metrics = metrics
 
+        # The keys recently evicted from this cache, if we're tracking them.
+        ghost_entries: Optional[GhostEntries[KT]] = None
+        if cache_name is not None and apply_cache_factor_from_config:
+            register_adaptive_cache(cache_name, self)
+
         # We create a single weakref to self here so that we don't need to keep
         # creating more each time we create a `_Node`.
         weak_ref_to_self = weakref.ref(self)
@@ -476,6 +605,13 @@ class LruCache(Generic[KT, VT]):
                 if metrics:
                     metrics.inc_evictions(EvictionReason.size, evicted_len)
 
+                    if caches.TRACK_GHOST_ENTRIES:
+                        nonlocal ghost_entries
+                        if ghost_entries is None:
+                            ghost_entries = GhostEntries(self.max_size)
+                        ghost_entries.max_size = self.max_size
+                        ghost_entries.add(node.key)
+
         def synchronized(f: FT) -> FT:
             @wraps(f)
             def inner(*args: Any, **kwargs: Any) -> Any:
@@ -514,8 +650,11 @@ class LruCache(Generic[KT, VT]):
             if size_callback:
                 cached_cache_len[0] += size_callback(node.value)
 
-            if caches.TRACK_MEMORY_USAGE and metrics:
-                metrics.inc_memory_usage(node.memory)
+            if node.memory:
+                if metrics:
+                    metrics.inc_memory_usage(node.memory)
+                if node.counts_towards_memory_budget():
+                    _update_global_memory_usage(node.memory)
 
         def move_node_to_front(node: _Node[KT, VT]) -> None:
             node.move_to_front(real_clock, list_root)
@@ -530,8 +669,11 @@ class LruCache(Generic[KT, VT]):
 
             node.run_and_clear_callbacks()
 
-            if caches.TRACK_MEMORY_USAGE and metrics:
-                metrics.dec_memory_usage(node.memory)
+            if node.memory:
+                if metrics:
+                    metrics.dec_memory_usage(node.memory)
+                if node.counts_towards_memory_budget():
+                    _update_global_memory_usage(-node.memory)
 
             return deleted_len
 
@@ -589,6 +731,8 @@ class LruCache(Generic[KT, VT]):
             else:
                 if update_metrics and metrics:
                     metrics.inc_misses()
+                    if ghost_entries is not None and ghost_entries.pop(key):
+                        metrics.inc_ghost_hits()
                 return default
 
         @overload
@@ -674,6 +818,14 @@ class LruCache(Generic[KT, VT]):
 
                 move_node_to_front(node)
                 node.value = value
+
+                if MEMORY_BUDGET is not None and node.memory:
+                    memory = estimate_size(key) + estimate_size(value)
+                    if metrics:
+                        metrics.inc_memory_usage(memory - node.memory)
+                    if node.counts_towards_memory_budget():
+                        _update_global_memory_usage(memory - node.memory)
+                    node.memory = memory
             else:
                 add_node(key, value, set(callbacks))
 
@@ -733,6 +885,8 @@ class LruCache(Generic[KT, VT]):
             for node in cache.values():
                 node.run_and_clear_callbacks()
                 node.drop_from_lists()
+                if node.memory and node.counts_towards_memory_budget():
+                    _update_global_memory_usage(-node.memory)
 
             assert list_root.next_node == list_root
             assert list_root.prev_node == list_root
@@ -741,7 +895,7 @@ class LruCache(Generic[KT, VT]):
             if size_callback:
                 cached_cache_len[0] = 0
 
-            if caches.TRACK_MEMORY_USAGE and metrics:
+            if metrics:
                 metrics.clear_memory_usage()
 
         @synchronized
@@ -786,6 +940,11 @@ class LruCache(Generic[KT, VT]):
     def __contains__(self, key: KT) -> bool:
         return self.contains(key)
 
+    @property
+    def original_max_size(self) -> int:
+        """The maximum size of this cache, before any cache factor is applied."""
+        return self._original_max_size
+
     def set_cache_factor(self, factor: float) -> None:
         """
         Set the cache factor for this individual cache.
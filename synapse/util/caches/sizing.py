@@ -0,0 +1,101 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cheap estimates of the memory used by cache entries.
+
+Unlike `pympler`, these don't walk the whole object graph: they are rough, but
+fast enough to compute for every entry inserted into a cache.
+"""
+
+import sys
+from typing import Any, Callable, Dict, Type
+
+import attr
+from immutabledict import immutabledict
+
+# Containers with more items than this are sized by sampling their first items.
+_SAMPLE_SIZE = 100
+
+# Beyond this depth we don't look inside objects any more.
+_MAX_DEPTH = 8
+
+_ESTIMATORS: Dict[Type, Callable[[Any], int]] = {}
+
+
+def register_size_estimator(cls: Type, estimator: Callable[[Any], int]) -> None:
+    """Register a function to estimate the size of instances of the given class
+    (and its subclasses).
+
+    The estimator may call `estimate_size` on the objects it references.
+    """
+    _ESTIMATORS[cls] = estimator
+
+
+def estimate_size(value: Any, _depth: int = 0) -> int:
+    """Get a rough estimate of the size in bytes of an object, including the
+    objects it references.
+
+    Objects which are shared between many values (e.g. interned strings) are
+    counted every time they are referenced, so this will tend to overestimate.
+    """
+    if value is None or value is True or value is False:
+        return 0
+
+    size = sys.getsizeof(value)
+    if _depth >= _MAX_DEPTH or isinstance(value, (str, bytes, int, float)):
+        return size
+
+    if isinstance(value, (dict, immutabledict)):
+        return size + _estimate_items_size(
+            len(value),
+            (
+                estimate_size(k, _depth + 1) + estimate_size(v, _depth + 1)
+                for k, v in value.items()
+            ),
+        )
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + _estimate_items_size(
+            len(value), (estimate_size(v, _depth + 1) for v in value)
+        )
+
+    for cls in type(value).__mro__:
+        estimator = _ESTIMATORS.get(cls)
+        if estimator is not None:
+            return estimator(value)
+
+    if attr.has(type(value)):
+        return size + sum(
+            estimate_size(getattr(value, field.name), _depth + 1)
+            for field in attr.fields(type(value))
+        )
+
+    return size
+
+
+def _estimate_items_size(num_items: int, item_sizes: Any) -> int:
+    """Sum the sizes of the items of a container, extrapolating from the first
+    `_SAMPLE_SIZE` items for large containers.
+    """
+    total = 0
+    sampled = 0
+    for item_size in item_sizes:
+        total += item_size
+        sampled += 1
+        if sampled >= _SAMPLE_SIZE:
+            break
+
+    if sampled == 0 or sampled == num_items:
+        return total
+    return total * num_items // sampled
@@ -0,0 +1,310 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A generator of synthetic room DAGs, for benchmarking state resolution and auth."""
+
+import random
+from typing import Any, Dict, List, Optional, Set
+
+import attr
+
+from synapse.api.constants import EventTypes, JoinRules, Membership
+from synapse.api.room_versions import RoomVersion, RoomVersions
+from synapse.events import EventBase, make_event_from_dict
+from synapse.types import MutableStateMap, StateMap
+
+# The number of servers the members of the room are spread across.
+NUM_SERVERS = 10
+
+
+@attr.s(slots=True, frozen=True, auto_attribs=True)
+class RoomDagConfig:
+    """The shape of a synthetic room DAG."""
+
+    # The number of users (other than the creator) who join the room.
+    num_members: int = 100
+    # The number of events sent after the room has been set up, not including
+    # the bans from ban storms.
+    num_events: int = 1000
+    # The chance that each event is sent on a new fork of the DAG, rather than
+    # an existing one. The forks are never merged, so the room ends up with
+    # a forward extremity per fork.
+    fork_rate: float = 0.01
+    # The chance that each event is a change to the room's power levels.
+    power_levels_churn: float = 0.02
+    # The number of times the creator bans a batch of members in one go.
+    num_ban_storms: int = 2
+    ban_storm_size: int = 20
+    room_version: RoomVersion = RoomVersions.V10
+    seed: int = 0
+
+
+@attr.s(slots=True, auto_attribs=True)
+class _Fork:
+    """The tip of one fork of the DAG, and the state after it."""
+
+    tip: str
+    depth: int
+    state: MutableStateMap[str]
+    # The users whose membership is join in `state`.
+    joined: List[str]
+    # The users who have a non-default power level in `state`.
+    power_levels: Dict[str, int]
+
+
+@attr.s(slots=True, auto_attribs=True)
+class RoomDag:
+    """A synthetic room DAG, generated by `generate_room_dag`."""
+
+    room_id: str
+    room_version: RoomVersion
+    creator: str
+    # The events in the room, in topological order.
+    events: Dict[str, EventBase]
+    # The state after each of the room's forward extremities.
+    state_sets: List[StateMap[str]]
+
+    def auth_events(self, event: EventBase) -> List[EventBase]:
+        return [self.events[auth_id] for auth_id in event.auth_event_ids()]
+
+
+class _RoomDagGenerator:
+    def __init__(self, config: RoomDagConfig):
+        self._config = config
+        self._rng = random.Random(config.seed)
+        self._ts = 0
+
+        self.room_id = "!synmark:synmark0"
+        self.creator = "@creator:synmark0"
+        self.events: Dict[str, EventBase] = {}
+        self.forks: List[_Fork] = []
+
+    def generate(self) -> RoomDag:
+        config = self._config
+
+        fork = self._set_up_room()
+        self.forks.append(fork)
+
+        # Send the ban storms at evenly spaced points amongst the other events.
+        ban_storm_positions = {
+            (i + 1) * config.num_events // (config.num_ban_storms + 1)
+            for i in range(config.num_ban_storms)
+        }
+
+        for i in range(config.num_events):
+            fork = self._rng.choice(self.forks)
+            if self._rng.random() < config.fork_rate:
+                fork = attr.evolve(
+                    fork,
+                    state=dict(fork.state),
+                    joined=list(fork.joined),
+                    power_levels=dict(fork.power_levels),
+                )
+                self.forks.append(fork)
+
+            if i in ban_storm_positions:
+                self._send_ban_storm(fork)
+
+            if self._rng.random() < config.power_levels_churn:
+                self._send_power_levels(fork)
+            else:
+                self._send_membership_or_message(fork)
+
+        return RoomDag(
+            room_id=self.room_id,
+            room_version=config.room_version,
+            creator=self.creator,
+            events=self.events,
+            state_sets=[fork.state for fork in self.forks],
+        )
+
+    def _set_up_room(self) -> _Fork:
+        create = self._make_event(
+            None,
+            EventTypes.Create,
+            self.creator,
+            "",
+            {
+                "creator": self.creator,
+                "room_version": self._config.room_version.identifier,
+            },
+        )
+        fork = _Fork(
+            tip=create.event_id,
+            depth=create.depth,
+            state={(EventTypes.Create, ""): create.event_id},
+            joined=[],
+            power_levels={self.creator: 100},
+        )
+
+        self._send_membership(fork, self.creator, self.creator, Membership.JOIN)
+        self._send_power_levels(fork)
+        self._send(
+            fork,
+            EventTypes.JoinRules,
+            self.creator,
+            "",
+            {"join_rule": JoinRules.PUBLIC},
+        )
+
+        for i in range(self._config.num_members):
+            user_id = "@user%d:synmark%d" % (i, i % NUM_SERVERS)
+            self._send_membership(fork, user_id, user_id, Membership.JOIN)
+
+        return fork
+
+    def _send_ban_storm(self, fork: _Fork) -> None:
+        targets = [user_id for user_id in fork.joined if user_id != self.creator]
+        targets = self._rng.sample(
+            targets, min(len(targets), self._config.ban_storm_size)
+        )
+        for user_id in targets:
+            self._send_membership(fork, self.creator, user_id, Membership.BAN)
+
+    def _send_power_levels(self, fork: _Fork) -> None:
+        candidates = [user_id for user_id in fork.joined if user_id != self.creator]
+        if candidates:
+            user_id = self._rng.choice(candidates)
+            if fork.power_levels.pop(user_id, None) is None:
+                fork.power_levels[user_id] = 50
+
+        self._send(
+            fork,
+            EventTypes.PowerLevels,
+            self.creator,
+            "",
+            {"users": dict(fork.power_levels)},
+        )
+
+    def _send_membership_or_message(self, fork: _Fork) -> None:
+        """Sends a message from a random member, or has someone join or leave."""
+        choice = self._rng.random()
+        if choice < 0.1:
+            user_id = "@user%d:synmark%d" % (
+                self._rng.randrange(self._config.num_members),
+                self._rng.randrange(NUM_SERVERS),
+            )
+            if fork.state.get((EventTypes.Member, user_id)) is None:
+                self._send_membership(fork, user_id, user_id, Membership.JOIN)
+                return
+
+        if choice < 0.2 and len(fork.joined) > 1:
+            user_id = self._rng.choice(fork.joined)
+            if user_id != self.creator:
+                self._send_membership(fork, user_id, user_id, Membership.LEAVE)
+                return
+
+        self._send(
+            fork,
+            EventTypes.Message,
+            self._rng.choice(fork.joined),
+            None,
+            {"msgtype": "m.text", "body": "Hello"},
+        )
+
+    def _send_membership(
+        self, fork: _Fork, sender: str, target: str, membership: str
+    ) -> None:
+        self._send(fork, EventTypes.Member, sender, target, {"membership": membership})
+        if membership == Membership.JOIN:
+            fork.joined.append(target)
+        else:
+            fork.joined.remove(target)
+            fork.power_levels.pop(target, None)
+
+    def _send(
+        self,
+        fork: _Fork,
+        event_type: str,
+        sender: str,
+        state_key: Optional[str],
+        content: Dict[str, Any],
+    ) -> None:
+        event = self._make_event(fork, event_type, sender, state_key, content)
+        fork.tip = event.event_id
+        fork.depth = event.depth
+        if state_key is not None:
+            fork.state[(event_type, state_key)] = event.event_id
+
+    def _make_event(
+        self,
+        fork: Optional[_Fork],
+        event_type: str,
+        sender: str,
+        state_key: Optional[str],
+        content: Dict[str, Any],
+    ) -> EventBase:
+        auth_event_ids: List[str] = []
+        if fork is not None:
+            auth_types = {
+                (EventTypes.Create, ""),
+                (EventTypes.PowerLevels, ""),
+                (EventTypes.Member, sender),
+            }
+            if event_type == EventTypes.Member:
+                assert state_key is not None
+                auth_types.add((EventTypes.Member, state_key))
+                if content["membership"] == Membership.JOIN:
+                    auth_types.add((EventTypes.JoinRules, ""))
+            auth_event_ids = [
+                fork.state[auth_type]
+                for auth_type in sorted(auth_types)
+                if auth_type in fork.state
+            ]
+
+        self._ts += 1
+        event_dict: Dict[str, Any] = {
+            "room_id": self.room_id,
+            "sender": sender,
+            "type": event_type,
+            "content": content,
+            "auth_events": auth_event_ids,
+            "prev_events": [fork.tip] if fork is not None else [],
+            "depth": fork.depth + 1 if fork is not None else 1,
+            "origin_server_ts": self._ts,
+            "hashes": {"sha256": "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"},
+            "signatures": {},
+        }
+        if state_key is not None:
+            event_dict["state_key"] = state_key
+
+        event = make_event_from_dict(event_dict, self._config.room_version)
+        self.events[event.event_id] = event
+        return event
+
+
+def generate_room_dag(config: RoomDagConfig) -> RoomDag:
+    """Generates a synthetic room DAG of the given shape.
+
+    The events all pass the auth rules against their auth events. They are not
+    signed, and their hashes are not valid.
+    """
+    return _RoomDagGenerator(config).generate()
+
+
+def get_auth_graph(
+    room: RoomDag, event_ids: Optional[Set[str]] = None
+) -> Dict[str, Set[str]]:
+    """Returns the graph of the auth events of the given events (or all the events
+    in the room), as used by `lexicographical_topological_sort`.
+    """
+    if event_ids is None:
+        event_ids = set(room.events)
+    return {
+        event_id: {
+            auth_id
+            for auth_id in room.events[event_id].auth_event_ids()
+            if auth_id in event_ids
+        }
+        for event_id in event_ids
+    }
@@ -1,4 +1,14 @@
-from . import logging, lrucache, lrucache_evict
+from . import (
+    auth_chain_difference,
+    auth_checks,
+    event_fetch,
+    logging,
+    lrucache,
+    lrucache_evict,
+    state_res,
+    state_res_mainline,
+    topological_sort,
+)
 
 SUITES = [
     (logging, 1000),
@@ -6,4 +16,10 @@ SUITES = [
     (logging, None),
     (lrucache, None),
     (lrucache_evict, None),
+    (event_fetch, 20),
+    (state_res_mainline, 10),
+    (state_res, 10),
+    (auth_checks, 10),
+    (topological_sort, 10),
+    (auth_chain_difference, 10),
 ]
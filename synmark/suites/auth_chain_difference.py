@@ -0,0 +1,45 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pyperf import perf_counter
+
+from synapse.types import ISynapseReactor
+from synmark.suites.event_fetch import run
+from synmark.suites.state_res import ROOM_DAG_CONFIG, make_homeserver_with_room_dag
+
+
+async def main(reactor: ISynapseReactor, loops: int) -> float:
+    """
+    Benchmark `loops` number of calculations from the database of the auth chain
+    difference between the forward extremities of a synthetic room.
+    """
+    hs, hs_reactor, room = make_homeserver_with_room_dag(ROOM_DAG_CONFIG)
+    store = hs.get_datastores().main
+    state_sets = [set(state.values()) for state in room.state_sets]
+
+    total = 0.0
+    for _ in range(loops):
+        # Make sure we measure the database queries, rather than the caches.
+        store._event_auth_cache.clear()
+        store._auth_dag_cache.clear()
+        store._chain_cover_index_cache.clear()
+
+        start = perf_counter()
+        difference = run(
+            hs_reactor, store.get_auth_chain_difference(room.room_id, state_sets)
+        )
+        total += perf_counter() - start
+
+        assert difference
+
+    return total
@@ -0,0 +1,39 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pyperf import perf_counter
+
+from synapse.event_auth import check_state_dependent_auth_rules
+from synapse.types import ISynapseReactor
+from synmark.room_dag import generate_room_dag
+from synmark.suites.state_res import ROOM_DAG_CONFIG
+
+
+async def main(reactor: ISynapseReactor, loops: int) -> float:
+    """
+    Benchmark `loops` number of state-dependent auth checks of every event in a
+    synthetic room against its auth events.
+    """
+    room = generate_room_dag(ROOM_DAG_CONFIG)
+    events_and_auth_events = [
+        (event, room.auth_events(event)) for event in room.events.values()
+    ]
+
+    total = 0.0
+    for _ in range(loops):
+        start = perf_counter()
+        for event, auth_events in events_and_auth_events:
+            check_state_dependent_auth_rules(event, auth_events)
+        total += perf_counter() - start
+
+    return total
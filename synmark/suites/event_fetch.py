@@ -0,0 +1,108 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Awaitable, List, Tuple, TypeVar
+
+from pyperf import perf_counter
+
+from twisted.internet.defer import Deferred, ensureDeferred
+from twisted.python.failure import Failure
+
+from synapse.server import HomeServer
+from synapse.types import ISynapseReactor, create_requester
+
+from tests.server import ThreadedMemoryReactorClock, get_clock, setup_test_homeserver
+
+T = TypeVar("T")
+
+# The number of events fetched in each loop.
+NUM_EVENTS = 500
+
+
+def run(reactor: ThreadedMemoryReactorClock, awaitable: Awaitable[T]) -> T:
+    """Run the awaitable to completion on the given memory reactor."""
+    d: "Deferred[T]" = ensureDeferred(awaitable)  # type: ignore[arg-type]
+    while not d.called:
+        reactor.advance(0)
+    if isinstance(d.result, Failure):
+        d.result.raiseException()
+    # mypy thinks this is an object for some reason.
+    return d.result  # type: ignore[return-value]
+
+
+def make_homeserver_with_events() -> (
+    Tuple[HomeServer, ThreadedMemoryReactorClock, List[str]]
+):
+    """Set up a homeserver with a room containing `NUM_EVENTS` messages.
+
+    The homeserver runs on a memory reactor, with synchronous database
+    transactions, like in the unit tests.
+
+    Returns:
+        The homeserver, its reactor, and the IDs of the messages.
+    """
+    reactor, clock = get_clock()
+    hs = setup_test_homeserver(lambda _: None, reactor=reactor, clock=clock)
+
+    user_id = run(
+        reactor, hs.get_registration_handler().register_user(localpart="synmark")
+    )
+    requester = create_requester(user_id)
+    room_id, _, _ = run(
+        reactor, hs.get_room_creation_handler().create_room(requester, {})
+    )
+
+    event_creation_handler = hs.get_event_creation_handler()
+    event_ids = []
+    for i in range(NUM_EVENTS):
+        event, _ = run(
+            reactor,
+            event_creation_handler.create_and_send_nonmember_event(
+                requester,
+                {
+                    "type": "m.room.message",
+                    "room_id": room_id,
+                    "sender": user_id,
+                    "content": {"msgtype": "m.text", "body": "Message %d" % (i,)},
+                },
+            ),
+        )
+        event_ids.append(event.event_id)
+
+    return hs, reactor, event_ids
+
+
+def clear_event_caches(hs: HomeServer) -> None:
+    store = hs.get_datastores().main
+    store._get_event_cache.clear()
+    store._event_ref.clear()
+
+
+async def main(reactor: ISynapseReactor, loops: int) -> float:
+    """
+    Benchmark `loops` number of fetches of `NUM_EVENTS` uncached events.
+    """
+    hs, hs_reactor, event_ids = make_homeserver_with_events()
+    store = hs.get_datastores().main
+
+    total = 0.0
+    for _ in range(loops):
+        clear_event_caches(hs)
+
+        start = perf_counter()
+        events = run(hs_reactor, store.get_events_as_list(event_ids))
+        total += perf_counter() - start
+
+        assert len(events) == NUM_EVENTS
+
+    return total
@@ -0,0 +1,108 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Tuple
+
+from pyperf import perf_counter
+
+from synapse.events.snapshot import EventContext
+from synapse.server import HomeServer
+from synapse.state import StateResolutionStore, v2
+from synapse.types import ISynapseReactor
+from synapse.util import Clock
+from synmark.room_dag import RoomDag, RoomDagConfig, generate_room_dag
+from synmark.suites.event_fetch import run
+
+from tests.server import ThreadedMemoryReactorClock, get_clock, setup_test_homeserver
+
+# The shape of the room to resolve the state of. Each fork of the DAG gives a
+# state set to resolve.
+ROOM_DAG_CONFIG = RoomDagConfig(
+    num_members=200,
+    num_events=2000,
+    fork_rate=0.005,
+    power_levels_churn=0.02,
+    num_ban_storms=2,
+    ban_storm_size=50,
+)
+
+# The number of events to persist in each batch.
+PERSIST_BATCH_SIZE = 100
+
+
+def make_homeserver_with_room_dag(
+    config: RoomDagConfig,
+) -> Tuple[HomeServer, ThreadedMemoryReactorClock, RoomDag]:
+    """Set up a homeserver with a synthetic room DAG of the given shape.
+
+    The homeserver runs on a memory reactor, with synchronous database
+    transactions, like in the unit tests. It uses Postgres if `SYNAPSE_POSTGRES`
+    is set, and SQLite otherwise.
+
+    The events are persisted as outliers, as if they had been pulled in over
+    federation, so they have auth chains (and a chain cover index) but no state
+    is calculated for them.
+    """
+    reactor, clock = get_clock()
+    hs = setup_test_homeserver(lambda _: None, reactor=reactor, clock=clock)
+    room = generate_room_dag(config)
+
+    store = hs.get_datastores().main
+    run(
+        reactor,
+        store.store_room(room.room_id, room.creator, False, room.room_version),
+    )
+
+    persistence = hs.get_storage_controllers().persistence
+    assert persistence is not None
+    events = list(room.events.values())
+    for i in range(0, len(events), PERSIST_BATCH_SIZE):
+        batch = []
+        for event in events[i : i + PERSIST_BATCH_SIZE]:
+            event.internal_metadata.outlier = True
+            batch.append(
+                (event, EventContext.for_outlier(hs.get_storage_controllers()))
+            )
+        run(reactor, persistence.persist_events(batch, backfilled=True))
+
+    return hs, reactor, room
+
+
+async def main(reactor: ISynapseReactor, loops: int) -> float:
+    """
+    Benchmark `loops` number of resolutions of the state at the forward extremities
+    of a synthetic room, with the events fetched from the database.
+    """
+    hs, hs_reactor, room = make_homeserver_with_room_dag(ROOM_DAG_CONFIG)
+    state_res_store = StateResolutionStore(hs.get_datastores().main)
+    clock = Clock(hs_reactor)
+
+    total = 0.0
+    for _ in range(loops):
+        start = perf_counter()
+        resolved_state = run(
+            hs_reactor,
+            v2.resolve_events_with_store(
+                clock,
+                room.room_id,
+                room.room_version,
+                room.state_sets,
+                {},
+                state_res_store,
+            ),
+        )
+        total += perf_counter() - start
+
+        assert resolved_state
+
+    return total
@@ -0,0 +1,199 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+from pyperf import perf_counter
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.api.room_versions import RoomVersions
+from synapse.events import EventBase, make_event_from_dict
+from synapse.state import v2
+from synapse.types import ISynapseReactor, StateMap, StrCollection
+from synapse.util import Clock
+
+ROOM_ID = "!synmark:example.com"
+ALICE = "@alice:example.com"
+
+# The number of power levels events in the room's mainline.
+MAINLINE_LENGTH = 1000
+
+# The number and length of forks in the power levels history, which the conflicted
+# events point at.
+NUM_POWER_LEVELS_FORKS = 20
+POWER_LEVELS_FORK_LENGTH = 50
+
+# The number of conflicted events in each of the two state sets.
+NUM_CONFLICTED_EVENTS = 500
+
+
+class _Room:
+    """A synthetic room with a deep power levels history, and two state sets which
+    conflict in many non-power events whose power levels auth events are spread
+    across forks of that history.
+    """
+
+    def __init__(self) -> None:
+        self.event_map: Dict[str, EventBase] = {}
+        self._next_id = 0
+        self._rng = random.Random(0)
+
+        create = self._add_event(
+            EventTypes.Create, "", {"creator": ALICE}, auth_event_ids=[]
+        )
+        member = self._add_event(
+            EventTypes.Member, ALICE, {"membership": Membership.JOIN}, [create]
+        )
+
+        mainline = [
+            self._add_event(
+                EventTypes.PowerLevels, "", {"users": {ALICE: 100}}, [create, member]
+            )
+        ]
+        for _ in range(MAINLINE_LENGTH - 1):
+            mainline.append(
+                self._add_event(
+                    EventTypes.PowerLevels,
+                    "",
+                    {"users": {ALICE: 100}},
+                    [create, member, mainline[-1]],
+                )
+            )
+
+        fork_power_levels = []
+        for _ in range(NUM_POWER_LEVELS_FORKS):
+            pl = self._rng.choice(mainline)
+            for _ in range(POWER_LEVELS_FORK_LENGTH):
+                pl = self._add_event(
+                    EventTypes.PowerLevels,
+                    "",
+                    {"users": {ALICE: 100}},
+                    [create, member, pl],
+                )
+                fork_power_levels.append(pl)
+
+        base_state = {
+            (EventTypes.Create, ""): create,
+            (EventTypes.Member, ALICE): member,
+            (EventTypes.PowerLevels, ""): mainline[-1],
+        }
+        self.state_sets: List[StateMap[str]] = []
+        for _ in range(2):
+            state = dict(base_state)
+            for i in range(NUM_CONFLICTED_EVENTS):
+                state[("org.matrix.synmark", str(i))] = self._add_event(
+                    "org.matrix.synmark",
+                    str(i),
+                    {},
+                    [create, member, self._rng.choice(fork_power_levels)],
+                )
+            self.state_sets.append(state)
+
+    def _add_event(
+        self,
+        event_type: str,
+        state_key: str,
+        content: Dict[str, object],
+        auth_event_ids: List[str],
+    ) -> str:
+        self._next_id += 1
+        event_id = "$%d:example.com" % (self._next_id,)
+        self.event_map[event_id] = make_event_from_dict(
+            {
+                "event_id": event_id,
+                "room_id": ROOM_ID,
+                "sender": ALICE,
+                "type": event_type,
+                "state_key": state_key,
+                "content": content,
+                "auth_events": [(auth_id, {}) for auth_id in auth_event_ids],
+                "prev_events": [],
+                "depth": self._next_id,
+                "origin_server_ts": self._next_id,
+                "hashes": {"sha256": "aaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa"},
+                "signatures": {},
+            },
+            RoomVersions.V2,
+        )
+        return event_id
+
+
+class _StateResolutionStore:
+    def __init__(self, event_map: Dict[str, EventBase]):
+        self._event_map = event_map
+        self._auth_chain_differences: Dict[Tuple[FrozenSet[str], ...], Set[str]] = {}
+
+    async def get_events(
+        self, event_ids: StrCollection, allow_rejected: bool = False
+    ) -> Dict[str, EventBase]:
+        return {
+            event_id: self._event_map[event_id]
+            for event_id in event_ids
+            if event_id in self._event_map
+        }
+
+    async def get_auth_chain_difference(
+        self, room_id: str, state_sets: List[Set[str]]
+    ) -> Set[str]:
+        # This isn't what we're measuring, so only calculate it once.
+        key = tuple(frozenset(state_set) for state_set in state_sets)
+        difference = self._auth_chain_differences.get(key)
+        if difference is None:
+            auth_chains = [self._get_auth_chain(state_set) for state_set in state_sets]
+            common = auth_chains[0].intersection(*auth_chains[1:])
+            difference = auth_chains[0].union(*auth_chains[1:]) - common
+            self._auth_chain_differences[key] = difference
+        return set(difference)
+
+    def _get_auth_chain(self, event_ids: Set[str]) -> Set[str]:
+        auth_chain: Set[str] = set()
+        stack = list(event_ids)
+        while stack:
+            event_id = stack.pop()
+            if event_id not in auth_chain:
+                auth_chain.add(event_id)
+                stack.extend(self._event_map[event_id].auth_event_ids())
+        return auth_chain
+
+
+async def main(reactor: ISynapseReactor, loops: int) -> float:
+    """
+    Benchmark `loops` number of state resolutions in a room with a deep power levels
+    history, sharing the room's mainlines between them.
+    """
+    room = _Room()
+    clock = Clock(reactor)
+    store = _StateResolutionStore(room.event_map)
+    mainline_cache = v2.MainlineCache()
+
+    total = 0.0
+    resolved_state: Optional[StateMap[str]] = None
+    for _ in range(loops):
+        start = perf_counter()
+        resolved_state = await v2.resolve_events_with_store(
+            clock,
+            ROOM_ID,
+            RoomVersions.V2,
+            room.state_sets,
+            {},
+            store,
+            mainline_cache,
+        )
+        total += perf_counter() - start
+
+    assert resolved_state is not None
+    assert len(resolved_state) == 3 + NUM_CONFLICTED_EVENTS
+
+    return total
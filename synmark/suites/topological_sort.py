@@ -0,0 +1,51 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from typing import Tuple
+
+from pyperf import perf_counter
+
+from synapse.state.v2 import lexicographical_topological_sort
+from synapse.types import ISynapseReactor
+from synmark.room_dag import generate_room_dag, get_auth_graph
+from synmark.suites.state_res import ROOM_DAG_CONFIG
+
+
+async def main(reactor: ISynapseReactor, loops: int) -> float:
+    """
+    Benchmark `loops` number of lexicographical topological sorts of the auth
+    graph of every event in a synthetic room, ordered as state resolution orders
+    power events.
+    """
+    room = generate_room_dag(ROOM_DAG_CONFIG)
+    auth_graph = get_auth_graph(room)
+
+    def _get_power_order(event_id: str) -> Tuple[int, int, str]:
+        event = room.events[event_id]
+        power_level = 100 if event.sender == room.creator else 0
+        return -power_level, event.origin_server_ts, event_id
+
+    total = 0.0
+    for _ in range(loops):
+        # The sort consumes the graph.
+        graph = {event_id: set(edges) for event_id, edges in auth_graph.items()}
+
+        start = perf_counter()
+        sorted_event_ids = list(
+            lexicographical_topological_sort(graph, _get_power_order)
+        )
+        total += perf_counter() - start
+
+        assert len(sorted_event_ids) == len(room.events)
+
+    return total
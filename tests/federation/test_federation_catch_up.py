@@ -7,6 +7,7 @@ from twisted.test.proto_helpers import MemoryReactor
 from synapse.api.constants import EventTypes
 from synapse.events import EventBase
 from synapse.federation.sender import (
+    CatchUpCoordinator,
     FederationSender,
     PerDestinationQueue,
     TransactionManager,
@@ -72,7 +73,10 @@ class FederationCatchUpTestCases(FederatingHomeserverTestCase):
         return config
 
     async def record_transaction(
-        self, txn: Transaction, json_cb: Optional[Callable[[], JsonDict]]
+        self,
+        txn: Transaction,
+        json_cb: Optional[Callable[[], JsonDict]],
+        encoded_json_cb: Optional[Callable[[], bytes]] = None,
     ) -> JsonDict:
         if json_cb is None:
             # The tests seem to expect that this method raises in this situation.
@@ -269,13 +273,19 @@ class FederationCatchUpTestCases(FederatingHomeserverTestCase):
         self.assertEqual(self.pdus[1]["content"]["body"], "wombats!")
 
     def make_fake_destination_queue(
-        self, destination: str = "host2"
+        self,
+        destination: str = "host2",
+        catch_up_coordinator: Optional[CatchUpCoordinator] = None,
     ) -> Tuple[PerDestinationQueue, List[EventBase]]:
         """
         Makes a fake per-destination queue.
         """
         transaction_manager = TransactionManager(self.hs)
-        per_dest_queue = PerDestinationQueue(self.hs, transaction_manager, destination)
+        if catch_up_coordinator is None:
+            catch_up_coordinator = CatchUpCoordinator(self.hs)
+        per_dest_queue = PerDestinationQueue(
+            self.hs, transaction_manager, catch_up_coordinator, destination
+        )
         results_list = []
 
         async def fake_send(
@@ -498,6 +508,103 @@ class FederationCatchUpTestCases(FederatingHomeserverTestCase):
         self.assertEqual(sent_pdus[0].event_id, event_2.event_id)
         self.assertFalse(per_dest_queue._catching_up)
 
+    def test_catch_up_shares_extremities(self) -> None:
+        """Test that destinations catching up on the same room share the work of
+        fetching its extremities.
+        """
+        catch_up_coordinator = CatchUpCoordinator(self.hs)
+        queue_2, sent_pdus_2 = self.make_fake_destination_queue(
+            "host2", catch_up_coordinator
+        )
+        queue_4, sent_pdus_4 = self.make_fake_destination_queue(
+            "host4", catch_up_coordinator
+        )
+
+        # Make a room with a local user and three servers. Two will go offline
+        # and one will send some events.
+        self.register_user("u1", "you the one")
+        u1_token = self.login("u1", "you the one")
+        room_1 = self.helper.create_room_as("u1", tok=u1_token)
+
+        self.get_success(
+            event_injection.inject_member_event(self.hs, room_1, "@user:host2", "join")
+        )
+        self.get_success(
+            event_injection.inject_member_event(self.hs, room_1, "@user:host4", "join")
+        )
+        event_1 = self.get_success(
+            event_injection.inject_member_event(self.hs, room_1, "@user:host3", "join")
+        )
+
+        self.helper.send(room_1, "you hear me!!", tok=u1_token)
+        event_2 = self.get_success(
+            event_injection.inject_event(
+                self.hs,
+                type=EventTypes.Message,
+                sender="@user:host3",
+                room_id=room_1,
+                content={"msgtype": "m.text", "body": "Hello"},
+            )
+        )
+
+        store = self.hs.get_datastores().main
+        assert event_1.internal_metadata.stream_ordering is not None
+        for destination in ("host2", "host4"):
+            self.get_success(
+                store.set_destination_last_successful_stream_ordering(
+                    destination, event_1.internal_metadata.stream_ordering
+                )
+            )
+
+        get_prev_events_for_room = Mock(side_effect=store.get_prev_events_for_room)
+        store.get_prev_events_for_room = get_prev_events_for_room  # type: ignore[method-assign]
+
+        self.get_success(queue_2._catch_up_transmission_loop())
+        self.get_success(queue_4._catch_up_transmission_loop())
+
+        # Both destinations are sent the latest event, but the room's extremities
+        # were only fetched once.
+        self.assertEqual([pdu.event_id for pdu in sent_pdus_2], [event_2.event_id])
+        self.assertEqual([pdu.event_id for pdu in sent_pdus_4], [event_2.event_id])
+        get_prev_events_for_room.assert_called_once_with(room_1)
+
+        # Neither destination is still behind.
+        self.assertEqual(catch_up_coordinator._get_backlogs(), {})
+
+    def test_catch_up_refetches_stale_extremities(self) -> None:
+        """Test that we don't use shared extremities which were fetched before the
+        event we are catching up on was persisted.
+        """
+        catch_up_coordinator = CatchUpCoordinator(self.hs)
+        per_dest_queue, sent_pdus = self.make_fake_destination_queue(
+            "host2", catch_up_coordinator
+        )
+
+        self.register_user("u1", "you the one")
+        u1_token = self.login("u1", "you the one")
+        room_1 = self.helper.create_room_as("u1", tok=u1_token)
+        event_1 = self.get_success(
+            event_injection.inject_member_event(self.hs, room_1, "@user:host2", "join")
+        )
+
+        # Another destination fills the shared cache with the room's extremities...
+        self.get_success(catch_up_coordinator.get_room_extremities(room_1, 0))
+
+        # ... before we send an event which host2 misses.
+        event_id_2 = self.helper.send(room_1, "you hear me!!", tok=u1_token)["event_id"]
+
+        assert event_1.internal_metadata.stream_ordering is not None
+        self.get_success(
+            self.hs.get_datastores().main.set_destination_last_successful_stream_ordering(
+                "host2", event_1.internal_metadata.stream_ordering
+            )
+        )
+
+        self.get_success(per_dest_queue._catch_up_transmission_loop())
+
+        self.assertEqual([pdu.event_id for pdu in sent_pdus], [event_id_2])
+        self.assertFalse(per_dest_queue._catching_up)
+
     def test_catch_up_is_not_blocked_by_remote_event_in_partial_state_room(
         self,
     ) -> None:
@@ -14,6 +14,7 @@
 from typing import Callable, FrozenSet, List, Optional, Set
 from unittest.mock import AsyncMock, Mock
 
+from canonicaljson import encode_canonical_json
 from signedjson import key, sign
 from signedjson.types import BaseKey, SigningKey
 
@@ -21,7 +22,16 @@ from twisted.internet import defer
 from twisted.test.proto_helpers import MemoryReactor
 
 from synapse.api.constants import EduTypes, RoomEncryptionAlgorithms
-from synapse.federation.units import Transaction
+from synapse.api.room_versions import RoomVersions
+from synapse.events import make_event_from_dict
+from synapse.federation.sender import FederationSender
+from synapse.federation.sender.per_destination_queue import (
+    MAX_EDUS_PER_TRANSACTION,
+    TrafficClass,
+    TransactionScheduler,
+    _TransactionQueueManager,
+)
+from synapse.federation.units import Edu, Transaction
 from synapse.handlers.device import DeviceHandler
 from synapse.rest import admin
 from synapse.rest.client import login
@@ -29,7 +39,8 @@ from synapse.server import HomeServer
 from synapse.types import JsonDict, ReadReceipt
 from synapse.util import Clock
 
-from tests.unittest import HomeserverTestCase
+from tests.server import get_clock
+from tests.unittest import HomeserverTestCase, TestCase
 
 
 class FederationSenderReceiptsTestCases(HomeserverTestCase):
@@ -260,6 +271,160 @@ class FederationSenderReceiptsTestCases(HomeserverTestCase):
         )
 
 
+class FederationSenderPdusTestCases(HomeserverTestCase):
+    def make_homeserver(self, reactor: MemoryReactor, clock: Clock) -> HomeServer:
+        self.federation_transport_client = Mock(spec=["send_transaction"])
+        self.federation_transport_client.send_transaction = AsyncMock(return_value={})
+        return self.setup_test_homeserver(
+            federation_transport_client=self.federation_transport_client,
+        )
+
+    def default_config(self) -> JsonDict:
+        config = super().default_config()
+        config["federation_sender_instances"] = None
+        return config
+
+    def test_pdus_serialized_once(self) -> None:
+        """A PDU sent to several destinations is only serialized once."""
+        federation_sender = self.hs.get_federation_sender()
+        assert isinstance(federation_sender, FederationSender)
+        transaction_manager = federation_sender._transaction_manager
+
+        event = make_event_from_dict(
+            {
+                "room_id": "!room:test",
+                "type": "m.room.message",
+                "sender": "@user:test",
+                "content": {"msgtype": "m.text", "body": "h\u00e9llo"},
+                "auth_events": [],
+                "prev_events": [],
+                "depth": 1,
+                "origin_server_ts": 1234,
+            },
+            RoomVersions.V10,
+        )
+        for destination in ("host2", "host3"):
+            self.get_success(
+                transaction_manager.send_new_transaction(destination, [event], [])
+            )
+
+        mock_send_transaction = self.federation_transport_client.send_transaction
+        self.assertEqual(mock_send_transaction.call_count, 2)
+        (txn1, _, _), (txn2, _, _) = (
+            call[0] for call in mock_send_transaction.call_args_list
+        )
+        self.assertIs(txn1.pdus[0], txn2.pdus[0])
+
+        for call in mock_send_transaction.call_args_list:
+            _, json_cb, encoded_json_cb = call[0]
+            data = json_cb()
+            self.assertEqual(data["pdus"], [event.get_pdu_json()])
+            self.assertEqual(encoded_json_cb(), encode_canonical_json(data))
+
+
+class TransactionSchedulerTestCases(TestCase):
+    def setUp(self) -> None:
+        self.reactor, clock = get_clock()
+        self.scheduler = TransactionScheduler(clock)
+
+    def test_allocate(self) -> None:
+        """Classes get up to their demand, and share the rest by weight."""
+        allocation = self.scheduler.allocate(
+            {
+                TrafficClass.TYPING: 2,
+                TrafficClass.PRESENCE: 0,
+                TrafficClass.TO_DEVICE: None,
+                TrafficClass.DEVICE_LISTS: None,
+            },
+            MAX_EDUS_PER_TRANSACTION,
+        )
+        self.assertEqual(allocation[TrafficClass.TYPING], 2)
+        self.assertEqual(allocation[TrafficClass.PRESENCE], 0)
+        self.assertEqual(sum(allocation.values()), MAX_EDUS_PER_TRANSACTION)
+        self.assertApproximates(
+            allocation[TrafficClass.TO_DEVICE] / allocation[TrafficClass.DEVICE_LISTS],
+            2,
+            0.1,
+        )
+
+    def test_allocate_overdue(self) -> None:
+        """Classes waiting longer than their latency target get a larger share."""
+        self.scheduler.note_pending(TrafficClass.DEVICE_LISTS)
+        self.reactor.advance(60)
+
+        demand = {TrafficClass.TO_DEVICE: None, TrafficClass.DEVICE_LISTS: None}
+        allocation = self.scheduler.allocate(demand, MAX_EDUS_PER_TRANSACTION)
+        self.assertGreater(
+            allocation[TrafficClass.DEVICE_LISTS], allocation[TrafficClass.TO_DEVICE]
+        )
+
+        # Once everything has been sent, it goes back to its normal share.
+        self.scheduler.note_sent(TrafficClass.DEVICE_LISTS, drained=True)
+        allocation = self.scheduler.allocate(demand, MAX_EDUS_PER_TRANSACTION)
+        self.assertLess(
+            allocation[TrafficClass.DEVICE_LISTS], allocation[TrafficClass.TO_DEVICE]
+        )
+
+
+class TransactionQueueManagerTestCases(HomeserverTestCase):
+    def default_config(self) -> JsonDict:
+        config = super().default_config()
+        config["federation_sender_instances"] = None
+        return config
+
+    def test_to_device_backlog(self) -> None:
+        """Typing EDUs get slots behind a backlog of to-device messages, and the
+        to-device messages get all the other slots.
+        """
+        store = self.hs.get_datastores().main
+        for i in range(2 * MAX_EDUS_PER_TRANSACTION):
+            self.get_success(
+                store.add_messages_to_device_inbox(
+                    {},
+                    {
+                        "host2": {
+                            "sender": "@user:test",
+                            "type": "m.test",
+                            "message_id": str(i),
+                            "messages": {},
+                        }
+                    },
+                )
+            )
+
+        federation_sender = self.hs.get_federation_sender()
+        assert isinstance(federation_sender, FederationSender)
+        queue = federation_sender._get_per_destination_queue("host2")
+        for i in range(5):
+            edu = Edu(
+                origin="test",
+                destination="host2",
+                edu_type=EduTypes.TYPING,
+                content={"room_id": "!room%d:test" % (i,)},
+            )
+            queue._pending_edus_keyed[(EduTypes.TYPING, i)] = edu
+
+        async def get_edus() -> List[Edu]:
+            async with _TransactionQueueManager(queue) as (_, edus):
+                return edus
+
+        edus = self.get_success(get_edus())
+        edu_types = [edu.edu_type for edu in edus]
+        self.assertEqual(len(edus), MAX_EDUS_PER_TRANSACTION)
+        self.assertEqual(edu_types.count(EduTypes.TYPING), 5)
+        self.assertEqual(
+            edu_types.count(EduTypes.DIRECT_TO_DEVICE), MAX_EDUS_PER_TRANSACTION - 5
+        )
+
+        # The to-device messages are all different ones.
+        message_ids = {
+            edu.content["message_id"]
+            for edu in edus
+            if edu.edu_type == EduTypes.DIRECT_TO_DEVICE
+        }
+        self.assertEqual(len(message_ids), MAX_EDUS_PER_TRANSACTION - 5)
+
+
 class FederationSenderDevicesTestCases(HomeserverTestCase):
     """
     Test federation sending to update devices.
@@ -321,7 +486,10 @@ class FederationSenderDevicesTestCases(HomeserverTestCase):
         )
 
     async def record_transaction(
-        self, txn: Transaction, json_cb: Optional[Callable[[], JsonDict]] = None
+        self,
+        txn: Transaction,
+        json_cb: Optional[Callable[[], JsonDict]] = None,
+        encoded_json_cb: Optional[Callable[[], bytes]] = None,
     ) -> JsonDict:
         assert json_cb is not None
         data = json_cb()
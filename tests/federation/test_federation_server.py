@@ -14,14 +14,17 @@
 # limitations under the License.
 import logging
 from http import HTTPStatus
+from typing import Dict, List
 
 from parameterized import parameterized
 
+from twisted.internet.defer import Deferred
 from twisted.test.proto_helpers import MemoryReactor
 
 from synapse.api.room_versions import KNOWN_ROOM_VERSIONS
 from synapse.config.server import DEFAULT_ROOM_VERSION
 from synapse.events import EventBase, make_event_from_dict
+from synapse.federation.incoming_pdus import IncomingPduScheduler
 from synapse.rest import admin
 from synapse.rest.client import login, room
 from synapse.server import HomeServer
@@ -332,6 +335,67 @@ class SendJoinFederationTests(unittest.FederatingHomeserverTestCase):
     #   is probably sufficient to reassure that the bucket is updated.
 
 
+class IncomingPduSchedulerTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor: MemoryReactor, clock: Clock, hs: HomeServer) -> None:
+        # The rooms we've started processing, in order.
+        self.processed: List[str] = []
+        # The `Deferred`s to resolve to finish processing each room, with whether
+        # there's more to process.
+        self.unblock: Dict[str, "Deferred[bool]"] = {}
+
+    async def _process_room(self, room_id: str) -> bool:
+        self.processed.append(room_id)
+        d: "Deferred[bool]" = Deferred()
+        self.unblock[room_id] = d
+        return await d
+
+    def _finish(self, room_id: str, more_to_process: bool = False) -> None:
+        self.unblock.pop(room_id).callback(more_to_process)
+        self.pump()
+
+    def test_bounded_workers(self) -> None:
+        """Only a limited number of rooms are processed at once."""
+        scheduler = IncomingPduScheduler(self.hs, self._process_room, max_workers=2)
+        for room_id in ("!a", "!b", "!c"):
+            scheduler.schedule(room_id, "remote")
+        self.assertEqual(self.processed, ["!a", "!b"])
+
+        self._finish("!a")
+        self.assertEqual(self.processed, ["!a", "!b", "!c"])
+
+    def test_fair_across_origins(self) -> None:
+        """Rooms are taken from each sending server in turn."""
+        scheduler = IncomingPduScheduler(self.hs, self._process_room, max_workers=1)
+        for room_id in ("!a1", "!a2", "!a3"):
+            scheduler.schedule(room_id, "chatty")
+        scheduler.schedule("!b1", "quiet")
+
+        for room_id in ("!a1", "!a2", "!b1"):
+            self._finish(room_id)
+        self.assertEqual(self.processed, ["!a1", "!a2", "!b1", "!a3"])
+
+    def test_requeue(self) -> None:
+        """Rooms with more to process, or which were scheduled while being
+        processed, are processed again.
+        """
+        scheduler = IncomingPduScheduler(self.hs, self._process_room, max_workers=1)
+        scheduler.schedule("!a", "remote")
+        scheduler.schedule("!b", "remote")
+
+        # The room still has more to process, so goes to the back of the queue.
+        self._finish("!a", more_to_process=True)
+        self.assertEqual(self.processed, ["!a", "!b"])
+
+        # A room scheduled while it is processed is processed again.
+        scheduler.schedule("!b", "remote")
+        self._finish("!b")
+        self._finish("!a")
+        self.assertEqual(self.processed, ["!a", "!b", "!a", "!b"])
+
+        self._finish("!b")
+        self.assertEqual(self.unblock, {})
+
+
 def _create_acl_event(content: JsonDict) -> EventBase:
     return make_event_from_dict(
         {
@@ -0,0 +1,149 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Tuple
+
+from twisted.internet import defer
+from twisted.internet.defer import Deferred
+from twisted.test.proto_helpers import MemoryReactor
+
+from synapse.federation.sender.governor import (
+    SLOW_TRANSACTION_SECONDS,
+    TransactionGovernor,
+)
+from synapse.server import HomeServer
+from synapse.util import Clock
+
+from tests import unittest
+
+
+class TransactionGovernorTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor: MemoryReactor, clock: Clock, hs: HomeServer) -> None:
+        self.started: List[str] = []
+
+        # A destination which has recently failed.
+        self.get_success(
+            hs.get_datastores().main.set_destination_retry_timings(
+                "unresponsive", 1000, 1000, 60000
+            )
+        )
+
+    def _start_transaction(
+        self, governor: TransactionGovernor, destination: str, has_pdus: bool = False
+    ) -> Tuple["Deferred[None]", "Deferred[None]"]:
+        """Starts a transaction which stays in flight until unblocked.
+
+        Returns:
+            The `Deferred` for the transaction, and a `Deferred` to resolve to
+            unblock it.
+        """
+        unblock_d: "Deferred[None]" = Deferred()
+
+        async def transaction() -> None:
+            async with governor.transaction(destination, has_pdus):
+                self.started.append(destination)
+                await unblock_d
+
+        d = defer.ensureDeferred(transaction())
+        self.pump()
+        return d, unblock_d
+
+    def test_priority(self) -> None:
+        """Transactions wait for a slot, and are sent in order of priority."""
+        governor = TransactionGovernor(self.hs, max_in_flight=2)
+        _, unblock1 = self._start_transaction(governor, "1")
+        _, unblock2 = self._start_transaction(governor, "2")
+        _, unblock_unresponsive = self._start_transaction(
+            governor, "unresponsive", has_pdus=True
+        )
+        _, unblock_normal = self._start_transaction(governor, "normal")
+        _, unblock_active = self._start_transaction(governor, "active", has_pdus=True)
+        self.assertEqual(self.started, ["1", "2"])
+
+        unblock1.callback(None)
+        self.pump()
+        self.assertEqual(self.started, ["1", "2", "active"])
+
+        unblock2.callback(None)
+        self.pump()
+        self.assertEqual(self.started, ["1", "2", "active", "normal"])
+
+        unblock_active.callback(None)
+        self.pump()
+        self.assertEqual(self.started, ["1", "2", "active", "normal", "unresponsive"])
+
+        unblock_normal.callback(None)
+        unblock_unresponsive.callback(None)
+        self.pump()
+
+    def test_unresponsive_share(self) -> None:
+        """Unresponsive destinations can only use a share of the slots."""
+        governor = TransactionGovernor(self.hs, max_in_flight=4)
+        _, unblock = self._start_transaction(governor, "unresponsive")
+        self._start_transaction(governor, "unresponsive")
+        self.assertEqual(self.started, ["unresponsive"])
+
+        # Other destinations don't wait behind them.
+        self._start_transaction(governor, "normal")
+        self.assertEqual(self.started, ["unresponsive", "normal"])
+
+        unblock.callback(None)
+        self.pump()
+        self.assertEqual(self.started, ["unresponsive", "normal", "unresponsive"])
+
+    def test_slow_destination(self) -> None:
+        """Destinations whose transactions are slow are treated as unresponsive."""
+        governor = TransactionGovernor(self.hs, max_in_flight=4)
+        governor.note_duration("slow", 60)
+
+        self._start_transaction(governor, "slow")
+        self._start_transaction(governor, "slow")
+        self.assertEqual(self.started, ["slow"])
+
+    def test_slow_transactions_give_up_slots(self) -> None:
+        """Transactions which are slow to complete don't stop transactions to
+        other destinations from being sent.
+        """
+        governor = TransactionGovernor(self.hs, max_in_flight=2)
+        _, unblock_slow1 = self._start_transaction(governor, "slow1", has_pdus=True)
+        _, unblock_slow2 = self._start_transaction(governor, "slow2")
+        _, unblock_healthy = self._start_transaction(governor, "healthy")
+        _, unblock_unresponsive = self._start_transaction(governor, "unresponsive")
+        self.assertEqual(self.started, ["slow1", "slow2"])
+
+        # Once the slow transactions have been in flight for a while, the others
+        # can go ahead, but the slow transactions count against the share of
+        # unresponsive destinations.
+        self.reactor.advance(SLOW_TRANSACTION_SECONDS)
+        self.assertEqual(self.started, ["slow1", "slow2", "healthy"])
+
+        unblock_slow1.callback(None)
+        unblock_slow2.callback(None)
+        self.pump()
+        self.assertEqual(self.started, ["slow1", "slow2", "healthy", "unresponsive"])
+
+        unblock_healthy.callback(None)
+        unblock_unresponsive.callback(None)
+        self.pump()
+
+        # All the slots have been given back.
+        self.assertEqual(governor._in_flight, 0)
+        self.assertEqual(governor._unresponsive_in_flight, 0)
+
+    def test_no_limit(self) -> None:
+        """Without a limit, transactions are sent straight away."""
+        governor = TransactionGovernor(self.hs, max_in_flight=None)
+        for _ in range(10):
+            self._start_transaction(governor, "unresponsive")
+        self.assertEqual(len(self.started), 10)
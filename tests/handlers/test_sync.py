@@ -11,24 +11,27 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Optional
+from typing import Any, Dict, Optional
 from unittest.mock import AsyncMock, Mock, patch
 
+from twisted.internet import defer
 from twisted.test.proto_helpers import MemoryReactor
 
-from synapse.api.constants import EventTypes, JoinRules
+from synapse.api.constants import AccountDataTypes, EduTypes, EventTypes, JoinRules
 from synapse.api.errors import Codes, ResourceLimitError
-from synapse.api.filtering import Filtering
+from synapse.api.filtering import FilterCollection, Filtering
 from synapse.api.room_versions import RoomVersions
-from synapse.handlers.sync import SyncConfig, SyncResult
+from synapse.handlers.sync import SyncConfig, SyncResult, _get_sync_snapshot_filter_key
 from synapse.rest import admin
 from synapse.rest.client import knock, login, room
 from synapse.server import HomeServer
-from synapse.types import UserID, create_requester
+from synapse.types import StateMap, UserID, create_requester
+from synapse.types.state import StateFilter
 from synapse.util import Clock
 
 import tests.unittest
 import tests.utils
+from tests.unittest import override_config
 
 
 class SyncTestCase(tests.unittest.HomeserverTestCase):
@@ -164,6 +167,9 @@ class SyncTestCase(tests.unittest.HomeserverTestCase):
         self.store.get_rooms_for_user.invalidate_all()
         self.store._get_event_cache.clear()
         self.store._event_ref.clear()
+        work_unit_cache = self.sync_handler._work_unit_cache
+        for key in list(work_unit_cache.keys()):
+            work_unit_cache.unset(key)
 
         # The rooms should be excluded from the sync response.
         # Get a new request key.
@@ -279,19 +285,334 @@ class SyncTestCase(tests.unittest.HomeserverTestCase):
         )
         self.assertEqual(eve_initial_sync_after_join.joined, [])
 
+    @override_config({"caches": {"sync_snapshots_enabled": True}})
+    def test_initial_sync_reuses_snapshot(self) -> None:
+        """Initial syncs reuse the snapshot of rooms which have not changed since
+        the previous initial sync, and recompute the rooms which have."""
+        user = self.register_user("user", "pass")
+        tok = self.login(user, "pass")
+        requester = create_requester(user)
+
+        unchanged_room = self.helper.create_room_as(user, tok=tok)
+        self.helper.send(unchanged_room, "hello", tok=tok)
+        changed_room = self.helper.create_room_as(user, tok=tok)
+
+        first_result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                requester, generate_sync_config(user)
+            )
+        )
+
+        # Both rooms should now have a snapshot.
+        filter_key = _get_sync_snapshot_filter_key(
+            Filtering(Mock()).DEFAULT_FILTER_COLLECTION
+        )
+        snapshots = self.get_success(
+            self.store.get_sync_snapshots(
+                user, filter_key, self.store.get_room_max_stream_ordering()
+            )
+        )
+        self.assertEqual(snapshots.keys(), {unchanged_room, changed_room})
+
+        self.helper.send(changed_room, "new message", tok=tok)
+
+        with patch.object(
+            self.sync_handler,
+            "compute_state_delta",
+            wraps=self.sync_handler.compute_state_delta,
+        ) as compute_state_delta:
+            second_result = self.get_success(
+                self.sync_handler.wait_for_sync_for_user(
+                    requester, generate_sync_config(user)
+                )
+            )
+
+        # Only the room with a new event should have been recomputed.
+        self.assertEqual(
+            [call.args[0] for call in compute_state_delta.call_args_list],
+            [changed_room],
+        )
+
+        first_rooms = {room.room_id: room for room in first_result.joined}
+        second_rooms = {room.room_id: room for room in second_result.joined}
+        self.assertEqual(first_rooms.keys(), second_rooms.keys())
+
+        # The reused room should be identical to the one first computed.
+        first_room = first_rooms[unchanged_room]
+        second_room = second_rooms[unchanged_room]
+        self.assertEqual(
+            [e.event_id for e in first_room.timeline.events],
+            [e.event_id for e in second_room.timeline.events],
+        )
+        self.assertEqual(first_room.timeline.limited, second_room.timeline.limited)
+        self.assertEqual(
+            first_room.timeline.prev_batch.room_key,
+            second_room.timeline.prev_batch.room_key,
+        )
+        self.assertEqual(
+            {k: e.event_id for k, e in first_room.state.items()},
+            {k: e.event_id for k, e in second_room.state.items()},
+        )
+
+        # ... while the changed room picks up the new message.
+        self.assertEqual(
+            second_rooms[changed_room].timeline.events[-1].content["body"],
+            "new message",
+        )
+
+    @override_config({"caches": {"sync_snapshots_enabled": True}})
+    def test_unignoring_user_invalidates_snapshots(self) -> None:
+        """Initial syncs don't reuse snapshots taken while a user whose events are
+        in the room was ignored.
+        """
+        user = self.register_user("user", "pass")
+        tok = self.login(user, "pass")
+        other = self.register_user("other", "pass")
+        other_tok = self.login(other, "pass")
+        requester = create_requester(user)
+
+        room_id = self.helper.create_room_as(user, tok=tok)
+        self.helper.join(room_id, other, tok=other_tok)
+        other_event_id = self.helper.send(room_id, "hello", tok=other_tok)["event_id"]
+        self.helper.send(room_id, "hi", tok=tok)
+
+        account_data_handler = self.hs.get_account_data_handler()
+        self.get_success(
+            account_data_handler.add_account_data_for_user(
+                user, AccountDataTypes.IGNORED_USER_LIST, {"ignored_users": {other: {}}}
+            )
+        )
+
+        result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                requester, generate_sync_config(user)
+            )
+        )
+        self.assertNotIn(
+            other_event_id, [e.event_id for e in result.joined[0].timeline.events]
+        )
+
+        self.get_success(
+            account_data_handler.add_account_data_for_user(
+                user, AccountDataTypes.IGNORED_USER_LIST, {"ignored_users": {}}
+            )
+        )
+
+        result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                requester, generate_sync_config(user)
+            )
+        )
+        self.assertIn(
+            other_event_id, [e.event_id for e in result.joined[0].timeline.events]
+        )
+
+    def test_concurrent_syncs_share_work_units(self) -> None:
+        """Incremental syncs for the same user between the same tokens share the
+        filter-independent parts of the sync, even if their filters differ."""
+        user = self.register_user("user", "pass")
+        tok = self.login(user, "pass")
+        requester = create_requester(user)
+        room_id = self.helper.create_room_as(user, tok=tok)
+
+        initial_result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                requester, generate_sync_config(user)
+            )
+        )
+        self.helper.send(room_id, "hello", tok=tok)
+
+        lazy_load_filter = FilterCollection(
+            self.hs, {"room": {"state": {"lazy_load_members": True}}}
+        )
+
+        with patch.object(
+            self.store,
+            "get_room_events_stream_for_rooms",
+            wraps=self.store.get_room_events_stream_for_rooms,
+        ) as get_room_events_stream_for_rooms:
+            results = [
+                self.get_success(
+                    self.sync_handler.wait_for_sync_for_user(
+                        requester,
+                        generate_sync_config(
+                            user, device_id=device_id, filter_collection=filter
+                        ),
+                        since_token=initial_result.next_batch,
+                    )
+                )
+                for device_id, filter in (
+                    ("dev1", Filtering(Mock()).DEFAULT_FILTER_COLLECTION),
+                    ("dev2", lazy_load_filter),
+                )
+            ]
+
+        # The new events in the room were only fetched once...
+        get_room_events_stream_for_rooms.assert_called_once()
+
+        # ... but both syncs see the new message.
+        for result in results:
+            self.assertEqual(len(result.joined), 1)
+            self.assertEqual(
+                result.joined[0].timeline.events[-1].content["body"], "hello"
+            )
+
+    def test_state_prefetched_in_one_batch(self) -> None:
+        """The state needed for the rooms in a sync is fetched in a single batch."""
+        user = self.register_user("user", "pass")
+        tok = self.login(user, "pass")
+        requester = create_requester(user)
+        room_ids = [self.helper.create_room_as(user, tok=tok) for _ in range(3)]
+
+        state_store = self.hs.get_datastores().state
+        state_store._state_group_cache.invalidate_all()
+        state_store._state_group_members_cache.invalidate_all()
+
+        get_state_groups = state_store._get_state_groups_from_groups
+
+        async def get_state_groups_then_evict(
+            *args: Any, **kwargs: Any
+        ) -> Dict[int, StateMap[str]]:
+            result = await get_state_groups(*args, **kwargs)
+            # Evict the fetched state from the caches, as happens during initial
+            # syncs over many rooms: the per-room lookups must not rely on them.
+            state_store._state_group_cache.invalidate_all()
+            state_store._state_group_members_cache.invalidate_all()
+            return result
+
+        with patch.object(
+            state_store,
+            "_get_state_groups_from_groups",
+            side_effect=get_state_groups_then_evict,
+        ) as get_state_groups_from_groups:
+            result = self.get_success(
+                self.sync_handler.wait_for_sync_for_user(
+                    requester, generate_sync_config(user)
+                )
+            )
+
+        # The full state of all the rooms was fetched from the database in one go,
+        # and handed to the per-room lookups.
+        full_state_calls = [
+            call
+            for call in get_state_groups_from_groups.call_args_list
+            if call.kwargs["state_filter"] == StateFilter.all()
+        ]
+        self.assertEqual(len(full_state_calls), 1)
+        self.assertEqual(len(full_state_calls[0].args[0]), 6)
+        self.assertEqual(len(result.joined), 3)
+        self.assertCountEqual([room.room_id for room in result.joined], room_ids)
+
+    def test_sync_not_woken_by_filtered_out_streams(self) -> None:
+        """A waiting sync whose filter excludes typing notifications isn't woken up
+        by them."""
+        user = self.register_user("user", "pass")
+        tok = self.login(user, "pass")
+        requester = create_requester(user)
+        room_id = self.helper.create_room_as(user, tok=tok)
+
+        sync_filter = FilterCollection(
+            self.hs, {"room": {"ephemeral": {"not_types": [EduTypes.TYPING]}}}
+        )
+        initial_result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                requester, generate_sync_config(user, filter_collection=sync_filter)
+            )
+        )
+
+        with patch.object(
+            self.sync_handler,
+            "current_sync_for_user",
+            wraps=self.sync_handler.current_sync_for_user,
+        ) as current_sync_for_user:
+            sync_d = defer.ensureDeferred(
+                self.sync_handler.wait_for_sync_for_user(
+                    requester,
+                    generate_sync_config(user, filter_collection=sync_filter),
+                    since_token=initial_result.next_batch,
+                    timeout=10000,
+                )
+            )
+            self.pump()
+            self.assertEqual(current_sync_for_user.call_count, 0)
+
+            # Typing doesn't wake up the sync...
+            self.get_success(
+                self.hs.get_typing_writer_handler().started_typing(
+                    UserID.from_string(user), requester, room_id, 30000
+                )
+            )
+            self.pump()
+            self.assertFalse(sync_d.called)
+            self.assertEqual(current_sync_for_user.call_count, 0)
+
+            # ... but a new message does.
+            self.helper.send(room_id, "hello", tok=tok)
+            result = self.get_success(sync_d)
+
+        self.assertEqual(current_sync_for_user.call_count, 1)
+        self.assertEqual(result.joined[0].timeline.events[-1].content["body"], "hello")
+
+    @override_config({"notifier_coalescing": {"window": 5000}})
+    def test_coalesced_wakeups(self) -> None:
+        """With notifier coalescing enabled, a burst of events wakes up a waiting
+        sync once, at the end of the coalescing window."""
+        user = self.register_user("user", "pass")
+        tok = self.login(user, "pass")
+        requester = create_requester(user)
+        room_id = self.helper.create_room_as(user, tok=tok)
+
+        initial_result = self.get_success(
+            self.sync_handler.wait_for_sync_for_user(
+                requester, generate_sync_config(user)
+            )
+        )
+
+        with patch.object(
+            self.sync_handler,
+            "current_sync_for_user",
+            wraps=self.sync_handler.current_sync_for_user,
+        ) as current_sync_for_user:
+            sync_d = defer.ensureDeferred(
+                self.sync_handler.wait_for_sync_for_user(
+                    requester,
+                    generate_sync_config(user),
+                    since_token=initial_result.next_batch,
+                    timeout=30000,
+                )
+            )
+            for i in range(3):
+                self.helper.send(room_id, "message %d" % (i,), tok=tok)
+            self.assertFalse(sync_d.called)
+
+            self.reactor.advance(5)
+            result = self.get_success(sync_d)
+
+        self.assertEqual(current_sync_for_user.call_count, 1)
+        self.assertEqual(
+            [event.content["body"] for event in result.joined[0].timeline.events],
+            ["message 0", "message 1", "message 2"],
+        )
+
 
 _request_key = 0
 
 
 def generate_sync_config(
-    user_id: str, device_id: Optional[str] = "device_id"
+    user_id: str,
+    device_id: Optional[str] = "device_id",
+    filter_collection: Optional[FilterCollection] = None,
 ) -> SyncConfig:
     """Generate a sync config (with a unique request key)."""
     global _request_key
     _request_key += 1
+
+    if filter_collection is None:
+        filter_collection = Filtering(Mock()).DEFAULT_FILTER_COLLECTION
+
     return SyncConfig(
         user=UserID.from_string(user_id),
-        filter_collection=Filtering(Mock()).DEFAULT_FILTER_COLLECTION,
+        filter_collection=filter_collection,
         is_guest=False,
         request_key=("request_key", _request_key),
         device_id=device_id,
@@ -250,6 +250,7 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                 },
             ),
             json_data_callback=ANY,
+            encoded_data_callback=ANY,
             long_retries=True,
             try_trailing_slash_on_400=True,
             backoff_on_all_error_codes=True,
@@ -369,6 +370,7 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                 },
             ),
             json_data_callback=ANY,
+            encoded_data_callback=ANY,
             long_retries=True,
             backoff_on_all_error_codes=True,
             try_trailing_slash_on_400=True,
@@ -14,6 +14,7 @@
 from typing import Any, Dict, Generator
 from unittest.mock import ANY, Mock, create_autospec
 
+from canonicaljson import encode_canonical_json
 from netaddr import IPSet
 from parameterized import parameterized
 
@@ -645,6 +646,22 @@ class FederationClientTests(HomeserverTestCase):
                 b"", b"GET", b"https://example.com", destination_is=b""
             )
 
+    def test_build_auth_headers_encoded_content(self) -> None:
+        """Signing pre-encoded content gives the same headers as signing the content."""
+        content = {
+            "origin": "test",
+            "pdus": [{"type": "m.room.message", "b": "\u00e9"}],
+        }
+        self.assertEqual(
+            self.cl.build_auth_headers(
+                b"example.com",
+                b"PUT",
+                b"/foo",
+                encoded_content=encode_canonical_json(content),
+            ),
+            self.cl.build_auth_headers(b"example.com", b"PUT", b"/foo", content),
+        )
+
     @override_config(
         {
             "federation": {
@@ -299,6 +299,7 @@ class BackgroundUpdatesTestCase(unittest.HomeserverTestCase):
                     "populate_user_directory_cleanup",
                 ],
             ),
+            ("compact_state_groups", ["state_group_compaction"]),
         ]
     )
     def test_start_backround_job(self, job_name: str, updates: Collection[str]) -> None:
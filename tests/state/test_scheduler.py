@@ -0,0 +1,88 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from typing import List, Tuple
+
+from twisted.internet import defer
+from twisted.internet.defer import Deferred
+
+from synapse.state.scheduler import StateResPriority, StateResScheduler
+
+from tests import unittest
+from tests.server import get_clock
+
+
+class StateResSchedulerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.reactor, self.clock = get_clock()
+        self.scheduler = StateResScheduler(self.clock, max_concurrent=2)
+        self.started: List[str] = []
+
+    def _start_task(
+        self, name: str, priority: StateResPriority
+    ) -> Tuple["Deferred[None]", "Deferred[None]"]:
+        """Starts a task which runs in the scheduler until unblocked.
+
+        Returns:
+            The `Deferred` for the task, and a `Deferred` to resolve to unblock it.
+        """
+        unblock_d: "Deferred[None]" = Deferred()
+
+        async def task() -> None:
+            async with self.scheduler.schedule(priority):
+                self.started.append(name)
+                await unblock_d
+
+        d = defer.ensureDeferred(task())
+        return d, unblock_d
+
+    def test_priority(self) -> None:
+        """Tasks wait for a slot, and run in order of priority."""
+        _, unblock1 = self._start_task("1", StateResPriority.NORMAL)
+        _, unblock2 = self._start_task("2", StateResPriority.NORMAL)
+        self._start_task("flooding", StateResPriority.FLOODING)
+        self._start_task("normal", StateResPriority.NORMAL)
+        self._start_task("active", StateResPriority.ACTIVE)
+        self.assertEqual(self.started, ["1", "2"])
+
+        unblock1.callback(None)
+        self.reactor.advance(0)
+        self.assertEqual(self.started, ["1", "2", "active"])
+
+        unblock2.callback(None)
+        self.reactor.advance(0)
+        self.assertEqual(self.started, ["1", "2", "active", "normal"])
+
+    def test_cancellation(self) -> None:
+        """Cancelled tasks are removed from the queue."""
+        _, unblock1 = self._start_task("1", StateResPriority.NORMAL)
+        _, unblock2 = self._start_task("2", StateResPriority.NORMAL)
+        d3, _ = self._start_task("3", StateResPriority.ACTIVE)
+        d4, unblock4 = self._start_task("4", StateResPriority.NORMAL)
+
+        d3.cancel()
+        self.failureResultOf(d3, defer.CancelledError)
+
+        unblock1.callback(None)
+        self.reactor.advance(0)
+        self.assertEqual(self.started, ["1", "2", "4"])
+
+        # Once everything is done, new tasks run straight away.
+        unblock2.callback(None)
+        unblock4.callback(None)
+        self.reactor.advance(0)
+        self.successResultOf(d4)
+        self._start_task("5", StateResPriority.NORMAL)
+        self._start_task("6", StateResPriority.NORMAL)
+        self.assertEqual(self.started, ["1", "2", "4", "5", "6"])
@@ -13,7 +13,12 @@
 # limitations under the License.
 
 import itertools
+import pickle
+import sys
+from concurrent.futures import Executor, Future
 from typing import (
+    Any,
+    Callable,
     Collection,
     Dict,
     Iterable,
@@ -24,8 +29,10 @@ from typing import (
     Tuple,
     TypeVar,
 )
+from unittest.mock import patch
 
 import attr
+from typing_extensions import ParamSpec
 
 from twisted.internet import defer
 
@@ -33,10 +40,20 @@ from synapse.api.constants import EventTypes, JoinRules, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.event_auth import auth_types_for_event
 from synapse.events import EventBase, make_event_from_dict
+from synapse.state.process_pool import (
+    MissingPrefetchedEventError,
+    StateResProcessPool,
+    _PrefetchedEventsStore,
+    resolve_in_worker,
+)
 from synapse.state.v2 import (
+    _MAX_CACHED_MAINLINES,
+    MainlineCache,
     _get_auth_chain_difference,
+    _mainline_sort,
     lexicographical_topological_sort,
     resolve_events_with_store,
+    resolve_full_conflicted_set,
 )
 from synapse.types import EventID, StateMap
 
@@ -501,17 +518,10 @@ class StateTestCase(unittest.TestCase):
             elif len(prev_events) == 1:
                 state_before = dict(state_at_event[prev_events[0]])
             else:
-                state_d = resolve_events_with_store(
-                    FakeClock(),
-                    ROOM_ID,
-                    RoomVersions.V2,
-                    [state_at_event[n] for n in prev_events],
-                    event_map=event_map,
-                    state_res_store=TestStateResolutionStore(event_map),
+                state_before = self.resolve_state(
+                    [state_at_event[n] for n in prev_events], event_map
                 )
 
-                state_before = self.successResultOf(defer.ensureDeferred(state_d))
-
             state_after = dict(state_before)
             if fake_event.state_key is not None:
                 state_after[(fake_event.type, fake_event.state_key)] = event_id
@@ -557,6 +567,354 @@ class StateTestCase(unittest.TestCase):
 
         self.assertEqual(expected_state, end_state)
 
+    def resolve_state(
+        self, state_sets: List[StateMap[str]], event_map: Dict[str, EventBase]
+    ) -> StateMap[str]:
+        state_d = resolve_events_with_store(
+            FakeClock(),
+            ROOM_ID,
+            RoomVersions.V2,
+            state_sets,
+            event_map=event_map,
+            state_res_store=TestStateResolutionStore(event_map),
+        )
+
+        return self.successResultOf(defer.ensureDeferred(state_d))
+
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+
+class _ImmediateReactor:
+    def callFromThread(self, f: Callable[..., Any], *args: Any) -> None:
+        f(*args)
+
+
+class _PicklingExecutor(Executor):
+    """Runs functions synchronously, but pickles their arguments and results as
+    a process pool would.
+    """
+
+    # Match the signature of `Executor.submit` for the Python version.
+    if sys.version_info >= (3, 9):
+
+        def submit(
+            self, __fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs
+        ) -> "Future[R]":
+            return self._submit(__fn, *args)
+
+    else:
+
+        def submit(
+            self, fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs
+        ) -> "Future[R]":
+            return self._submit(fn, *args)
+
+    def _submit(self, fn: Callable[..., R], *args: Any) -> "Future[R]":
+        future: "Future[R]" = Future()
+        try:
+            result = fn(*pickle.loads(pickle.dumps(args)))
+            future.set_result(pickle.loads(pickle.dumps(result)))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class ProcessPoolStateTestCase(StateTestCase):
+    """Runs the state resolution tests through `StateResProcessPool`."""
+
+    def setUp(self) -> None:
+        self.pool = StateResProcessPool(
+            _ImmediateReactor(),  # type: ignore[arg-type]
+            workers=1,
+            min_conflicted_events=0,
+        )
+        self.pool._executor = _PicklingExecutor()
+
+    def resolve_state(
+        self, state_sets: List[StateMap[str]], event_map: Dict[str, EventBase]
+    ) -> StateMap[str]:
+        state_d = self.pool.resolve_events_with_store(
+            FakeClock(),
+            ROOM_ID,
+            RoomVersions.V2,
+            state_sets,
+            event_map=event_map,
+            state_res_store=TestStateResolutionStore(event_map),
+        )
+
+        return self.successResultOf(defer.ensureDeferred(state_d))
+
+    def _make_topic_conflict(
+        self,
+    ) -> Tuple[List[EventBase], StateMap[str], List[StateMap[str]]]:
+        """Makes a room whose state conflicts in its topic.
+
+        Returns:
+            The create event, Alice's join and the two topic events; the state
+            before the topic events; and the two state sets.
+        """
+        create = FakeEvent(
+            id="CREATE",
+            sender=ALICE,
+            type=EventTypes.Create,
+            state_key="",
+            content={"creator": ALICE},
+        ).to_event([], [])
+        alice = FakeEvent(
+            id="IMA",
+            sender=ALICE,
+            type=EventTypes.Member,
+            state_key=ALICE,
+            content=MEMBERSHIP_CONTENT_JOIN,
+        ).to_event([create.event_id], [create.event_id])
+        topic_1 = FakeEvent(
+            id="T1", sender=ALICE, type=EventTypes.Topic, state_key="", content={}
+        ).to_event([create.event_id, alice.event_id], [alice.event_id])
+        topic_2 = FakeEvent(
+            id="T2", sender=ALICE, type=EventTypes.Topic, state_key="", content={}
+        ).to_event([create.event_id, alice.event_id], [alice.event_id])
+
+        base_state = {
+            (EventTypes.Create, ""): create.event_id,
+            (EventTypes.Member, ALICE): alice.event_id,
+        }
+        state_sets: List[StateMap[str]] = [
+            {**base_state, (EventTypes.Topic, ""): topic_1.event_id},
+            {**base_state, (EventTypes.Topic, ""): topic_2.event_id},
+        ]
+        return [create, alice, topic_1, topic_2], base_state, state_sets
+
+    def test_wall_time_by_mode(self) -> None:
+        """The time spent resolving state in each mode is recorded."""
+        events, _, state_sets = self._make_topic_conflict()
+        event_map = {e.event_id: e for e in events}
+
+        wall_time_by_mode: Dict[str, float] = {}
+        state_d = self.pool.resolve_events_with_store(
+            FakeClock(),
+            ROOM_ID,
+            RoomVersions.V2,
+            state_sets,
+            event_map=dict(event_map),
+            state_res_store=TestStateResolutionStore(event_map),
+            wall_time_by_mode=wall_time_by_mode,
+        )
+        self.successResultOf(defer.ensureDeferred(state_d))
+
+        self.assertEqual(list(wall_time_by_mode), ["process_pool"])
+
+    def test_worker_auth_chain_difference(self) -> None:
+        """The worker processes can work out auth chain differences from the
+        events they were sent.
+        """
+        events, _, state_sets = self._make_topic_conflict()
+        event_map = {e.event_id: e for e in events}
+        auth_sets = [set(state_set.values()) for state_set in state_sets]
+
+        difference = self.successResultOf(
+            defer.ensureDeferred(
+                _PrefetchedEventsStore(event_map).get_auth_chain_difference(
+                    ROOM_ID, auth_sets
+                )
+            )
+        )
+        expected_difference = self.successResultOf(
+            TestStateResolutionStore(event_map).get_auth_chain_difference(
+                ROOM_ID, auth_sets
+            )
+        )
+        self.assertEqual(difference, expected_difference)
+
+        # Missing events are reported rather than silently skipped.
+        del event_map[events[0].event_id]
+        self.failureResultOf(
+            defer.ensureDeferred(
+                _PrefetchedEventsStore(event_map).get_auth_chain_difference(
+                    ROOM_ID, auth_sets
+                )
+            ),
+            MissingPrefetchedEventError,
+        )
+
+    def test_missing_event(self) -> None:
+        """If the worker needs an event which wasn't sent to it, it raises, and
+        the state gets resolved in-process instead.
+        """
+        events, base_state, state_sets = self._make_topic_conflict()
+        create, alice, topic_1, topic_2 = events
+
+        with self.assertRaises(MissingPrefetchedEventError):
+            resolve_in_worker(
+                ROOM_ID,
+                RoomVersions.V2.identifier,
+                dict(base_state),
+                {topic_1.event_id, topic_2.event_id},
+                [
+                    (event.get_dict(), event.internal_metadata.get_dict(), None)
+                    for event in (topic_1, topic_2)
+                ],
+            )
+
+        event_map = {e.event_id: e for e in (create, alice, topic_1, topic_2)}
+        expected_state = self.successResultOf(
+            defer.ensureDeferred(
+                resolve_events_with_store(
+                    FakeClock(),
+                    ROOM_ID,
+                    RoomVersions.V2,
+                    state_sets,
+                    event_map=None,
+                    state_res_store=TestStateResolutionStore(event_map),
+                )
+            )
+        )
+
+        # Only send the conflicted events to the worker.
+        async def prefetch_events(*args: Any) -> List[EventBase]:
+            return [topic_1, topic_2]
+
+        store = TestStateResolutionStore(event_map)
+        state_d = self.pool.resolve_events_with_store(
+            FakeClock(),
+            ROOM_ID,
+            RoomVersions.V2,
+            state_sets,
+            event_map={topic_1.event_id: topic_1, topic_2.event_id: topic_2},
+            state_res_store=store,
+        )
+        with patch(
+            "synapse.state.process_pool._prefetch_events", new=prefetch_events
+        ), patch.object(self.pool, "_run", wraps=self.pool._run) as run, patch(
+            "synapse.state.process_pool.v2.resolve_full_conflicted_set",
+            wraps=resolve_full_conflicted_set,
+        ) as resolve_in_process:
+            state = self.successResultOf(defer.ensureDeferred(state_d))
+
+        self.assertEqual(state, expected_state)
+        run.assert_called_once()
+        # The worker is run in-process here, so it shows up as a first call.
+        self.assertEqual(resolve_in_process.call_count, 2)
+        self.assertIs(resolve_in_process.call_args[0][6], store)
+
+
+class MainlineCacheStateTestCase(StateTestCase):
+    """Runs the state resolution tests with a `MainlineCache` shared between all
+    the state resolutions in the room.
+    """
+
+    def setUp(self) -> None:
+        self.mainline_cache = MainlineCache()
+
+    def resolve_state(
+        self, state_sets: List[StateMap[str]], event_map: Dict[str, EventBase]
+    ) -> StateMap[str]:
+        state_d = resolve_events_with_store(
+            FakeClock(),
+            ROOM_ID,
+            RoomVersions.V2,
+            state_sets,
+            event_map=event_map,
+            state_res_store=TestStateResolutionStore(event_map),
+            mainline_cache=self.mainline_cache,
+        )
+
+        return self.successResultOf(defer.ensureDeferred(state_d))
+
+    def test_mainline_cached(self) -> None:
+        """The mainline of the resolved power levels event and the mainline depths
+        of the sorted events are reused by later state resolutions.
+        """
+        self.test_mainline_sort()
+
+        pa1 = EventID("PA1", "example.com").to_string()
+        pa2 = EventID("PA2", "example.com").to_string()
+        t3 = EventID("T3", "example.com").to_string()
+        t4 = EventID("T4", "example.com").to_string()
+        ipower = EventID("IPOWER", "example.com").to_string()
+
+        mainline = self.mainline_cache.get_mainline(pa2)
+        assert mainline is not None
+        mainline_map, depths = mainline
+        self.assertEqual(mainline_map, {ipower: 1, pa1: 2, pa2: 3})
+        self.assertEqual(depths[t3], 3)
+        self.assertEqual(depths[t4], 2)
+        self.assertEqual(self.mainline_cache.power_level_auth_events[pa2], pa1)
+
+    def test_missing_auth_events_not_cached(self) -> None:
+        """The mainline depths of events are not cached if they were calculated
+        without some of the auth events.
+        """
+        pl = FakeEvent(
+            id="PL",
+            sender=ALICE,
+            type=EventTypes.PowerLevels,
+            state_key="",
+            content={"users": {ALICE: 100}},
+        ).to_event([], [])
+        missing_pl_id = EventID("MISSINGPL", "example.com").to_string()
+        t1 = FakeEvent(
+            id="T1", sender=ALICE, type=EventTypes.Topic, state_key="", content={}
+        ).to_event([missing_pl_id], [])
+        t2 = FakeEvent(
+            id="T2", sender=ALICE, type=EventTypes.Topic, state_key="", content={}
+        ).to_event([pl.event_id], [])
+        # T3's power levels event is not in the mainline, and we don't know
+        # whether it has a power levels event in its auth events.
+        pl2 = FakeEvent(
+            id="PL2",
+            sender=ALICE,
+            type=EventTypes.PowerLevels,
+            state_key="",
+            content={"users": {ALICE: 100}},
+        ).to_event([missing_pl_id], [])
+        t3 = FakeEvent(
+            id="T3", sender=ALICE, type=EventTypes.Topic, state_key="", content={}
+        ).to_event([pl2.event_id], [])
+        event_map = {ev.event_id: ev for ev in (pl, pl2, t1, t2, t3)}
+
+        sorted_ids = self.successResultOf(
+            defer.ensureDeferred(
+                _mainline_sort(
+                    FakeClock(),
+                    ROOM_ID,
+                    [t1.event_id, t2.event_id, t3.event_id],
+                    pl.event_id,
+                    event_map,
+                    TestStateResolutionStore(event_map),
+                    self.mainline_cache,
+                )
+            )
+        )
+        self.assertEqual(sorted_ids, [t1.event_id, t3.event_id, t2.event_id])
+
+        mainline = self.mainline_cache.get_mainline(pl.event_id)
+        assert mainline is not None
+        _, depths = mainline
+        self.assertEqual(depths, {t2.event_id: 1})
+        self.assertNotIn(t1.event_id, self.mainline_cache.power_level_auth_events)
+        self.assertNotIn(pl2.event_id, self.mainline_cache.power_level_auth_events)
+        self.assertEqual(
+            self.mainline_cache.power_level_auth_events[t3.event_id], pl2.event_id
+        )
+
+    def test_max_mainlines(self) -> None:
+        """Only the mainlines of the most recently used power levels events are
+        kept.
+        """
+        for i in range(_MAX_CACHED_MAINLINES + 1):
+            self.mainline_cache.add_mainline(f"$pl{i}", {f"$pl{i}": 1})
+
+        # Using the oldest remaining mainline keeps it around.
+        self.assertIsNotNone(self.mainline_cache.get_mainline("$pl1"))
+        self.mainline_cache.add_mainline("$new", {"$new": 1})
+
+        self.assertIsNone(self.mainline_cache.get_mainline("$pl0"))
+        self.assertIsNone(self.mainline_cache.get_mainline("$pl2"))
+        self.assertIsNotNone(self.mainline_cache.get_mainline("$pl1"))
+        self.assertEqual(len(self.mainline_cache.mainlines), _MAX_CACHED_MAINLINES)
+
 
 class LexicographicalTestCase(unittest.TestCase):
     def test_simple(self) -> None:
@@ -930,3 +1288,13 @@ class TestStateResolutionStore:
 
         common = set(chains[0]).intersection(*chains[1:])
         return defer.succeed(set(chains[0]).union(*chains[1:]) - common)
+
+    def get_auth_chain_ids(
+        self, room_id: str, event_ids: Collection[str], include_given: bool = False
+    ) -> "defer.Deferred[Set[str]]":
+        auth_chain = set(
+            self._get_auth_chain(e for e in event_ids if e in self.event_map)
+        )
+        if not include_given:
+            auth_chain.difference_update(event_ids)
+        return defer.succeed(auth_chain)
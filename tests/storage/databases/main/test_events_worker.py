@@ -287,6 +287,27 @@ class EventCacheTestCase(unittest.HomeserverTestCase):
             # We should have fetched the event from the DB
             self.assertEqual(ctx.get_resource_usage().evt_db_fetch_count, 1)
 
+    def test_lazily_decoded(self) -> None:
+        """Test that events pulled from the DB only decode their content,
+        signatures and unsigned when they are needed.
+        """
+        event = self.get_success(self.store.get_event(self.event_id))
+        event_json = event.get_undecoded_json()
+        assert event_json is not None
+
+        # Top-level fields are available without decoding anything.
+        self.assertEqual(event.sender, self.user)
+        self.assertEqual(event.type, "m.room.message")
+        self.assertIsNotNone(event.get_undecoded_json())
+
+        self.assertEqual(event.content, {"body": "body_text_here", "msgtype": "m.text"})
+        self.assertIsNone(event.get_undecoded_json())
+
+        # The decoded event should match what we stored.
+        expected = json.loads(event_json)
+        self.assertEqual(event.get_dict(), expected)
+        self.assertEqual(event.signatures, expected["signatures"])
+
 
 class DatabaseOutageTestCase(unittest.HomeserverTestCase):
     """Test event fetching during a database outage."""
@@ -14,6 +14,9 @@
 
 import datetime
 from typing import (
+    Any,
+    Awaitable,
+    Callable,
     Collection,
     Dict,
     FrozenSet,
@@ -26,6 +29,7 @@ from typing import (
     Union,
     cast,
 )
+from unittest.mock import patch
 
 import attr
 from parameterized import parameterized
@@ -447,6 +451,224 @@ class EventFederationWorkerStoreTestCase(tests.unittest.HomeserverTestCase):
         # Now actually test that various combinations give the right result:
         self.assert_auth_diff_is_expected(room_id)
 
+    def test_auth_difference_cached(self) -> None:
+        """Test that the auth chain difference is calculated from the auth DAG
+        cache once it has the auth chains of the state sets.
+        """
+        # (Rooms with a chain cover index use the chain cover index cache.)
+        room_id = self._setup_auth_chain(False)
+
+        difference = self.get_success(
+            self.store.get_auth_chain_difference(room_id, [{"d"}, {"c"}])
+        )
+        self.assertSetEqual(difference, {"c", "d", "f"})
+
+        dag = self.store._auth_dag_cache.get(room_id)
+        assert dag is not None
+        self.assertCountEqual(dag.nodes, ["c", "d", "f", "g", "h", "i", "j", "k"])
+        self.assertEqual(dag.nodes["g"].auth_event_ids, ("h", "i"))
+        self.assertEqual((dag.hits, dag.misses), (0, 1))
+
+        # Everything we need is cached, so the database shouldn't be touched.
+        with patch.object(
+            self.store.db_pool, "runInteraction", side_effect=AssertionError
+        ):
+            difference = self.get_success(
+                self.store.get_auth_chain_difference(room_id, [{"f"}, {"c", "g"}])
+            )
+        self.assertSetEqual(difference, {"c", "f"})
+        self.assertEqual((dag.hits, dag.misses), (1, 1))
+
+        # A new event only needs its own auth chain to be added.
+        difference = self.get_success(
+            self.store.get_auth_chain_difference(room_id, [{"a"}, {"d"}])
+        )
+        self.assertSetEqual(difference, {"a", "d", "e"})
+        self.assertEqual((dag.hits, dag.misses), (1, 2))
+        self.assertIn("a", dag.nodes)
+
+        # Deleting the room's events drops the cache.
+        self.store._invalidate_caches_for_room_events(room_id)
+        self.assertIsNone(self.store._auth_dag_cache.get(room_id))
+
+    def test_auth_difference_cache_invalidated_during_fetch(self) -> None:
+        """Test that the auth DAG cache isn't populated with events fetched before
+        the room's events were deleted.
+        """
+        room_id = self._setup_auth_chain(False)
+
+        get_auth_dag_nodes_txn = self.store._get_auth_dag_nodes_txn
+
+        def get_auth_dag_nodes_then_invalidate(*args: Any) -> Any:
+            result = get_auth_dag_nodes_txn(*args)
+            self.store._invalidate_caches_for_room_events(room_id)
+            return result
+
+        with patch.object(
+            self.store,
+            "_get_auth_dag_nodes_txn",
+            side_effect=get_auth_dag_nodes_then_invalidate,
+        ):
+            difference = self.get_success(
+                self.store.get_auth_chain_difference(room_id, [{"d"}, {"c"}])
+            )
+
+        # The difference is still calculated, but not cached.
+        self.assertSetEqual(difference, {"c", "d", "f"})
+        self.assertIsNone(self.store._auth_dag_cache.get(room_id))
+
+    def test_chain_cover_index_cached(self) -> None:
+        """Test that auth chain queries are answered from the in-memory copy of
+        the chain cover index once it has the events, and that it gets extended
+        with new events.
+        """
+        room_id = self._setup_auth_chain(True)
+
+        difference = self.get_success(
+            self.store.get_auth_chain_difference(room_id, [{"d"}, {"c"}])
+        )
+        self.assertSetEqual(difference, {"c", "d", "f"})
+
+        index = self.store._chain_cover_index_cache.get(room_id)
+        assert index is not None
+        self.assertCountEqual(index.event_to_chain, AUTH_GRAPH)
+
+        # Everything we need is cached, so the database shouldn't be touched.
+        with patch.object(
+            self.store.db_pool, "runInteraction", side_effect=AssertionError
+        ):
+            difference = self.get_success(
+                self.store.get_auth_chain_difference(room_id, [{"f"}, {"c", "g"}])
+            )
+            auth_chain_ids = self.get_success(
+                self.store.get_auth_chain_ids(room_id, ["a", "c"])
+            )
+        self.assertSetEqual(difference, {"c", "f"})
+        self.assertCountEqual(auth_chain_ids, ["e", "f", "g", "h", "i", "j", "k"])
+
+        # Add new events on top of the existing ones.
+        def insert_event(txn: LoggingTransaction) -> None:
+            # The chain cover index of the new events is calculated from that of
+            # their auth events, which it looks up via `state_events`.
+            self.store.db_pool.simple_insert_many_txn(
+                txn,
+                table="state_events",
+                keys=("event_id", "room_id", "type", "state_key"),
+                values=[(event_id, room_id, "foo", "foo") for event_id in "acd"],
+            )
+
+            for stream_ordering, event_id in enumerate(("l", "m"), start=100):
+                self.store.db_pool.simple_insert_txn(
+                    txn,
+                    table="events",
+                    values={
+                        "event_id": event_id,
+                        "room_id": room_id,
+                        "depth": 8,
+                        "topological_ordering": 8,
+                        "type": "m.test",
+                        "processed": True,
+                        "outlier": False,
+                        "stream_ordering": stream_ordering,
+                    },
+                )
+
+            self.persist_events._persist_event_auth_chain_txn(
+                txn,
+                [
+                    cast(EventBase, FakeEvent("l", room_id, ["a"])),
+                    cast(EventBase, FakeEvent("m", room_id, ["c", "d"])),
+                ],
+            )
+
+        self.get_success(self.store.db_pool.runInteraction("insert", insert_event))
+
+        difference = self.get_success(
+            self.store.get_auth_chain_difference(room_id, [{"l"}, {"m"}])
+        )
+        self.assertSetEqual(difference, {"a", "c", "d", "e", "l", "m"})
+        self.assertIn("m", index.event_to_chain)
+
+        auth_chain_ids = self.get_success(self.store.get_auth_chain_ids(room_id, ["m"]))
+        self.assertCountEqual(auth_chain_ids, ["c", "d", "f", "g", "h", "i", "j", "k"])
+
+        # The answers match the ones from the database.
+        self.assertSetEqual(
+            self.get_success(
+                self.store._get_auth_chain_difference_from_db(room_id, [{"l"}, {"m"}])
+            ),
+            difference,
+        )
+
+        # Deleting the room's events drops the cache.
+        self.store._invalidate_caches_for_room_events(room_id)
+        self.assertIsNone(self.store._chain_cover_index_cache.get(room_id))
+
+    def test_chain_cover_index_invalidated_during_fetch(self) -> None:
+        """Test that the chain cover index cache isn't populated with rows fetched
+        before the room's events were deleted.
+        """
+        room_id = self._setup_auth_chain(True)
+
+        get_rows_txn = self.store._get_chain_cover_index_rows_txn
+
+        def get_rows_then_invalidate(*args: Any) -> Any:
+            result = get_rows_txn(*args)
+            self.store._invalidate_caches_for_room_events(room_id)
+            return result
+
+        with patch.object(
+            self.store,
+            "_get_chain_cover_index_rows_txn",
+            side_effect=get_rows_then_invalidate,
+        ):
+            difference = self.get_success(
+                self.store.get_auth_chain_difference(room_id, [{"d"}, {"c"}])
+            )
+
+        self.assertSetEqual(difference, {"c", "d", "f"})
+        self.assertIsNone(self.store._chain_cover_index_cache.get(room_id))
+
+    def test_chain_cover_index_with_gap(self) -> None:
+        """Test that we don't keep trying to cache the chain cover index of a room
+        with a gap in it.
+        """
+        room_id = self._setup_auth_chain(True)
+
+        # Remove the first event of a chain with more than one event in it.
+        def remove_first_event_txn(txn: LoggingTransaction) -> None:
+            txn.execute(
+                """
+                SELECT chain_id FROM event_auth_chains
+                GROUP BY chain_id HAVING MAX(sequence_number) > 1
+                """
+            )
+            chain_id = cast(Tuple[int], txn.fetchone())[0]
+            txn.execute(
+                """
+                DELETE FROM event_auth_chains
+                WHERE chain_id = ? AND sequence_number = 1
+                """,
+                (chain_id,),
+            )
+
+        self.get_success(
+            self.store.db_pool.runInteraction("remove", remove_first_event_txn)
+        )
+
+        with patch.object(
+            self.store,
+            "_get_chain_cover_index_rows_txn",
+            wraps=self.store._get_chain_cover_index_rows_txn,
+        ) as get_rows_txn:
+            self.get_success(self.store._get_chain_cover_index(room_id, ["a"]))
+            self.get_success(self.store._get_chain_cover_index(room_id, ["a"]))
+
+        # The index was only fetched once.
+        self.assertEqual(get_rows_txn.call_count, 1)
+        self.assertTrue(self.store._rooms_with_uncached_chain_cover_index.get(room_id))
+        self.assertIsNone(self.store._chain_cover_index_cache.get(room_id))
+
     @parameterized.expand(
         [
             [graph_subset]
@@ -489,45 +711,56 @@ class EventFederationWorkerStoreTestCase(tests.unittest.HomeserverTestCase):
         self.assert_auth_diff_is_expected(room_id)
 
     def assert_auth_diff_is_expected(self, room_id: str) -> None:
-        """Assert the auth chain difference returns the correct answers."""
+        """Assert the auth chain difference returns the correct answers, both with
+        and without the auth DAG cache.
+        """
+        for get_auth_chain_difference in (
+            self.store._get_auth_chain_difference_from_db,
+            self.store.get_auth_chain_difference,
+        ):
+            self._assert_auth_diff_is_expected(room_id, get_auth_chain_difference)
+
+    def _assert_auth_diff_is_expected(
+        self,
+        room_id: str,
+        get_auth_chain_difference: Callable[[str, List[Set[str]]], Awaitable[Set[str]]],
+    ) -> None:
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}])
+            get_auth_chain_difference(room_id, [{"a"}, {"b"}])
         )
         self.assertSetEqual(difference, {"a", "b"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}])
+            get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}])
         )
         self.assertSetEqual(difference, {"a", "b", "c", "e", "f"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a", "c"}, {"b"}])
+            get_auth_chain_difference(room_id, [{"a", "c"}, {"b"}])
         )
         self.assertSetEqual(difference, {"a", "b", "c"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a", "c"}, {"b", "c"}])
+            get_auth_chain_difference(room_id, [{"a", "c"}, {"b", "c"}])
         )
         self.assertSetEqual(difference, {"a", "b"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"d"}])
+            get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"d"}])
         )
         self.assertSetEqual(difference, {"a", "b", "d", "e"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}, {"d"}])
+            get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}, {"d"}])
         )
         self.assertSetEqual(difference, {"a", "b", "c", "d", "e", "f"})
 
         difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"e"}])
+            get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"e"}])
         )
         self.assertSetEqual(difference, {"a", "b"})
 
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}])
-        )
+        difference = self.get_success(get_auth_chain_difference(room_id, [{"a"}]))
         self.assertSetEqual(difference, set())
 
     def test_auth_difference_partial_cover(self) -> None:
@@ -660,46 +893,7 @@ class EventFederationWorkerStoreTestCase(tests.unittest.HomeserverTestCase):
         )
 
         # Now actually test that various combinations give the right result:
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}])
-        )
-        self.assertSetEqual(difference, {"a", "b"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}])
-        )
-        self.assertSetEqual(difference, {"a", "b", "c", "e", "f"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a", "c"}, {"b"}])
-        )
-        self.assertSetEqual(difference, {"a", "b", "c"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a", "c"}, {"b", "c"}])
-        )
-        self.assertSetEqual(difference, {"a", "b"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"d"}])
-        )
-        self.assertSetEqual(difference, {"a", "b", "d", "e"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"c"}, {"d"}])
-        )
-        self.assertSetEqual(difference, {"a", "b", "c", "d", "e", "f"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}, {"b"}, {"e"}])
-        )
-        self.assertSetEqual(difference, {"a", "b"})
-
-        difference = self.get_success(
-            self.store.get_auth_chain_difference(room_id, [{"a"}])
-        )
-        self.assertSetEqual(difference, set())
+        self.assert_auth_diff_is_expected(room_id)
 
     @parameterized.expand(
         [(room_version,) for room_version in KNOWN_ROOM_VERSIONS.values()]
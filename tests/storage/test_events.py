@@ -12,21 +12,27 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Optional
+from typing import Any, List, Optional, Tuple
+from unittest.mock import Mock
 
+from twisted.internet import defer
 from twisted.test.proto_helpers import MemoryReactor
 
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.events import EventBase
+from synapse.events.snapshot import EventContext
 from synapse.federation.federation_base import event_from_pdu_json
 from synapse.rest import admin
 from synapse.rest.client import login, room
 from synapse.server import HomeServer
-from synapse.types import StateMap
+from synapse.storage.controllers.persist_events import (
+    EXTREMITY_MAINTENANCE_RETRY_DELAY_SECONDS,
+)
+from synapse.types import StateMap, create_requester
 from synapse.util import Clock
 
-from tests.unittest import HomeserverTestCase
+from tests.unittest import HomeserverTestCase, override_config
 
 
 class ExtremPruneTestCase(HomeserverTestCase):
@@ -364,6 +370,167 @@ class ExtremPruneTestCase(HomeserverTestCase):
         # Check the new extremity is just the new remote event.
         self.assert_extremities([local_message_event_id, remote_event_2.event_id])
 
+    @override_config({"deferred_extremity_maintenance": True})
+    def test_prune_gap_deferred(self) -> None:
+        """Test that we still drop extremities after a gap when the state
+        resolution is deferred until after the event has been persisted.
+        """
+        remote_event_2 = event_from_pdu_json(
+            {
+                "type": EventTypes.Member,
+                "state_key": "@user:other",
+                "content": {"membership": Membership.JOIN},
+                "room_id": self.room_id,
+                "sender": "@user:other",
+                "depth": 50,
+                "prev_events": ["$some_unknown_message"],
+                "auth_events": [],
+                "origin_server_ts": self.clock.time_msec(),
+            },
+            RoomVersions.V6,
+        )
+
+        state_before_gap = self.get_success(
+            self._state_storage_controller.get_current_state_ids(self.room_id)
+        )
+
+        self.persist_event(remote_event_2, state=state_before_gap)
+        self.pump()
+
+        # Check the new extremity is just the new remote event, and that the
+        # current state has caught up with it.
+        self.assert_extremities([remote_event_2.event_id])
+        current_state = self.get_success(
+            self._state_storage_controller.get_current_state_ids(self.room_id)
+        )
+        self.assertEqual(
+            current_state[(EventTypes.Member, "@user:other")], remote_event_2.event_id
+        )
+        persist_events_store = self.hs.get_datastores().persist_events
+        assert persist_events_store is not None
+        self.assertEqual(
+            self.get_success(
+                persist_events_store.get_rooms_awaiting_extremity_maintenance()
+            ),
+            [],
+        )
+
+    def test_resume_extremity_maintenance(self) -> None:
+        """Test that recalculations of the current state which were pending when
+        we stopped are done on startup.
+        """
+        persist_events_store = self.hs.get_datastores().persist_events
+        assert persist_events_store is not None
+
+        self.get_success(
+            persist_events_store.mark_room_awaiting_extremity_maintenance(self.room_id)
+        )
+        self.assertEqual(
+            self.get_success(
+                persist_events_store.get_rooms_awaiting_extremity_maintenance()
+            ),
+            [self.room_id],
+        )
+
+        self.get_success(self._persistence._resume_extremity_maintenance())
+        self.pump()
+
+        self.assertEqual(
+            self.get_success(
+                persist_events_store.get_rooms_awaiting_extremity_maintenance()
+            ),
+            [],
+        )
+        self.assert_extremities([self.remote_event_1.event_id])
+
+    def test_retry_failed_extremity_maintenance(self) -> None:
+        """Test that a failed recalculation of the current state is retried after
+        a backoff, rather than leaving the room awaiting it for good.
+        """
+        persist_events_store = self.hs.get_datastores().persist_events
+        assert persist_events_store is not None
+
+        maintain_extremities = self._persistence._maintain_extremities
+        calls = 0
+
+        async def fail_once(*args: Any) -> None:
+            nonlocal calls
+            calls += 1
+            if calls == 1:
+                raise Exception("Failed")
+            await maintain_extremities(*args)
+
+        self._persistence._maintain_extremities = fail_once  # type: ignore[assignment]
+
+        self.get_success(
+            persist_events_store.mark_room_awaiting_extremity_maintenance(self.room_id)
+        )
+        self.get_success(self._persistence._resume_extremity_maintenance())
+        self.pump()
+
+        # The room is still awaiting maintenance after the failure...
+        self.assertEqual(calls, 1)
+        self.assertIn(self.room_id, self._persistence._rooms_awaiting_maintenance)
+        self.assertEqual(
+            self.get_success(
+                persist_events_store.get_rooms_awaiting_extremity_maintenance()
+            ),
+            [self.room_id],
+        )
+
+        # ... until it's retried.
+        self.reactor.advance(EXTREMITY_MAINTENANCE_RETRY_DELAY_SECONDS)
+        self.assertEqual(calls, 2)
+        self.assertNotIn(self.room_id, self._persistence._rooms_awaiting_maintenance)
+        self.assertEqual(
+            self.get_success(
+                persist_events_store.get_rooms_awaiting_extremity_maintenance()
+            ),
+            [],
+        )
+
+    @override_config({"deferred_extremity_maintenance": True})
+    def test_no_extremity_maintenance_if_persisting_fails(self) -> None:
+        """Test that the current state of a room isn't recalculated if persisting
+        the events it was deferred for fails.
+        """
+        remote_event_2 = event_from_pdu_json(
+            {
+                "type": EventTypes.Member,
+                "state_key": "@user:other",
+                "content": {"membership": Membership.JOIN},
+                "room_id": self.room_id,
+                "sender": "@user:other",
+                "depth": 50,
+                "prev_events": ["$some_unknown_message"],
+                "auth_events": [],
+                "origin_server_ts": self.clock.time_msec(),
+            },
+            RoomVersions.V6,
+        )
+
+        state_before_gap = self.get_success(
+            self._state_storage_controller.get_current_state_ids(self.room_id)
+        )
+        context = self.get_success(
+            self.state.compute_event_context(
+                remote_event_2,
+                state_ids_before_event=state_before_gap,
+                partial_state=False,
+            )
+        )
+
+        self._persistence._persist_events_and_state_updates = Mock(  # type: ignore[method-assign]
+            side_effect=Exception("Failed")
+        )
+        self.get_failure(
+            self._persistence.persist_event(remote_event_2, context), Exception
+        )
+        self.pump()
+
+        self.assertNotIn(self.room_id, self._persistence._rooms_awaiting_maintenance)
+        self.assert_extremities([self.remote_event_1.event_id])
+
 
 class InvalideUsersInRoomCacheTestCase(HomeserverTestCase):
     servlets = [
@@ -474,3 +641,102 @@ class InvalideUsersInRoomCacheTestCase(HomeserverTestCase):
 
         users = self.get_success(self.store.get_users_in_room(room_id))
         self.assertEqual(users, [])
+
+
+class GroupCommitTestCase(HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        room.register_servlets,
+        login.register_servlets,
+    ]
+
+    def prepare(
+        self, reactor: MemoryReactor, clock: Clock, homeserver: HomeServer
+    ) -> None:
+        persistence = self.hs.get_storage_controllers().persistence
+        assert persistence is not None
+        self._persistence = persistence
+        self.store = self.hs.get_datastores().main
+        persist_events_store = self.hs.get_datastores().persist_events
+        assert persist_events_store is not None
+        self.persist_events_store = persist_events_store
+
+        self.user_id = self.register_user("user", "pass")
+        self.token = self.login("user", "pass")
+        self.room_ids = [
+            self.helper.create_room_as(self.user_id, tok=self.token) for _ in range(2)
+        ]
+
+    def _create_message(self, room_id: str) -> Tuple[EventBase, EventContext]:
+        event, unpersisted_context = self.get_success(
+            self.hs.get_event_creation_handler().create_event(
+                create_requester(self.user_id),
+                {
+                    "type": EventTypes.Message,
+                    "room_id": room_id,
+                    "sender": self.user_id,
+                    "content": {"msgtype": "m.text", "body": "hello"},
+                },
+            )
+        )
+        context = self.get_success(unpersisted_context.persist(event))
+        return event, context
+
+    def _persist_messages(self) -> List[EventBase]:
+        """Persist a message in each room at the same time."""
+        events_and_contexts = [
+            self._create_message(room_id) for room_id in self.room_ids
+        ]
+        deferreds = [
+            defer.ensureDeferred(self._persistence.persist_event(event, context))
+            for event, context in events_and_contexts
+        ]
+        for d in deferreds:
+            self.get_success(d, by=0.01)
+
+        return [event for event, _ in events_and_contexts]
+
+    @override_config({"event_persistence_group_commit": {"enabled": True}})
+    def test_group_commit(self) -> None:
+        """The events of different rooms are persisted in a single transaction."""
+        persist = Mock(
+            side_effect=self.persist_events_store._persist_events_and_state_updates
+        )
+        self.persist_events_store._persist_events_and_state_updates = persist  # type: ignore[method-assign]
+
+        events = self._persist_messages()
+
+        persist.assert_called_once()
+        self.assertCountEqual([event for event, _ in persist.call_args[0][0]], events)
+        for event in events:
+            self.get_success(self.store.get_event(event.event_id))
+            self.assertEqual(
+                self.get_success(
+                    self.store.get_latest_event_ids_in_room(event.room_id)
+                ),
+                frozenset([event.event_id]),
+            )
+
+    @override_config({"event_persistence_group_commit": {"enabled": True}})
+    def test_group_commit_failure(self) -> None:
+        """If persisting the events of several rooms together fails, they are
+        persisted room by room.
+        """
+        original_persist = self.persist_events_store._persist_events_and_state_updates
+        calls: List[List[Tuple[EventBase, EventContext]]] = []
+
+        async def persist(
+            events_and_contexts: List[Tuple[EventBase, EventContext]], **kwargs: Any
+        ) -> None:
+            calls.append(events_and_contexts)
+            if len(calls) == 1:
+                raise Exception("Oh no")
+            await original_persist(events_and_contexts, **kwargs)
+
+        self.persist_events_store._persist_events_and_state_updates = persist  # type: ignore[method-assign]
+
+        events = self._persist_messages()
+
+        self.assertEqual([len(c) for c in calls], [2, 1, 1])
+        for event in events:
+            self.get_success(self.store.get_event(event.event_id))
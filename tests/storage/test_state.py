@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import logging
+from typing import Dict, List
 
 from immutabledict import immutabledict
 
@@ -22,11 +23,11 @@ from synapse.api.constants import EventTypes, Membership
 from synapse.api.room_versions import RoomVersions
 from synapse.events import EventBase
 from synapse.server import HomeServer
-from synapse.types import JsonDict, RoomID, StateMap, UserID
+from synapse.types import JsonDict, RoomID, StateKey, StateMap, UserID
 from synapse.types.state import StateFilter
 from synapse.util import Clock
 
-from tests.unittest import HomeserverTestCase
+from tests.unittest import HomeserverTestCase, override_config
 
 logger = logging.getLogger(__name__)
 
@@ -363,7 +364,7 @@ class StateStoreTestCase(HomeserverTestCase):
 
         self.assertEqual(cache_entry.full, True)
         self.assertEqual(cache_entry.known_absent, set())
-        self.assertDictEqual(
+        self.assertEqual(
             state_dict_ids,
             {
                 (e1.type, e1.state_key): e1.event_id,
@@ -371,6 +372,8 @@ class StateStoreTestCase(HomeserverTestCase):
             },
         )
 
+        # The full state maps are stored as immutable compact maps.
+        state_dict_ids = dict(state_dict_ids)
         state_dict_ids.pop((e2.type, e2.state_key))
         self.state_datastore._state_group_cache.invalidate(group)
         self.state_datastore._state_group_cache.update(
@@ -626,3 +629,73 @@ class StateStoreTestCase(HomeserverTestCase):
                 self.assertEqual(
                     context.state_group_before_event, groups[0].get("prev_state_group")
                 )
+
+
+class StateGroupCompactionTestCase(HomeserverTestCase):
+    def prepare(self, reactor: MemoryReactor, clock: Clock, hs: HomeServer) -> None:
+        self.state_datastore = hs.get_datastores().state
+        self.room_id = "!room:test"
+
+    def _create_chain(self, length: int) -> List[int]:
+        """Create a chain of state groups, each adding a member to the state of the
+        previous one.
+        """
+        state: Dict[StateKey, str] = {(EventTypes.Create, ""): "$create"}
+        groups = [
+            self.get_success(
+                self.state_datastore.store_state_group(
+                    "$create", self.room_id, None, None, dict(state)
+                )
+            )
+        ]
+        for i in range(1, length):
+            delta = {(EventTypes.Member, "@user%d:test" % (i,)): "$member%d" % (i,)}
+            state.update(delta)
+            groups.append(
+                self.get_success(
+                    self.state_datastore.store_state_group(
+                        "$member%d" % (i,), self.room_id, groups[-1], delta, dict(state)
+                    )
+                )
+            )
+        return groups
+
+    def _get_state(self, groups: List[int]) -> Dict[int, StateMap[str]]:
+        return self.get_success(
+            self.state_datastore._get_state_groups_from_groups(
+                groups, StateFilter.all()
+            )
+        )
+
+    def _compact(self) -> None:
+        self.get_success(
+            self.state_datastore.db_pool.simple_insert(
+                "background_updates",
+                {
+                    "update_name": self.state_datastore.STATE_GROUP_COMPACTION_UPDATE_NAME,
+                    "progress_json": "{}",
+                },
+            )
+        )
+        self.state_datastore.db_pool.updates._all_done = False
+        self.wait_for_background_updates()
+
+    @override_config({"state_group_compaction": {"max_delta_chain_length": 5}})
+    def test_compaction(self) -> None:
+        """Long chains of deltas are cut by snapshots, without changing the state."""
+        groups = self._create_chain(14)
+        state_before = self._get_state(groups)
+
+        self._compact()
+
+        # Check the state groups without a previous group.
+        edges = self.get_success(
+            self.state_datastore.db_pool.simple_select_onecol(
+                "state_group_edges", None, "state_group"
+            )
+        )
+        self.assertEqual(
+            [group for group in groups if group not in edges],
+            [groups[0], groups[6], groups[12]],
+        )
+        self.assertEqual(self._get_state(groups), state_before)
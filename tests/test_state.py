@@ -34,6 +34,7 @@ from synapse.api.room_versions import RoomVersions
 from synapse.events import EventBase, make_event_from_dict
 from synapse.events.snapshot import EventContext
 from synapse.state import StateHandler, StateResolutionHandler, _make_state_cache_entry
+from synapse.state.scheduler import StateResPriority
 from synapse.types import MutableStateMap, StateMap
 from synapse.types.state import StateFilter
 from synapse.util import Clock
@@ -230,6 +231,7 @@ class StateTestCase(unittest.TestCase):
                 "get_simple_http_client",
                 "get_replication_client",
                 "hostname",
+                "is_mine_id",
             ]
         )
         clock = cast(Clock, MockClock())
@@ -244,6 +246,7 @@ class StateTestCase(unittest.TestCase):
         hs.get_state_resolution_handler = lambda: StateResolutionHandler(hs)
         hs.get_storage_controllers.return_value = storage_controllers
 
+        self.hs = hs
         self.state = StateHandler(hs)
         self.event_id = 0
 
@@ -888,3 +891,24 @@ class StateTestCase(unittest.TestCase):
         self.assertEqual(
             entry.delta_ids, {("a", ""): "E", ("c", ""): "E", ("d", ""): "E"}
         )
+
+    def test_state_res_priority(self) -> None:
+        """Rooms with local activity get priority, and flooding rooms are deferred."""
+        self.hs.config.server.state_res_max_concurrent_resolutions = 1
+        handler = StateResolutionHandler(self.hs)
+
+        self.assertEqual(handler._get_priority("!room:test"), StateResPriority.NORMAL)
+
+        handler._state_res_metrics["!room:test"].cpu_time = 20.0
+        self.assertEqual(handler._get_priority("!room:test"), StateResPriority.FLOODING)
+
+        # The room stays deferred for the next reporting period.
+        handler._report_metrics()
+        self.assertEqual(handler._get_priority("!room:test"), StateResPriority.FLOODING)
+
+        # Without any state res in the following period, it no longer is.
+        handler._report_metrics()
+        self.assertEqual(handler._get_priority("!room:test"), StateResPriority.NORMAL)
+
+        handler.note_local_activity("!room:test")
+        self.assertEqual(handler._get_priority("!room:test"), StateResPriority.ACTIVE)
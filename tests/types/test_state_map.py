@@ -0,0 +1,93 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.api.constants import EventTypes
+from synapse.types.state import StateFilter
+from synapse.types.state_map import CompactStateMap
+
+from tests.unittest import TestCase
+
+STATE = {
+    (EventTypes.Create, ""): "$create",
+    (EventTypes.Member, "@bob:test"): "$bob",
+    (EventTypes.Member, "@alice:test"): "$alice",
+    (EventTypes.Name, ""): "$name",
+}
+
+
+class CompactStateMapTestCase(TestCase):
+    def test_lookups(self) -> None:
+        state = CompactStateMap(STATE)
+
+        self.assertEqual(len(state), 4)
+        self.assertEqual(state[(EventTypes.Member, "@alice:test")], "$alice")
+        self.assertEqual(state.get((EventTypes.Member, "@bob:test")), "$bob")
+        self.assertIsNone(state.get((EventTypes.Member, "@carol:test")))
+        self.assertEqual(state.get((EventTypes.Topic, ""), "$default"), "$default")
+        self.assertIn((EventTypes.Name, ""), state)
+        self.assertNotIn((EventTypes.Name, "x"), state)
+        self.assertNotIn("not a key", state)
+        with self.assertRaises(KeyError):
+            state[(EventTypes.Topic, "")]
+
+    def test_iteration(self) -> None:
+        state = CompactStateMap(STATE)
+
+        self.assertCountEqual(state, STATE)
+        self.assertCountEqual(state.keys(), STATE.keys())
+        self.assertCountEqual(state.values(), STATE.values())
+        self.assertIn("$bob", state.values())
+        self.assertCountEqual(state.items(), STATE.items())
+        self.assertIn(((EventTypes.Create, ""), "$create"), state.items())
+        self.assertEqual(state.to_dict(), STATE)
+        self.assertEqual(dict(state), STATE)
+
+    def test_equality(self) -> None:
+        state = CompactStateMap(STATE)
+
+        self.assertEqual(state, STATE)
+        self.assertEqual(STATE, state)
+        self.assertEqual(state, CompactStateMap(STATE))
+        self.assertEqual(state, CompactStateMap(state))
+        self.assertNotEqual(
+            state, CompactStateMap({**STATE, (EventTypes.Name, ""): "$n"})
+        )
+        self.assertEqual(CompactStateMap(), {})
+
+    def test_filter_state(self) -> None:
+        state = CompactStateMap(STATE)
+
+        filtered = StateFilter.all().filter_state(state)
+        self.assertIsInstance(filtered, dict)
+        self.assertEqual(filtered, STATE)
+
+        self.assertEqual(
+            StateFilter.from_types([(EventTypes.Member, None)]).filter_state(state),
+            {
+                (EventTypes.Member, "@bob:test"): "$bob",
+                (EventTypes.Member, "@alice:test"): "$alice",
+            },
+        )
+
+    def test_strings_are_shared(self) -> None:
+        """Equal strings from different state maps are stored once."""
+        other_state = {
+            ("".join(k[0]), "".join(k[1])): "".join(v) for k, v in STATE.items()
+        }
+
+        state = CompactStateMap(STATE)
+        other = CompactStateMap(other_state)
+
+        for key in STATE:
+            self.assertIs(state[key], other[key])
@@ -0,0 +1,70 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from unittest.mock import patch
+
+from synapse.util.caches.adaptive import AdaptiveCacheSizer
+from synapse.util.caches.lrucache import LruCache
+
+from tests import unittest
+from tests.unittest import override_config
+
+
+@patch("synapse.util.caches.TRACK_GHOST_ENTRIES", True)
+class AdaptiveCacheSizerTestCase(unittest.HomeserverTestCase):
+    def _make_ghost_hits(self, cache: LruCache[int, int], count: int) -> None:
+        """Fill the cache past its size, then look up the evicted keys."""
+        for i in range(cache.max_size + count):
+            cache[i] = i
+        for i in range(count):
+            self.assertIsNone(cache.get(i))
+
+    def test_ghost_hits(self) -> None:
+        """Lookups of recently evicted keys are counted as ghost hits."""
+        cache: LruCache[int, int] = LruCache(2, cache_name="test_ghost_hits")
+        assert cache.metrics is not None
+
+        self._make_ghost_hits(cache, 1)
+        self.assertEqual(cache.metrics.ghost_hits, 1)
+
+        # Keys which were never in the cache aren't ghost hits.
+        self.assertIsNone(cache.get(100))
+        self.assertEqual(cache.metrics.ghost_hits, 1)
+
+    def test_rebalance(self) -> None:
+        """Caches with more ghost hits are grown at the expense of the others."""
+        hot: LruCache[int, int] = LruCache(10, cache_name="test_rebalance_hot")
+        cold: LruCache[int, int] = LruCache(10, cache_name="test_rebalance_cold")
+
+        self._make_ghost_hits(hot, 5)
+
+        AdaptiveCacheSizer(self.hs).rebalance()
+
+        self.assertGreater(hot.max_size, 10)
+        self.assertEqual(cold.max_size, 9)
+
+    @override_config({"caches": {"adaptive_sizing": {"recommend_only": True}}})
+    def test_recommend_only(self) -> None:
+        """In recommend only mode, caches are not resized."""
+        hot: LruCache[int, int] = LruCache(10, cache_name="test_recommend_hot")
+        cold: LruCache[int, int] = LruCache(10, cache_name="test_recommend_cold")
+
+        hot_size, cold_size = hot.max_size, cold.max_size
+        self._make_ghost_hits(hot, 5)
+
+        with self.assertLogs("synapse.util.caches.adaptive", "INFO") as logs:
+            AdaptiveCacheSizer(self.hs).rebalance()
+
+        self.assertEqual(hot.max_size, hot_size)
+        self.assertEqual(cold.max_size, cold_size)
+        self.assertIn("test_recommend_hot", logs.output[0])
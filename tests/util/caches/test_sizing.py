@@ -0,0 +1,61 @@
+# Copyright 2023 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+
+from synapse.api.room_versions import RoomVersions
+from synapse.events import make_event_from_dict
+from synapse.util.caches.sizing import estimate_size
+from synapse.util.frozenutils import freeze
+
+from tests import unittest
+
+
+class EstimateSizeTestCase(unittest.TestCase):
+    def test_containers(self) -> None:
+        """Containers are sized along with their contents."""
+        user_ids = frozenset(f"@user{i}:test" for i in range(10))
+        self.assertEqual(
+            estimate_size(user_ids),
+            sys.getsizeof(user_ids) + sum(sys.getsizeof(u) for u in user_ids),
+        )
+
+        state_map = {("m.room.member", u): "$event" for u in user_ids}
+        self.assertGreater(estimate_size(state_map), estimate_size(user_ids))
+
+        # Frozen dicts are sized like regular dicts.
+        self.assertGreater(estimate_size(freeze(state_map)), estimate_size(user_ids))
+
+    def test_large_containers_are_sampled(self) -> None:
+        """Large containers are sized by extrapolating from their first items."""
+        values = ["x" * 10] * 10000
+        self.assertEqual(
+            estimate_size(values),
+            sys.getsizeof(values) + 10000 * sys.getsizeof("x" * 10),
+        )
+
+    def test_event(self) -> None:
+        """Events are sized with their content."""
+        small = make_event_from_dict(
+            {"event_id": "$small", "type": "m.room.message", "content": {}},
+            RoomVersions.V1,
+        )
+        large = make_event_from_dict(
+            {
+                "event_id": "$large",
+                "type": "m.room.message",
+                "content": {"body": "x" * 10000},
+            },
+            RoomVersions.V1,
+        )
+        self.assertGreater(estimate_size(large), estimate_size(small) + 10000)
@@ -18,7 +18,12 @@ from unittest.mock import Mock, patch
 
 from synapse.metrics.jemalloc import JemallocStats
 from synapse.types import JsonDict
-from synapse.util.caches.lrucache import LruCache, setup_expire_lru_cache_entries
+from synapse.util.caches.lrucache import (
+    LruCache,
+    _expire_old_entries,
+    get_global_memory_usage,
+    setup_expire_lru_cache_entries,
+)
 from synapse.util.caches.treecache import TreeCache
 
 from tests import unittest
@@ -322,6 +327,19 @@ class TimeEvictionTestCase(unittest.HomeserverTestCase):
         self.assertEqual(cache.get("key1"), None)
         self.assertEqual(cache.get("key2"), 3)
 
+    @patch("synapse.util.caches.lrucache.USE_GLOBAL_LIST", True)
+    def test_evict_at_expiry_time(self) -> None:
+        """Entries which were last accessed exactly the expiry time ago are
+        evicted, without cache autotuning configured.
+        """
+        cache: LruCache[str, int] = LruCache(5, clock=self.hs.get_clock())
+        cache["key"] = 1
+
+        self.reactor.advance(30)
+        self.get_success(_expire_old_entries(self.hs.get_clock(), 30, None))
+
+        self.assertEqual(cache.get("key"), None)
+
 
 class MemoryEvictionTestCase(unittest.HomeserverTestCase):
     @override_config(
@@ -376,3 +394,75 @@ class MemoryEvictionTestCase(unittest.HomeserverTestCase):
         # the items should still be in the cache
         self.assertEqual(cache.get("key1"), 1)
         self.assertEqual(cache.get("key2"), 2)
+
+    @override_config({"caches": {"memory_budget": "10K"}})
+    @patch("synapse.util.caches.lrucache.MEMORY_BUDGET", None)
+    def test_evict_memory_budget(self) -> None:
+        setup_expire_lru_cache_entries(self.hs)
+        cache: LruCache[str, str] = LruCache(100, clock=self.hs.get_clock())
+
+        # Add about twice the budget's worth of entries.
+        for i in range(20):
+            cache[f"key{i}"] = "x" * 1000
+
+        self.assertEqual(len(cache), 20)
+
+        # The least recently used entries should be evicted the next time the
+        # budget is checked.
+        self.reactor.advance(1)
+
+        self.assertLessEqual(get_global_memory_usage(), 10 * 1024)
+        self.assertIsNone(cache.get("key0"))
+        self.assertEqual(cache.get("key19"), "x" * 1000)
+
+    @override_config(
+        {
+            "caches": {
+                "cache_autotuning": {
+                    "max_cache_memory_usage": "700M",
+                    "target_cache_memory_usage": "500M",
+                    "min_cache_ttl": "5m",
+                    "memory_stat": "resident",
+                    "check_interval": "10s",
+                }
+            }
+        }
+    )
+    @patch("synapse.util.caches.lrucache.get_jemalloc_stats")
+    def test_evict_memory_weighted_by_hit_ratio(self, jemalloc_interface: Mock) -> None:
+        """Entries from caches with a high hit ratio are kept for longer when
+        evicting due to memory.
+        """
+        mock_jemalloc_class = Mock(spec=JemallocStats)
+        jemalloc_interface.return_value = mock_jemalloc_class
+        mock_jemalloc_class.get_stat.return_value = 924288000
+
+        setup_expire_lru_cache_entries(self.hs)
+        hot_cache: LruCache[str, int] = LruCache(
+            4, cache_name="test_hot_cache", clock=self.hs.get_clock()
+        )
+        cold_cache: LruCache[str, int] = LruCache(
+            4, cache_name="test_cold_cache", clock=self.hs.get_clock()
+        )
+
+        hot_cache["key"] = 1
+        cold_cache["key"] = 1
+
+        # Give the hot cache a perfect hit ratio, without touching the entries.
+        assert hot_cache.metrics is not None
+        hot_cache.metrics.hits = 10
+
+        # Past the min_cache_ttl only the cold cache's entry gets evicted. (We
+        # check with `in` so as not to update the entries' last access time.)
+        for _ in range(36):
+            self.reactor.advance(10)
+        self.assertIn("key", hot_cache)
+        self.assertNotIn("key", cold_cache)
+
+        # The resident memory is checked, at the configured interval.
+        mock_jemalloc_class.get_stat.assert_called_with("resident")
+        self.assertGreaterEqual(mock_jemalloc_class.get_stat.call_count, 36)
+
+        # Past twice the min_cache_ttl, the hot cache's entry gets evicted too.
+        self.reactor.advance(60 * 5)
+        self.assertNotIn("key", hot_cache)